@@ -1,5 +1,6 @@
 'epub.py functions and classes'
 from epub import Epub
+from epub import EpubWriter
 
 'chapter.py functions and classes'
 from chapter import Chapter
@@ -0,0 +1,415 @@
+import copy
+import itertools
+import mimetypes
+import multiprocessing
+import multiprocessing.pool
+import os
+import struct
+import time
+import zipfile
+import zlib
+
+from constants import *
+
+
+_CHUNK_BUFFER_SIZE = 64 * 1024
+_MEDIA_TYPES = {
+    '.xhtml': 'application/xhtml+xml',
+    '.html': 'text/html',
+    '.ncx': 'application/x-dtbncx+xml',
+    '.opf': 'application/oebps-package+xml',
+    '.xml': 'application/xml',
+    '.css': 'text/css',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+    '.svg': 'image/svg+xml',
+    }
+# Deflating these saves next to nothing, as they are compressed already
+DEFAULT_COMPRESSION_LEVELS = {
+    'image/png': 0,
+    'image/jpeg': 0,
+    'image/gif': 0,
+    'image/webp': 0,
+    }
+
+
+def get_media_type(archive_name):
+    """
+    Returns the media type of an entry from the extension of its name, or
+    'application/octet-stream' if it is unknown.
+    """
+    extension = os.path.splitext(archive_name)[1].lower()
+    media_type = _MEDIA_TYPES.get(extension) or mimetypes.guess_type(archive_name)[0]
+    return media_type or 'application/octet-stream'
+
+
+class CompressionPolicy(object):
+    """
+    Decides how much to compress each entry of an epub, by media type.
+
+    Args:
+        levels (Option[dict]): The zlib compression level of each media
+            type, from 0, which means the entry is stored uncompressed, to 9.
+            These are added to DEFAULT_COMPRESSION_LEVELS, which stores png,
+            jpeg, gif and webp images.
+        default_level (Option[int]): The level of any other media type. By
+            default, this is 6.
+    """
+
+    def __init__(self, levels=None, default_level=6):
+        self.levels = dict(DEFAULT_COMPRESSION_LEVELS)
+        self.levels.update(levels or {})
+        self.default_level = default_level
+
+    def get_level(self, archive_name):
+        return self.levels.get(get_media_type(archive_name), self.default_level)
+
+    def get_compression(self, archive_name, compress_type=None):
+        """
+        Returns the zipfile compression constant and the zlib level to write
+        archive_name with. compress_type overrides the policy if given.
+        """
+        level = self.get_level(archive_name)
+        if compress_type is None:
+            compress_type = zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED
+        if compress_type == zipfile.ZIP_DEFLATED and not level:
+            level = self.default_level or zlib.Z_DEFAULT_COMPRESSION
+        return compress_type, level
+
+
+class EpubArchive(object):
+    """
+    Writes the zip archive of an epub entry by entry, straight into the
+    epub file. The mimetype entry is written first and uncompressed, as
+    required by the epub specification, followed by META-INF/container.xml.
+
+    An existing epub can be opened with mode 'a' instead, to add entries to
+    it and remove entries from it without rewriting the entries it keeps. If
+    an exception is raised inside its with block, the epub is put back the
+    way it was instead.
+
+    Entries are compressed as compression_policy decides for their media
+    type, unless a compress_type is given when writing them.
+
+    Args:
+        file_name (str): The full name of the epub file to create. Any
+            existing file with this name is overwritten. A writable file
+            object can be given instead.
+        mode (Option[str]): 'w' to create a new epub, or 'a' to add to the
+            existing epub file_name. By default, this is 'w'.
+        compression_policy (Option[CompressionPolicy]): How much to compress
+            each entry. By default, images are stored and everything else is
+            compressed at level 6.
+        max_workers (Option[int]): The number of entries write_entries
+            compresses at once. By default, this is the number of CPUs.
+    """
+
+    def __init__(self, file_name, mode='w', compression_policy=None, max_workers=None):
+        self.file_name = file_name
+        self.compression_policy = compression_policy or CompressionPolicy()
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        if mode == 'a':
+            if isinstance(file_name, basestring):
+                self._file = open(file_name, 'r+b')
+            else:
+                self._file = file_name
+            self._zip_file = zipfile.ZipFile(self._file, 'a', zipfile.ZIP_DEFLATED, allowZip64=True)
+            self._source_infos = list(self._zip_file.filelist)
+            self._source_end = self._zip_file.start_dir
+            self._removed_data = None
+        else:
+            self._file = None
+            self._zip_file = zipfile.ZipFile(file_name, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+            self._write_mimetype()
+            self._write_container()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self._file is not None:
+            self._restore()
+        self.close()
+
+    def _restore(self):
+        """
+        Undoes every change to an epub opened with mode 'a'. The entries cut
+        off by remove are written back, and the central directory is then
+        written where it was, so the entries added are cut off instead.
+        """
+        zip_file = self._zip_file
+        if self._removed_data is not None:
+            offset, data = self._removed_data
+            zip_file.fp.seek(offset)
+            zip_file.fp.write(data)
+        zip_file.filelist = list(self._source_infos)
+        zip_file.NameToInfo = dict((zip_info.filename, zip_info) for zip_info in zip_file.filelist)
+        zip_file._didModify = True
+        zip_file.fp.seek(self._source_end)
+
+    def _write_mimetype(self):
+        with open(os.path.join(EPUB_TEMPLATES_DIR, 'minetype.txt'), 'rb') as f:
+            self.write_string('mimetype', f.read(), zipfile.ZIP_STORED)
+
+    def _write_container(self):
+        with open(os.path.join(EPUB_TEMPLATES_DIR, 'container.xml'), 'rb') as f:
+            self.write_string('META-INF/container.xml', f.read())
+
+    def write_string(self, archive_name, data, compress_type=None):
+        """
+        Adds an entry to the archive from a string.
+
+        Args:
+            archive_name (str): The path of the entry inside the archive.
+            data (str): The content of the entry. Unicode strings are encoded
+                as utf-8.
+            compress_type (Option[int]): The zipfile compression constant to
+                use. By default, the compression policy decides.
+        """
+        self.write_compressed(self.compress(archive_name, data, compress_type))
+
+    def compress(self, archive_name, data, compress_type=None):
+        """
+        Compresses the content of an entry without adding it to the archive,
+        so that entries can be compressed on several threads at once. zlib
+        lets other threads run while it compresses.
+
+        Args:
+            The same as those of write_string.
+
+        Returns:
+            tuple: The zipfile.ZipInfo of the entry and its compressed
+                content, to pass to write_compressed.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        compress_type, level = self.compression_policy.get_compression(archive_name, compress_type)
+        zip_info = self._get_zip_info(archive_name, compress_type)
+        zip_info.file_size = len(data)
+        zip_info.CRC = zlib.crc32(data) & 0xffffffff
+        if compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            data = compressor.compress(data) + compressor.flush()
+        zip_info.compress_size = len(data)
+        return zip_info, data
+
+    def write_compressed(self, compressed_entry):
+        """
+        Adds an entry compressed by compress to the archive. Entries must be
+        added from one thread at a time.
+        """
+        zip_info, data = compressed_entry
+        zip_file = self._zip_file
+        zip_info.header_offset = zip_file.fp.tell()
+        zip_file._writecheck(zip_info)
+        zip_file._didModify = True
+        zip64 = zip_info.file_size > zipfile.ZIP64_LIMIT or zip_info.compress_size > zipfile.ZIP64_LIMIT
+        zip_file.fp.write(zip_info.FileHeader(zip64))
+        zip_file.fp.write(data)
+        zip_file.filelist.append(zip_info)
+        zip_file.NameToInfo[zip_info.filename] = zip_info
+
+    def write_entries(self, entries):
+        """
+        Adds entries to the archive in the order given, compressing up to
+        max_workers of them at once. Entries are read and compressed a batch
+        at a time, so only a few are ever held in memory.
+
+        Args:
+            entries (iterable): A (archive_name, read) pair for each entry,
+                where read is a function that returns the content of the
+                entry. It is called from a worker thread.
+        """
+        def compress_entry(entry):
+            archive_name, read = entry
+            return self.compress(archive_name, read())
+        entries = iter(entries)
+        pool = None
+        try:
+            while True:
+                batch = list(itertools.islice(entries, self.max_workers * 4))
+                if not batch:
+                    return
+                if self.max_workers <= 1 or len(batch) == 1:
+                    compressed_entries = [compress_entry(entry) for entry in batch]
+                else:
+                    if pool is None:
+                        pool = multiprocessing.pool.ThreadPool(self.max_workers)
+                    compressed_entries = pool.map(compress_entry, batch)
+                for compressed_entry in compressed_entries:
+                    self.write_compressed(compressed_entry)
+        finally:
+            if pool is not None:
+                # Joining waits on a helper thread that only polls every tenth
+                # of a second, and the idle workers end by themselves
+                pool.close()
+
+    def _get_zip_info(self, archive_name, compress_type):
+        zip_info = zipfile.ZipInfo(archive_name, time.localtime(time.time())[:6])
+        zip_info.compress_type = compress_type
+        zip_info.external_attr = 0644 << 16
+        return zip_info
+
+    def write_chunks(self, archive_name, chunks, compress_type=None):
+        """
+        Adds an entry to the archive from an iterable of strings, compressing
+        each piece as it comes, so the whole content is never held in memory.
+        The header of the entry is rewritten once its size and CRC are known,
+        so the epub must be written to a seekable file. Entries written this
+        way must be smaller than 2 GB.
+
+        Args:
+            archive_name (str): The path of the entry inside the archive.
+            chunks (iterable): The pieces of the content of the entry.
+                Unicode strings are encoded as utf-8.
+            compress_type (Option[int]): The zipfile compression constant to
+                use. By default, the compression policy decides.
+        """
+        compress_type, level = self.compression_policy.get_compression(archive_name, compress_type)
+        zip_file = self._zip_file
+        zip_info = self._get_zip_info(archive_name, compress_type)
+        zip_info.flag_bits = 0x00
+        zip_info.header_offset = zip_file.fp.tell()
+        zip_info.file_size = zip_info.compress_size = zip_info.CRC = 0
+        zip_file._writecheck(zip_info)
+        zip_file._didModify = True
+        zip_file.fp.write(zip_info.FileHeader(False))
+        if compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        else:
+            compressor = None
+
+        def write_buffer(buffered_chunks):
+            data = ''.join(buffered_chunks)
+            zip_info.file_size += len(data)
+            zip_info.CRC = zlib.crc32(data, zip_info.CRC) & 0xffffffff
+            if compressor is not None:
+                data = compressor.compress(data)
+            zip_info.compress_size += len(data)
+            zip_file.fp.write(data)
+        buffered_chunks = []
+        buffered_size = 0
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            buffered_chunks.append(chunk)
+            buffered_size += len(chunk)
+            # Compressing many tiny pieces one at a time is slow
+            if buffered_size >= _CHUNK_BUFFER_SIZE:
+                write_buffer(buffered_chunks)
+                buffered_chunks = []
+                buffered_size = 0
+        write_buffer(buffered_chunks)
+        if compressor is not None:
+            data = compressor.flush()
+            zip_info.compress_size += len(data)
+            zip_file.fp.write(data)
+        if zip_info.file_size > zipfile.ZIP64_LIMIT or zip_info.compress_size > zipfile.ZIP64_LIMIT:
+            raise RuntimeError('%s is too large to write in chunks' % archive_name)
+        position = zip_file.fp.tell()
+        zip_file.fp.seek(zip_info.header_offset)
+        zip_file.fp.write(zip_info.FileHeader(False))
+        zip_file.fp.seek(position)
+        zip_file.filelist.append(zip_info)
+        zip_file.NameToInfo[zip_info.filename] = zip_info
+
+    def write_file(self, archive_name, file_name, compress_type=None):
+        """
+        Adds an entry to the archive from a file on disk. The file is
+        compressed in chunks, so it is never read into memory as a whole.
+
+        Args:
+            archive_name (str): The path of the entry inside the archive.
+            file_name (str): The full name of the file to add.
+            compress_type (Option[int]): The zipfile compression constant to
+                use. By default, the compression policy decides.
+        """
+        with open(file_name, 'rb') as f:
+            self.write_chunks(archive_name, iter(lambda: f.read(_CHUNK_BUFFER_SIZE), ''), compress_type)
+
+    def names(self):
+        """
+        Returns the names of all entries in the archive, in the order they
+        were written.
+        """
+        return self._zip_file.namelist()
+
+    def remove(self, archive_names):
+        """
+        Removes entries from an epub opened with mode 'a'. Must be called
+        before any entries are added. Entries at the end of the epub file are
+        cut off it, while the space of any others is left unused. What is cut
+        off is kept in memory until the epub is closed, to put it back if
+        adding the new entries fails.
+
+        Args:
+            archive_names (list): The paths of the entries inside the archive.
+        """
+        zip_file = self._zip_file
+        removed_infos = [zip_file.NameToInfo.pop(name) for name in archive_names]
+        zip_file.filelist = [zip_info for zip_info in zip_file.filelist if zip_info not in removed_infos]
+        zip_file._didModify = True
+        if any(zip_info.flag_bits & 0x08 for zip_info in zip_file.filelist):
+            # Where entries with a data descriptor end isn't worth working out
+            zip_file.fp.seek(zip_file.start_dir)
+            return
+        end_offsets = [_get_end_offset(zip_file, zip_info) for zip_info in zip_file.filelist]
+        end_offset = max([0] + end_offsets)
+        zip_file.fp.seek(end_offset)
+        self._removed_data = (end_offset, zip_file.fp.read(self._source_end - end_offset))
+        zip_file.fp.seek(end_offset)
+
+    def copy_entries(self, source_zip_file, archive_names):
+        """
+        Adds entries from another epub without decompressing or recompressing
+        them, so they are kept byte for byte.
+
+        Args:
+            source_zip_file (zipfile.ZipFile): The epub to copy entries from.
+            archive_names (list): The paths of the entries to copy.
+        """
+        zip_file = self._zip_file
+        for name in archive_names:
+            source_info = source_zip_file.getinfo(name)
+            if source_info.flag_bits & 0x08:
+                # The sizes of the entry are in a data descriptor after it,
+                # which isn't worth parsing for the rare epubs that have them
+                self.write_string(name, source_zip_file.read(name), source_info.compress_type)
+                continue
+            entry_size = _get_end_offset(source_zip_file, source_info) - source_info.header_offset
+            source_zip_file.fp.seek(source_info.header_offset)
+            zip_info = copy.copy(source_info)
+            zip_info.header_offset = zip_file.fp.tell()
+            zip_file._writecheck(zip_info)
+            zip_file._didModify = True
+            while entry_size > 0:
+                data = source_zip_file.fp.read(min(entry_size, _CHUNK_BUFFER_SIZE))
+                zip_file.fp.write(data)
+                entry_size -= len(data)
+            zip_file.filelist.append(zip_info)
+            zip_file.NameToInfo[zip_info.filename] = zip_info
+
+    def close(self):
+        """
+        Writes the central directory and closes the epub file.
+        """
+        self._zip_file.close()
+        if self._file is not None:
+            # Cut off what is left of a longer central directory
+            self._file.truncate()
+            if isinstance(self.file_name, basestring):
+                self._file.close()
+
+
+def _get_end_offset(zip_file, zip_info):
+    """
+    Returns the offset in the file of zip_file just after the entry of
+    zip_info, which is where the next entry would start.
+    """
+    zip_file.fp.seek(zip_info.header_offset)
+    local_header = zip_file.fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+    return zip_info.header_offset + zipfile.sizeFileHeader + name_length + extra_length + zip_info.compress_size
@@ -0,0 +1,319 @@
+"""
+Offline benchmarks for pypub, to compare the performance of different
+commits. Nothing is fetched from the internet: pages come from test_files and
+from synthetic chapters, and images from a local stand-in server.
+
+Each benchmark runs in its own process so that its peak memory can be
+measured, and the results are printed as JSON.
+
+    python benchmarks.py > before.json
+    python benchmarks.py --chapters 200 --images 4 > after.json
+    python benchmarks.py --compare before.json after.json
+    python benchmarks.py --profile add_chapter
+
+The clean_deep and clean_wide benchmarks sanitize synthetic trees of --nodes
+nodes, nested or side by side. Their nodes per second (items_per_second)
+stay about the same for any --nodes when sanitizing takes linear time.
+"""
+import argparse
+import codecs
+import cProfile
+import json
+import os
+import platform
+import pstats
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import chapter
+import clean
+from constants import *
+import epub
+import local_server
+import storage
+
+
+_PARAGRAPH = (u'<p>Lorem ipsum dolor sit amet, <a href="#">consectetur</a> adipiscing elit, sed do '
+              u'<b>eiusmod</b> tempor incididunt ut labore et dolore magna aliqua.&nbsp;Ut enim ad '
+              u'minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea.</p>')
+
+
+def _read_test_file(file_name):
+    with codecs.open(os.path.join(TEST_DIR, file_name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def _get_test_pages():
+    return [_read_test_file('example.html'), _read_test_file('strategy&.html')]
+
+
+def _create_synthetic_chapter(index, image_urls, paragraphs=50):
+    image_tags = u''.join(u'<img src="%s"/>' % image_url for image_url in image_urls)
+    return u'<html><head><title>Chapter %d</title><script>var x = 1;</script></head><body>%s%s</body></html>' % (
+        index, _PARAGRAPH * paragraphs, image_tags)
+
+
+def _create_deep_page(nodes):
+    # Every level has a removed tag to hoist from and a kept one to nest in
+    levels = nodes // 3
+    return u'<html><body>%s%s</body></html>' % (u'<section><p>level</p><div>' * levels,
+                                                u'</div></section>' * levels)
+
+
+def _create_wide_page(nodes):
+    return u'<html><body>%s</body></html>' % (u'<section><p>item</p></section><div>item</div>' * (nodes // 3))
+
+
+class _Corpus(object):
+    """
+    Synthetic chapters whose images are served by a local_server.LocalServer.
+    Every image is different, so none are shared between chapters.
+    """
+
+    def __init__(self, chapter_count, images_per_chapter):
+        self.server = local_server.LocalServer()
+        with open(os.path.join(TEST_DIR, 'test image 0.png'), 'rb') as f:
+            png_data = f.read()
+        self.html_strings = []
+        for index in range(chapter_count):
+            image_urls = [self.server.add_route('/%d/%d.png' % (index, n), png_data + '%d-%d' % (index, n),
+                                                'image/png')
+                          for n in range(images_per_chapter)]
+            self.html_strings.append(_create_synthetic_chapter(index, image_urls))
+
+    def create_chapters(self):
+        factory = chapter.ChapterFactory()
+        return [factory.create_chapter_from_string(html_string) for html_string in self.html_strings]
+
+    def close(self):
+        self.server.close()
+
+
+def _benchmark_clean(options, engine):
+    pages = _get_test_pages()
+    for i in range(options.repeat):
+        for page in pages:
+            clean.clean(page, engine=engine)
+    return len(pages) * options.repeat, sum(len(page) for page in pages) * options.repeat
+
+
+def _benchmark_clean_tree(options, engine, create_page):
+    engine = clean.get_engine(engine)
+    page = create_page(options.nodes)
+    roots = [engine.parse(page) for i in range(options.repeat)]
+    start_time = time.time()
+    for root in roots:
+        engine.clean_tree(root)
+    return options.nodes // 3 * 3 * options.repeat, len(page) * options.repeat, start_time
+
+
+def _benchmark_html_to_xhtml(options, engine):
+    pages = [clean.clean(page, engine=engine) for page in _get_test_pages()]
+    start_time = time.time()
+    for i in range(options.repeat):
+        for page in pages:
+            clean.html_to_xhtml(page, engine=engine)
+    return len(pages) * options.repeat, sum(len(page) for page in pages) * options.repeat, start_time
+
+
+def _benchmark_create_chapter(options, extract_content=False):
+    factory = chapter.ChapterFactory(extract_content=extract_content)
+    pages = _get_test_pages()
+    for i in range(options.repeat):
+        for page in pages:
+            factory.create_chapter_from_string(page).content
+    return len(pages) * options.repeat, sum(len(page) for page in pages) * options.repeat
+
+
+def _benchmark_add_chapter(options):
+    corpus = _Corpus(options.chapters, options.images)
+    try:
+        chapters = corpus.create_chapters()
+        start_time = time.time()
+        e = epub.Epub('Benchmark', store=storage.MemoryStore())
+        for c in chapters:
+            e.add_chapter(c)
+        return options.chapters, sum(e.store.size(name) for name in e.store.names()), start_time
+    finally:
+        corpus.close()
+
+
+def _benchmark_create_epub(options):
+    corpus = _Corpus(options.chapters, options.images)
+    output_directory = tempfile.mkdtemp()
+    try:
+        e = epub.Epub('Benchmark', store=storage.MemoryStore())
+        for c in corpus.create_chapters():
+            e.add_chapter(c)
+        start_time = time.time()
+        epub_path = e.create_epub(output_directory)
+        return options.chapters, os.path.getsize(epub_path), start_time
+    finally:
+        corpus.close()
+        shutil.rmtree(output_directory)
+
+
+def _benchmark_epub_writer(options):
+    corpus = _Corpus(options.chapters, options.images)
+    output_directory = tempfile.mkdtemp()
+    try:
+        epub_path = os.path.join(output_directory, 'Benchmark.epub')
+        factory = chapter.ChapterFactory()
+        start_time = time.time()
+        # Chapters are created one at a time, so only one is ever in memory
+        with epub.EpubWriter(epub_path, 'Benchmark') as writer:
+            for html_string in corpus.html_strings:
+                writer.add_chapter(factory.create_chapter_from_string(html_string))
+        return options.chapters, os.path.getsize(epub_path), start_time
+    finally:
+        corpus.close()
+        shutil.rmtree(output_directory)
+
+
+BENCHMARKS = {
+    'clean[bs4]': lambda options: _benchmark_clean(options, 'bs4'),
+    'clean[lxml]': lambda options: _benchmark_clean(options, 'lxml'),
+    'clean_deep[bs4]': lambda options: _benchmark_clean_tree(options, 'bs4', _create_deep_page),
+    'clean_deep[lxml]': lambda options: _benchmark_clean_tree(options, 'lxml', _create_deep_page),
+    'clean_wide[bs4]': lambda options: _benchmark_clean_tree(options, 'bs4', _create_wide_page),
+    'clean_wide[lxml]': lambda options: _benchmark_clean_tree(options, 'lxml', _create_wide_page),
+    'html_to_xhtml[bs4]': lambda options: _benchmark_html_to_xhtml(options, 'bs4'),
+    'html_to_xhtml[lxml]': lambda options: _benchmark_html_to_xhtml(options, 'lxml'),
+    'create_chapter': _benchmark_create_chapter,
+    'create_chapter[extract]': lambda options: _benchmark_create_chapter(options, extract_content=True),
+    'add_chapter': _benchmark_add_chapter,
+    'create_epub': _benchmark_create_epub,
+    'epub_writer': _benchmark_epub_writer,
+    }
+
+
+def _get_max_rss_kb():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    if sys.platform == 'darwin':
+        max_rss //= 1024
+    return max_rss
+
+
+def run_benchmark(name, options):
+    """
+    Runs the benchmark name in this process.
+
+    Returns:
+        dict: The time taken, the number of items and bytes processed, the
+            rates of both and the peak memory of the process. A benchmark that
+            has to set things up first only times what comes after.
+    """
+    start_time = time.time()
+    result = BENCHMARKS[name](options)
+    end_time = time.time()
+    if len(result) == 3:
+        items, byte_count, start_time = result
+    else:
+        items, byte_count = result
+    seconds = max(end_time - start_time, 1e-9)
+    return {
+        'seconds': seconds,
+        'items': items,
+        'bytes': byte_count,
+        'items_per_second': items / seconds,
+        'bytes_per_second': byte_count / seconds,
+        'max_rss_kb': _get_max_rss_kb(),
+        }
+
+
+def run_benchmarks(names, options):
+    """
+    Runs each benchmark in names in a new process, so the peak memory of one
+    doesn't hide that of the next.
+
+    Returns:
+        dict: The results of run_benchmark for each benchmark, by name, or
+            the error of those that fail.
+    """
+    results = {}
+    for name in names:
+        command = [sys.executable, os.path.abspath(__file__), '--run', name, '--chapters', str(options.chapters),
+                   '--images', str(options.images), '--repeat', str(options.repeat), '--nodes', str(options.nodes)]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        output, error = process.communicate()
+        if process.returncode == 0:
+            results[name] = json.loads(output)
+        else:
+            results[name] = {'error': error.strip().splitlines()[-1] if error.strip() else 'failed'}
+    return results
+
+
+def compare_results(old_results, new_results):
+    """
+    Returns lines comparing two outputs of this script: the ratio of the new
+    throughput and peak memory of each benchmark to the old.
+    """
+    lines = ['%-22s %12s %12s' % ('benchmark', 'throughput', 'memory')]
+    for name in sorted(set(old_results['benchmarks']) & set(new_results['benchmarks'])):
+        old, new = old_results['benchmarks'][name], new_results['benchmarks'][name]
+        if 'error' in old or 'error' in new:
+            lines.append('%-22s %12s %12s' % (name, 'error', 'error'))
+            continue
+        memory_ratio = ''
+        if old['max_rss_kb'] and new['max_rss_kb']:
+            memory_ratio = '%.2fx' % (float(new['max_rss_kb']) / old['max_rss_kb'])
+        lines.append('%-22s %11.2fx %12s' % (name, new['items_per_second'] / old['items_per_second'], memory_ratio))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run offline pypub benchmarks and print the results as JSON.')
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run, by default all of %s'
+                        % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--chapters', type=int, default=50, help='chapters in the synthetic book')
+    parser.add_argument('--images', type=int, default=2, help='images in each synthetic chapter')
+    parser.add_argument('--repeat', type=int, default=5, help='times to process each test page')
+    parser.add_argument('--nodes', type=int, default=3000, help='nodes in the synthetic deep and wide trees')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two JSON outputs')
+    parser.add_argument('--profile', metavar='BENCHMARK', help='profile one benchmark with cProfile')
+    parser.add_argument('--run', metavar='BENCHMARK', help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+
+    if options.compare:
+        with open(options.compare[0]) as old_file, open(options.compare[1]) as new_file:
+            print '\n'.join(compare_results(json.load(old_file), json.load(new_file)))
+        return
+    if options.run:
+        print json.dumps(run_benchmark(options.run, options))
+        return
+    if options.profile:
+        profile = cProfile.Profile()
+        profile.enable()
+        BENCHMARKS[options.profile](options)
+        profile.disable()
+        pstats.Stats(profile, stream=sys.stdout).sort_stats('cumulative').print_stats(30)
+        return
+    names = options.benchmarks or sorted(BENCHMARKS)
+    if not clean.lxml_module_exists:
+        names = [name for name in names if '[lxml]' not in name]
+    unknown_names = [name for name in names if name not in BENCHMARKS]
+    if unknown_names:
+        parser.error('unknown benchmarks: %s' % ', '.join(unknown_names))
+    print json.dumps({
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {'chapters': options.chapters, 'images': options.images, 'repeat': options.repeat,
+                    'nodes': options.nodes},
+        'benchmarks': run_benchmarks(names, options),
+        }, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+import requests.structures
+import requests.utils
+
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class OfflineError(requests.exceptions.ConnectionError):
+    def __init__(self, url):
+        super(OfflineError, self).__init__(url)
+        self.url = url
+
+    def __str__(self):
+        return 'No cached response for %s in offline mode' % self.url
+
+
+class ResponseCache(object):
+    """
+    An on-disk cache of the pages and images pypub downloads, so rebuilding a
+    book from mostly unchanged pages costs little network time.
+
+    Cached responses are revalidated with If-None-Match and If-Modified-Since
+    requests, so unchanged pages and images aren't downloaded again. When the
+    cache grows past max_bytes, the least recently used responses are evicted.
+    Only successful responses are cached, and only responses without a
+    Cache-Control: no-store header.
+
+    A cache directory should only be used by one process at a time.
+
+    Args:
+        directory (str): The directory to keep cached responses in. It is
+            created if it doesn't exist.
+        max_bytes (Option[int]): The largest total size of cached responses.
+            By default, this is 512 MB.
+        max_age (Option[int]): The number of seconds a cached response is used
+            without revalidating it. By default, this is 0, so every cached
+            response is revalidated.
+        offline (Option[bool]): If True, responses are only served from the
+            cache and the network is never used. By default, this is False.
+    """
+
+    _index_file_name = 'index.json'
+    _cached_headers = ('Content-Type', 'ETag', 'Last-Modified')
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024, max_age=0, offline=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.offline = offline
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._index = self._read_index()
+        self.size = sum(entry['size'] for entry in self._index.values())
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.directory, self._index_file_name), 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_index(self):
+        index_file_name = os.path.join(self.directory, self._index_file_name)
+        with open(index_file_name + '.tmp', 'wb') as f:
+            json.dump(self._index, f)
+        if os.name == 'nt' and os.path.exists(index_file_name):
+            os.remove(index_file_name)
+        os.rename(index_file_name + '.tmp', index_file_name)
+
+    def _get_key(self, url):
+        return hashlib.sha1(url.encode('utf-8') if isinstance(url, unicode) else url).hexdigest()
+
+    def _get_body_file_name(self, key):
+        return os.path.join(self.directory, key + '.body')
+
+    def get(self, url, headers=None, session=None, max_bytes=None, **kwargs):
+        """
+        Gets url through the cache. Takes the same arguments as requests.get,
+        except that responses are always read in full, even with stream=True.
+        Responses are downloaded with session, a requests.Session, if one is
+        given.
+
+        If max_bytes is given, no more than max_bytes and a little more of a
+        response are read, and larger responses aren't cached. A response
+        whose Content-Length is larger than max_bytes is returned unread, and
+        the content of any other larger response is cut off, so the caller
+        can tell it is too large either way.
+
+        Returns:
+            requests.Response: The response, whether cached or downloaded.
+
+        Raises:
+            OfflineError: Raised in offline mode if url isn't cached.
+            requests.exceptions.RequestException: Raised if the request fails.
+        """
+        kwargs.pop('stream', None)
+        key = self._get_key(url)
+        with self._lock:
+            entry = self._index.get(key)
+        if self.offline:
+            if entry is None:
+                raise OfflineError(url)
+            return self._use_entry(key, entry, url, max_bytes)
+        if entry is not None and time.time() - entry['stored'] < self.max_age:
+            return self._use_entry(key, entry, url, max_bytes)
+        request_headers = dict(headers or {})
+        if entry is not None:
+            if entry['headers'].get('ETag'):
+                request_headers['If-None-Match'] = entry['headers']['ETag']
+            if entry['headers'].get('Last-Modified'):
+                request_headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        response = (session or requests).get(url, headers=request_headers, stream=True, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            with self._lock:
+                entry['stored'] = time.time()
+            return self._use_entry(key, entry, url, max_bytes)
+        if (self._read_content(response, max_bytes) and response.status_code == 200 and
+                'no-store' not in response.headers.get('Cache-Control', '')):
+            self._store(key, url, response)
+        return response
+
+    def _read_content(self, response, max_bytes):
+        """
+        Reads the body of response, stopping once more than max_bytes arrive,
+        and returns whether all of it was read.
+        """
+        if max_bytes is None:
+            response.content
+            return True
+        content_length = response.headers.get('Content-Length', '')
+        if content_length.isdigit() and int(content_length) > max_bytes:
+            return False
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(_CHUNK_SIZE):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > max_bytes:
+                response.close()
+                break
+        response._content = ''.join(chunks)
+        response._content_consumed = True
+        return size <= max_bytes
+
+    def _use_entry(self, key, entry, url, max_bytes=None):
+        try:
+            with open(self._get_body_file_name(key), 'rb') as f:
+                content = f.read() if max_bytes is None else f.read(max_bytes + 1)
+        except IOError:
+            with self._lock:
+                self._remove(key)
+            raise requests.exceptions.ConnectionError('Cached response for %s is missing' % url)
+        with self._lock:
+            entry['used'] = time.time()
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = content
+        response._content_consumed = True
+        return response
+
+    def _store(self, key, url, response):
+        content = response.content
+        with self._lock:
+            if key in self._index:
+                self._remove(key)
+            if len(content) > self.max_bytes:
+                self._write_index()
+                return
+            with open(self._get_body_file_name(key), 'wb') as f:
+                f.write(content)
+            now = time.time()
+            self._index[key] = {
+                'url': url,
+                'headers': dict((header, response.headers[header]) for header in self._cached_headers
+                                if header in response.headers),
+                'size': len(content),
+                'stored': now,
+                'used': now,
+                }
+            self.size += len(content)
+            self._evict()
+            self._write_index()
+
+    def _evict(self):
+        if self.size <= self.max_bytes:
+            return
+        for key in sorted(self._index, key=lambda k: self._index[k]['used']):
+            self._remove(key)
+            if self.size <= self.max_bytes:
+                break
+
+    def _remove(self, key):
+        entry = self._index.pop(key)
+        self.size -= entry['size']
+        try:
+            os.remove(self._get_body_file_name(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        """
+        Removes every cached response.
+        """
+        with self._lock:
+            for key in list(self._index):
+                self._remove(key)
+            self._write_index()
+
+    def close(self):
+        """
+        Saves when each cached response was last used, so least recently used
+        eviction carries over to the next process using the cache.
+        """
+        with self._lock:
+            self._write_index()
@@ -1,13 +1,84 @@
+import copy
+import HTMLParser
+import imp
 import re
+import threading
 
 import bs4
 
 from bs4 import BeautifulSoup
-from bs4.dammit import EntitySubstitution
+
+try:
+    imp.find_module('lxml')
+    lxml_module_exists = True
+    import lxml.etree
+    import lxml.html
+except ImportError:
+    lxml_module_exists = False
 
 import constants
 
 
+_positive_hint_regex = re.compile(r'article|body|content|entry|main|page|post|story|text', re.IGNORECASE)
+_negative_hint_regex = re.compile(r'ad-|banner|breadcrumb|comment|footer|header|menu|meta|nav|promo|related|'
+                                  r'share|sidebar|social|sponsor|widget', re.IGNORECASE)
+_PARAGRAPH_TAGS = frozenset(['blockquote', 'p', 'pre'])
+_MIN_PARAGRAPH_LENGTH = 25
+_MIN_CONTENT_LENGTH = 250
+_SINGLETON_TAGS = frozenset(constants.SINGLETON_TAG_LIST)
+_PRESERVE_WHITESPACE_TAGS = frozenset(['pre', 'textarea'])
+# lxml escapes < and > in attribute values, so a singleton tag ends at the first />
+_singleton_tag_regex = re.compile(r'<(%s)((?:\s[^<>]*?)?)/>' % '|'.join(constants.SINGLETON_TAG_LIST))
+_image_tag_or_comment_regex = re.compile(r'<!--.*?-->|<img\b[^>]*>', re.DOTALL)
+_source_attribute_regex = re.compile(r'\ssrc="([^"]*)"')
+_html_parser = HTMLParser.HTMLParser()
+# Control characters other than tab, newline and carriage return, which XML
+# doesn't allow anywhere and lxml refuses to put in a tree
+_invalid_xml_character_regex = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+class SanitizerPolicy(object):
+    """
+    A tag and attribute whitelist compiled for fast lookups, used by clean
+    and the clean_tree method of every engine. Compiling a policy once and
+    passing it instead of a dictionary saves compiling it on every call.
+
+    Args:
+        tag_dictionary (Option[dict]): A dictionary with tags as keys and
+            attributes as values. See clean. By default, this is
+            constants.SUPPORTED_TAGS.
+        dropped_tags (Option[list]): Tags removed together with everything
+            inside them, rather than replaced by the tags inside them. By
+            default, this is constants.DROPPED_TAGS: script, style, iframe
+            and nav, whose contents don't belong in a book.
+
+    Attributes:
+        tags (frozenset): The tags kept.
+        attributes (dict): The frozenset of attributes kept for each tag.
+        dropped_tags (frozenset): The tags dropped with their contents.
+    """
+
+    def __init__(self, tag_dictionary=constants.SUPPORTED_TAGS, dropped_tags=constants.DROPPED_TAGS):
+        self.tags = frozenset(tag_dictionary)
+        self.attributes = dict((tag, frozenset(attributes)) for tag, attributes in tag_dictionary.items())
+        self.dropped_tags = frozenset(dropped_tags)
+
+
+DEFAULT_POLICY = SanitizerPolicy()
+
+
+def get_policy(tag_dictionary=constants.SUPPORTED_TAGS):
+    """
+    Returns tag_dictionary compiled into a SanitizerPolicy. A SanitizerPolicy
+    is returned unchanged, and the default dictionary isn't compiled again.
+    """
+    if isinstance(tag_dictionary, SanitizerPolicy):
+        return tag_dictionary
+    if tag_dictionary is constants.SUPPORTED_TAGS:
+        return DEFAULT_POLICY
+    return SanitizerPolicy(tag_dictionary)
+
+
 def create_html_from_fragment(tag):
     """
     Creates full html tree from a fragment. Assumes that tag should be wrapped in a body and is currently not
@@ -34,12 +105,16 @@ def create_html_from_fragment(tag):
 
 
 def clean(input_string,
-          tag_dictionary=constants.SUPPORTED_TAGS):
+          tag_dictionary=constants.SUPPORTED_TAGS,
+          engine=None,
+          extract_content=False):
     """
     Sanitizes HTML. Tags not contained as keys in the tag_dictionary input are
-    removed, and child nodes are recursively moved to parent of removed node.
-    Attributes not contained as arguments in tag_dictionary are removed.
-    Doctype is set to <!DOCTYPE html>.
+    removed, and the tags inside them take their place. Text directly inside
+    a removed tag is removed with it. Script, style, iframe and nav tags are
+    removed with everything inside them. Attributes not contained as
+    arguments in tag_dictionary are removed. Doctype is set to
+    <!DOCTYPE html>.
 
     Args:
         input_string (basestring): A (possibly unicode) string representing HTML.
@@ -48,6 +123,12 @@ def clean(input_string,
             isn't contained, it will be removed. By default, this is set to
             use the supported tags and attributes for the Amazon Kindle,
             as found at https://kdp.amazon.com/help?topicId=A1JPUWCSD6F59O
+            A SanitizerPolicy can be given instead.
+        engine (Option[str]): The name of the sanitizer engine to use, either
+            'lxml' or 'bs4'. By default, this is lxml if it is installed and
+            bs4 otherwise.
+        extract_content (Option[bool]): If True, only the main content of
+            the page is kept, see extract_content. By default, this is False.
 
     Returns:
         str: A (possibly unicode) string representing HTML.
@@ -59,41 +140,226 @@ def clean(input_string,
         assert isinstance(input_string, basestring)
     except AssertionError:
         raise TypeError
-    root = BeautifulSoup(input_string, 'html.parser')
-    article_tag = root.find_all('article')
-    if article_tag:
-        root = article_tag[0]
-    stack = root.findAll(True, recursive=False)
+    engine = get_engine(engine)
+    root = engine.parse(input_string)
+    if extract_content:
+        root = engine.extract_content(root)
+    root = engine.clean_tree(root, tag_dictionary)
+    return engine.html_tree_to_string(root)
+
+
+def clean_tree(root,
+               tag_dictionary=constants.SUPPORTED_TAGS):
+    """
+    Sanitizes an already parsed HTML tree in place. This is the tree level
+    counterpart of clean, and lets callers that already hold a parsed
+    document avoid serializing and parsing it again. Every node is visited
+    once, so the time taken grows linearly with the size of the tree,
+    however deep or wide it is.
+
+    Args:
+        root (bs4.BeautifulSoup): The parsed HTML document to sanitize.
+        tag_dictionary (Option[dict]): A dictionary with tags as keys and
+            attributes as values, or a SanitizerPolicy. See clean.
+
+    Returns:
+        bs4.BeautifulSoup: The root of the sanitized tree. This is either
+            root itself or, if root is only a fragment or contains an
+            article tag, a new document wrapping the kept content.
+
+    Raises:
+        TypeError: Raised if root isn't a bs4 tag.
+    """
+    try:
+        assert isinstance(root, bs4.element.Tag)
+    except AssertionError:
+        raise TypeError
+    policy = get_policy(tag_dictionary)
+    article_node = root.find('article')
+    if article_node is not None:
+        root = article_node.extract()
+        for attribute, value in root.attrs.items():
+            if isinstance(value, basestring):
+                root.attrs[attribute] = _invalid_xml_character_regex.sub(u'', value)
+    # The new children of each kept node are collected into a list, which
+    # replaces its contents at once; extracting and appending nodes one at a
+    # time costs time proportional to their siblings and descendants
+    new_contents = []
+    # Each frame holds the list the children of a node go into, and whether
+    # the text among them is kept, which it isn't inside a removed node
+    stack = [(new_contents, iter(root.contents), True)]
     while stack:
-        current_node = stack.pop()
-        child_node_list = current_node.findAll(True, recursive=False)
-        if current_node.name not in tag_dictionary.keys():
-            parent_node = current_node.parent
-            current_node.extract()
-            for n in child_node_list:
-                parent_node.append(n)
-        else:
-            attribute_dict = current_node.attrs
-            for attribute in attribute_dict.keys():
-                if attribute not in tag_dictionary[current_node.name]:
-                    attribute_dict.pop(attribute)
-        stack.extend(child_node_list)
+        output, children, keep_text = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+        elif isinstance(child, bs4.element.Tag):
+            if child.name in policy.dropped_tags or (child.name == 'img' and not child.has_attr('src')):
+                continue
+            if child.name in policy.tags:
+                allowed_attributes = policy.attributes[child.name]
+                attribute_dict = child.attrs
+                for attribute in attribute_dict.keys():
+                    if attribute not in allowed_attributes:
+                        del attribute_dict[attribute]
+                    elif isinstance(attribute_dict[attribute], basestring):
+                        attribute_dict[attribute] = _clean_text(attribute_dict[attribute])
+                    else:
+                        attribute_dict[attribute] = [_clean_text(value) for value in attribute_dict[attribute]]
+                output.append(child)
+                child_contents = child.contents
+                child.contents = []
+                stack.append((child.contents, iter(child_contents), True))
+            else:
+                stack.append((output, iter(child.contents), False))
+        elif keep_text:
+            if type(child) is bs4.element.NavigableString:
+                text = _clean_text(child)
+                if text != child:
+                    child = bs4.element.NavigableString(text)
+            output.append(child)
+    root.contents = new_contents
+    _relink_tree(root)
     #wrap partial tree if necessary
-    if root.find_all('html') == []:
+    if root.find('html') is None:
         root = create_html_from_fragment(root)
-    # Remove img tags without src attribute
-    image_node_list = root.find_all('img')
-    for node in image_node_list:
-        if not node.has_attr('src'):
-            node.extract()
-    unformatted_html_unicode_string = unicode(root.prettify(encoding='utf-8',
-                                                            formatter=EntitySubstitution.substitute_html),
-                                              encoding='utf-8')
-    # fix <br> tags since not handled well by default by bs4
-    unformatted_html_unicode_string = unformatted_html_unicode_string.replace('<br>', '<br/>')
-    # remove &nbsp; and replace with space since not handled well by certain e-readers
-    unformatted_html_unicode_string = unformatted_html_unicode_string.replace('&nbsp;', ' ')
-    return unformatted_html_unicode_string
+    return root
+
+
+def _relink_tree(root):
+    """
+    Points the parent, sibling and element links of every node under root at
+    the nodes around it in the contents lists, after those were rebuilt.
+    """
+    last_element = root
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node is not root:
+            last_element.next_element = node
+            node.previous_element = last_element
+            last_element = node
+        if isinstance(node, bs4.element.Tag):
+            previous_sibling = None
+            for child in node.contents:
+                child.parent = node
+                child.previous_sibling = previous_sibling
+                if previous_sibling is not None:
+                    previous_sibling.next_sibling = child
+                previous_sibling = child
+            if previous_sibling is not None:
+                previous_sibling.next_sibling = None
+            stack.extend(reversed(node.contents))
+    last_element.next_element = None
+
+
+def extract_content(root):
+    """
+    Narrows a parsed HTML document to its main content, e.g. the text of an
+    article without the menus, comments, footers and related links around
+    it, so none of those are sanitized, converted or packaged. The main
+    content is the element holding the most text in paragraphs that isn't
+    link text, with hints taken from class and id names. Documents without
+    enough such text are left as they are.
+
+    Args:
+        root (bs4.BeautifulSoup): The parsed HTML document.
+
+    Returns:
+        bs4.BeautifulSoup: root, with only the main content left in its
+            body.
+    """
+    body = root.body
+    if body is None:
+        return root
+    nodes = []
+    parent_indexes = []
+    tags = []
+    hints = []
+    text_lengths = []
+    comma_counts = []
+    stack = [(body, -1)]
+    while stack:
+        node, parent_index = stack.pop()
+        if isinstance(node, bs4.element.Tag):
+            if node.name in constants.DROPPED_TAGS:
+                continue
+            index = len(nodes)
+            nodes.append(node)
+            parent_indexes.append(parent_index)
+            tags.append(node.name)
+            class_names = node.get('class', '')
+            if isinstance(class_names, list):
+                class_names = ' '.join(class_names)
+            hints.append(class_names + ' ' + node.get('id', ''))
+            text_lengths.append(0)
+            comma_counts.append(0)
+            stack.extend((child, index) for child in reversed(node.contents))
+        elif type(node) is bs4.element.NavigableString:
+            text_lengths[parent_index] += len(node.strip())
+            comma_counts[parent_index] += node.count(',')
+    main_index = _choose_main_content(parent_indexes, tags, hints, text_lengths, comma_counts)
+    if main_index is None or main_index == 0:
+        return root
+    body.contents = [nodes[main_index]]
+    _relink_tree(root)
+    return root
+
+
+def _choose_main_content(parent_indexes, tags, hints, text_lengths, comma_counts):
+    """
+    Scores the elements of a document listed in document order by their
+    tags, the index of their parents, their class and id names and the
+    length of and commas in their own text. Paragraphs with enough text
+    score points for their parent and half as many for their grandparent,
+    and each element's score is then cut by the share of its text inside
+    links. Linear in the number of elements.
+
+    Returns:
+        int: The index of the main content element, or None if there isn't
+            enough text to tell.
+    """
+    count = len(tags)
+    link_text_lengths = [0] * count
+    in_link = [False] * count
+    for index in range(count):
+        parent_index = parent_indexes[index]
+        in_link[index] = tags[index] == 'a' or (parent_index >= 0 and in_link[parent_index])
+        if in_link[index]:
+            link_text_lengths[index] = text_lengths[index]
+    # Children come after their parents, so totals add up in reverse order
+    text_lengths = list(text_lengths)
+    comma_counts = list(comma_counts)
+    for index in reversed(range(1, count)):
+        parent_index = parent_indexes[index]
+        text_lengths[parent_index] += text_lengths[index]
+        comma_counts[parent_index] += comma_counts[index]
+        link_text_lengths[parent_index] += link_text_lengths[index]
+    scores = {}
+    for index in range(count):
+        if tags[index] not in _PARAGRAPH_TAGS or text_lengths[index] < _MIN_PARAGRAPH_LENGTH:
+            continue
+        score = 1 + comma_counts[index] + min(text_lengths[index] // 100, 3)
+        parent_index = parent_indexes[index]
+        if parent_index >= 0:
+            scores[parent_index] = scores.get(parent_index, 0) + score
+            grandparent_index = parent_indexes[parent_index]
+            if grandparent_index >= 0:
+                scores[grandparent_index] = scores.get(grandparent_index, 0) + score / 2.0
+    best_index = None
+    best_score = 0
+    for index, score in scores.items():
+        if _positive_hint_regex.search(hints[index]):
+            score += 25
+        if _negative_hint_regex.search(hints[index]):
+            score -= 25
+        score *= 1 - float(link_text_lengths[index]) / max(text_lengths[index], 1)
+        if score > best_score:
+            best_index = index
+            best_score = score
+    if best_index is None or text_lengths[best_index] - link_text_lengths[best_index] < _MIN_CONTENT_LENGTH:
+        return None
+    return best_index
 
 
 def condense(input_string):
@@ -118,12 +384,14 @@ def condense(input_string):
     return removed_trailing_whitespace
 
 
-def html_to_xhtml(html_unicode_string):
+def html_to_xhtml(html_unicode_string, engine=None):
     """
     Converts html to xhtml
 
     Args:
         html_unicode_string: A (possible unicode) string representing HTML.
+        engine (Option[str]): The name of the sanitizer engine to use. See
+            clean.
 
     Returns:
         A (possibly unicode) string representing XHTML.
@@ -135,7 +403,25 @@ def html_to_xhtml(html_unicode_string):
         assert isinstance(html_unicode_string, basestring)
     except AssertionError:
         raise TypeError
-    root = BeautifulSoup(html_unicode_string, 'html.parser')
+    engine = get_engine(engine)
+    root = engine.parse(html_unicode_string)
+    return engine.xhtml_tree_to_string(engine.html_tree_to_xhtml(root))
+
+
+def html_tree_to_xhtml(root):
+    """
+    Converts a parsed html tree to xhtml in place.
+
+    Args:
+        root (bs4.BeautifulSoup): A parsed html document.
+
+    Returns:
+        bs4.BeautifulSoup: root, ready to be serialized with
+            xhtml_tree_to_string.
+
+    Raises:
+        ValueError: Raised if root is only a fragment of an html document.
+    """
     # Confirm root node is html
     try:
         assert root.html is not None
@@ -144,10 +430,430 @@ def html_to_xhtml(html_unicode_string):
                          'string is the following: %s', unicode(root)]))
     # Add xmlns attribute to html node
     root.html['xmlns'] = 'http://www.w3.org/1999/xhtml'
-    unicode_string = unicode(root.prettify(encoding='utf-8', formatter='html'), encoding='utf-8')
-    # Close singleton tag_dictionary
-    for tag in constants.SINGLETON_TAG_LIST:
-        unicode_string = unicode_string.replace(
-                '<' + tag + '/>',
-                '<' + tag + ' />')
-    return unicode_string
+    _unnest_singleton_children(root)
+    return root
+
+
+def _unnest_singleton_children(root):
+    # Singleton tags can't have children, so move any the parser nested in them after the tag
+    for singleton_node in root.find_all(constants.SINGLETON_TAG_LIST):
+        for child_node in reversed(singleton_node.contents):
+            singleton_node.insert_after(child_node)
+
+
+def xhtml_tree_to_string(root):
+    """
+    Serializes a tree produced by html_tree_to_xhtml, in a single pass over
+    the tree. Nothing is indented and characters are left as they are, so
+    only &, <, > and, in attributes, " are escaped. Singleton tags are
+    closed as <br />, with anything a parser nested in them written after
+    them, and every other tag has a closing tag. Attributes are sorted, and
+    runs of whitespace between tags are cut to one newline or space, as the
+    bs4 parser does, so the output doesn't change when it is parsed and
+    serialized again.
+
+    Args:
+        root (bs4.BeautifulSoup): A parsed xhtml document.
+
+    Returns:
+        unicode: A unicode string representing XHTML.
+    """
+    pieces = []
+    text_pieces = []
+    preserve_depth = 0
+    # Closing tags are pushed as tuples, to tell them from nodes
+    stack = list(reversed(root.contents)) if isinstance(root, bs4.BeautifulSoup) else [root]
+    while stack:
+        node = stack.pop()
+        node_type = type(node)
+        if node_type is bs4.element.NavigableString:
+            text_pieces.append(node)
+            continue
+        if text_pieces:
+            pieces.append(_join_text(text_pieces, preserve_depth))
+            text_pieces = []
+        if node_type is tuple:
+            end_tag, preserve = node
+            pieces.append(end_tag)
+            preserve_depth -= preserve
+        elif isinstance(node, bs4.element.Tag):
+            pieces.append(u'<' + node.name)
+            for attribute, value in sorted(node.attrs.items()):
+                if isinstance(value, list):
+                    value = u' '.join(value)
+                pieces.append(u' %s="%s"' % (attribute, _escape_attribute(value)))
+            if node.name in _SINGLETON_TAGS:
+                pieces.append(u' />')
+                # Singleton tags can't have children, so any a parser nested in one follow it
+                stack.extend(reversed(node.contents))
+            else:
+                pieces.append(u'>')
+                preserve = node.name in _PRESERVE_WHITESPACE_TAGS
+                preserve_depth += preserve
+                stack.append((u'</%s>' % node.name, preserve))
+                stack.extend(reversed(node.contents))
+        else:
+            # Comments, doctypes and the like know their own delimiters
+            pieces.append(node.PREFIX + node + node.SUFFIX)
+    if text_pieces:
+        pieces.append(_join_text(text_pieces, preserve_depth))
+    return u''.join(pieces)
+
+
+def html_tree_to_string(root):
+    """
+    Serializes a tree produced by clean_tree. The html is written the same
+    way as by xhtml_tree_to_string, which html parsers read just as well.
+
+    Args:
+        root (bs4.BeautifulSoup): A parsed html document.
+
+    Returns:
+        unicode: A unicode string representing HTML.
+    """
+    return xhtml_tree_to_string(root)
+
+
+def get_image_sources(xhtml_string):
+    """
+    Returns the src of every img in a string written by xhtml_tree_to_string
+    or LxmlEngine.xhtml_tree_to_string, without parsing it. Their output
+    quotes and escapes every attribute, so img tags can be found as text.
+
+    Args:
+        xhtml_string (unicode): A serialized xhtml tree.
+
+    Returns:
+        list: The unescaped src of each img, in document order.
+    """
+    sources = []
+    for match in _image_tag_or_comment_regex.finditer(xhtml_string):
+        source_match = _source_attribute_regex.search(match.group(0))
+        if match.group(0).startswith(u'<img') and source_match is not None:
+            sources.append(_html_parser.unescape(source_match.group(1)))
+    return sources
+
+
+def replace_image_sources(xhtml_string, get_source):
+    """
+    Replaces the src of every img in a string written by xhtml_tree_to_string
+    or LxmlEngine.xhtml_tree_to_string, without parsing it.
+
+    Args:
+        xhtml_string (unicode): A serialized xhtml tree.
+        get_source (function): Called with the unescaped src of each img, and
+            returns its new src, or None to remove the img.
+
+    Returns:
+        unicode: xhtml_string with the new sources.
+    """
+    def replace_source(match):
+        image_tag = match.group(0)
+        source_match = _source_attribute_regex.search(image_tag)
+        if not image_tag.startswith(u'<img') or source_match is None:
+            return image_tag
+        source = get_source(_html_parser.unescape(source_match.group(1)))
+        if source is None:
+            return u''
+        return image_tag[:source_match.start(1)] + _escape_attribute(source) + image_tag[source_match.end(1):]
+    return _image_tag_or_comment_regex.sub(replace_source, xhtml_string)
+
+
+def _join_text(text_pieces, preserve_depth):
+    text = u''.join(text_pieces)
+    if text and not preserve_depth and not text.strip():
+        return u'\n' if u'\n' in text else u' '
+    return _escape_text(text)
+
+
+def _escape_text(text):
+    return text.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;')
+
+
+def _escape_attribute(value):
+    return _escape_text(value).replace(u'"', u'&quot;')
+
+
+class Bs4Engine(object):
+    """
+    Sanitizer engine built on bs4 and its pure python html.parser. Always
+    available. Trees are bs4.BeautifulSoup documents.
+    """
+
+    name = 'bs4'
+
+    def parse(self, html_string):
+        root = BeautifulSoup(html_string, 'html.parser')
+        # html.parser nests what follows an unclosed <link> or <meta> in it, where lxml doesn't
+        _unnest_singleton_children(root)
+        return root
+
+    def get_title(self, root):
+        title_node = root.title
+        if title_node is None:
+            raise ValueError
+        return unicode(title_node.string)
+
+    def clean_tree(self, root, tag_dictionary=constants.SUPPORTED_TAGS):
+        return clean_tree(root, tag_dictionary)
+
+    def extract_content(self, root):
+        return extract_content(root)
+
+    def html_tree_to_xhtml(self, root):
+        return html_tree_to_xhtml(root)
+
+    def html_tree_to_string(self, root):
+        return html_tree_to_string(root)
+
+    def xhtml_tree_to_string(self, root):
+        return xhtml_tree_to_string(root)
+
+    def count_nodes(self, root):
+        return len(root.find_all(True))
+
+
+class LxmlEngine(object):
+    """
+    Sanitizer engine built on lxml.html. Parsing and serialization are done
+    by libxml2, which makes it several times faster than Bs4Engine. Trees
+    are lxml.html.HtmlElement html nodes.
+
+    Enforces the same tag and attribute whitelist with the same rules as
+    clean_tree, so both engines keep the same elements, attributes and text.
+    Markup can still differ where the parsers repair broken html differently
+    (e.g. a p nested in a p is split into two siblings by libxml2), and
+    non-ascii characters are left as is rather than replaced by entities.
+
+    Raises:
+        NotImplementedError: Raised if lxml isn't installed.
+    """
+
+    name = 'lxml'
+
+    def __init__(self):
+        if not lxml_module_exists:
+            raise NotImplementedError()
+        # lxml parsers must not be shared between threads
+        self._local = threading.local()
+
+    def _get_parser(self, encoding):
+        parsers = self._local.__dict__.setdefault('parsers', {})
+        if encoding not in parsers:
+            parsers[encoding] = lxml.html.HTMLParser(default_doctype=False, encoding=encoding, huge_tree=True)
+        return parsers[encoding]
+
+    def parse(self, html_string):
+        if isinstance(html_string, unicode):
+            html_string = html_string.encode('utf-8')
+            parser = self._get_parser('utf-8')
+        else:
+            parser = self._get_parser(None)
+        try:
+            return lxml.html.document_fromstring(html_string, parser=parser)
+        except lxml.etree.ParserError:
+            # Raised for empty documents, which bs4 treats as an empty fragment
+            return self._create_document()
+
+    def _create_document(self):
+        return lxml.html.document_fromstring('<html><head></head><body></body></html>',
+                                             parser=self._get_parser(None))
+
+    def get_title(self, root):
+        title_node = root.find('.//title')
+        if title_node is None or title_node.text is None:
+            raise ValueError
+        return unicode(title_node.text)
+
+    def clean_tree(self, root, tag_dictionary=constants.SUPPORTED_TAGS):
+        policy = get_policy(tag_dictionary)
+        article_node = next(root.iter('article'), None)
+        if article_node is not None:
+            source = article_node
+            document = self._create_document()
+            root = lxml.etree.SubElement(document.find('body'), 'article',
+                                         self._get_clean_attributes(article_node))
+        else:
+            self._clean_attributes(root, policy)
+            # Moving a node costs time proportional to its descendants, so the
+            # kept nodes are copied into a new tree in one pass instead
+            source = root.makeelement('html')
+            source.text = root.text
+            source.extend(root)
+        root.text = _clean_text(source.text)
+        # Each frame holds the node the children of a node go into, and
+        # whether the text among them is kept, which it isn't inside a
+        # removed node. The tail of a node goes after its last descendant.
+        # Holding on to the source nodes also keeps lxml from searching up
+        # the tree for a referenced ancestor whenever a node is let go.
+        stack = [(root, iter(source), True)]
+        sources = [None]
+        while stack:
+            output, children, keep_text = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                source_node = sources.pop()
+                if source_node is not None and stack and stack[-1][2]:
+                    _append_text(stack[-1][0], source_node.tail)
+                continue
+            tag = child.tag
+            if not isinstance(tag, basestring):
+                if keep_text:
+                    # Comments and processing instructions are kept where they are
+                    output.append(copy.copy(child))
+                    output[-1].tail = None
+                    _append_text(output, child.tail)
+                continue
+            if tag in policy.dropped_tags or (tag == 'img' and child.get('src') is None):
+                if keep_text:
+                    _append_text(output, child.tail)
+                continue
+            if tag in policy.tags:
+                new_node = lxml.etree.SubElement(output, tag,
+                                                 self._get_clean_attributes(child, policy.attributes[tag]))
+                new_node.text = _clean_text(child.text)
+                stack.append((new_node, iter(child), True))
+            else:
+                stack.append((output, iter(child), False))
+            sources.append(child)
+        #wrap partial tree if necessary
+        if article_node is not None:
+            root = document
+        elif root.find('head') is None:
+            root.insert(0, root.makeelement('head'))
+        return root
+
+    def extract_content(self, root):
+        body = root.find('body')
+        if body is None:
+            return root
+        nodes = []
+        parent_indexes = []
+        tags = []
+        hints = []
+        text_lengths = []
+        comma_counts = []
+        stack = [(body, -1)]
+        while stack:
+            node, parent_index = stack.pop()
+            if parent_index >= 0 and node.tail:
+                text_lengths[parent_index] += len(node.tail.strip())
+                comma_counts[parent_index] += node.tail.count(',')
+            if not isinstance(node.tag, basestring) or node.tag in constants.DROPPED_TAGS:
+                continue
+            index = len(nodes)
+            nodes.append(node)
+            parent_indexes.append(parent_index)
+            tags.append(node.tag)
+            hints.append(node.get('class', '') + ' ' + node.get('id', ''))
+            text = node.text or ''
+            text_lengths.append(len(text.strip()))
+            comma_counts.append(text.count(','))
+            stack.extend((child, index) for child in reversed(node))
+        main_index = _choose_main_content(parent_indexes, tags, hints, text_lengths, comma_counts)
+        if main_index is None or main_index == 0:
+            return root
+        main_node = nodes[main_index]
+        main_node.getparent().remove(main_node)
+        main_node.tail = None
+        body.text = None
+        del body[:]
+        body.append(main_node)
+        return root
+
+    def _get_clean_attributes(self, node, allowed_attributes=None):
+        # Only the kept attributes are cleaned and copied, since the others
+        # can hold characters lxml won't set
+        return dict((attribute, _clean_text(value)) for attribute, value in node.attrib.items()
+                    if allowed_attributes is None or attribute in allowed_attributes)
+
+    def _clean_attributes(self, node, policy):
+        allowed_attributes = policy.attributes.get(node.tag, ())
+        attribute_dict = node.attrib
+        for attribute in attribute_dict.keys():
+            if attribute not in allowed_attributes:
+                del attribute_dict[attribute]
+            else:
+                attribute_dict[attribute] = _clean_text(attribute_dict[attribute])
+
+    def html_tree_to_xhtml(self, root):
+        root.set('xmlns', 'http://www.w3.org/1999/xhtml')
+        # Give empty non singleton tags a closing tag rather than <tag/>
+        for node in root.iter():
+            if (isinstance(node.tag, basestring) and node.tag not in constants.SINGLETON_TAG_LIST and
+                    node.text is None and len(node) == 0):
+                node.text = ''
+        return root
+
+    def html_tree_to_string(self, root):
+        unicode_string = lxml.html.tostring(root.getroottree(), encoding='unicode')
+        return unicode_string.replace('<br>', '<br/>')
+
+    def xhtml_tree_to_string(self, root):
+        unicode_string = lxml.etree.tostring(root.getroottree(), method='xml', encoding='unicode')
+        # Close singleton tags, with or without attributes, as <br />, as xhtml_tree_to_string does
+        return _singleton_tag_regex.sub(r'<\1\2 />', unicode_string)
+
+    def count_nodes(self, root):
+        return sum(1 for node in root.iter() if isinstance(node.tag, basestring))
+
+
+def _clean_text(text):
+    """
+    Replaces &nbsp; with a space, since it isn't handled well by certain
+    e-readers, and removes the characters XML doesn't allow.
+    """
+    if not text:
+        return text
+    if u'\xa0' in text:
+        text = text.replace(u'\xa0', u' ')
+    return _invalid_xml_character_regex.sub(u'', text)
+
+
+def _append_text(node, text):
+    """
+    Adds text to the end of the content of an lxml node.
+    """
+    text = _clean_text(text)
+    if not text:
+        return
+    if len(node):
+        last_child = node[-1]
+        last_child.tail = (last_child.tail or '') + text
+    else:
+        node.text = (node.text or '') + text
+
+
+ENGINES = {
+    Bs4Engine.name: Bs4Engine,
+    LxmlEngine.name: LxmlEngine,
+    }
+_engine_instances = {}
+
+
+def get_engine(engine=None):
+    """
+    Gets a sanitizer engine.
+
+    Args:
+        engine (Option[str]): The name of the engine, one of the keys of
+            ENGINES. An engine instance is returned unchanged. By default,
+            this is lxml if it is installed and bs4 otherwise.
+
+    Returns:
+        An engine object with the methods of Bs4Engine.
+
+    Raises:
+        ValueError: Raised if engine isn't the name of an engine.
+        NotImplementedError: Raised if the engine requested isn't installed.
+    """
+    if engine is None:
+        engine = LxmlEngine.name if lxml_module_exists else Bs4Engine.name
+    if not isinstance(engine, basestring):
+        return engine
+    if engine not in ENGINES:
+        raise ValueError('engine must be one of %s' % ', '.join(sorted(ENGINES.keys())))
+    if engine not in _engine_instances:
+        _engine_instances[engine] = ENGINES[engine]()
+    return _engine_instances[engine]
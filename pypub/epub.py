@@ -1,10 +1,16 @@
 import collections
+import functools
 import imp
+import io
+import itertools
 import random
+import re
 import string
 import shutil
 import tempfile
+import threading
 import time
+import zipfile
 
 import jinja2
 import requests
@@ -20,17 +26,57 @@ except ImportError:
     lxml_module_exists = False
 
 from constants import *
+import archive
 import chapter
+from metrics import Metrics
+import storage
+from transport import get_default_transport, Transport
 
 requests.packages.urllib3.disable_warnings()
 
+_template_environments = {}
+_template_environments_lock = threading.Lock()
+_template_bytecode_cache = None
+_metadata_regex = re.compile(r'<dc:(\w+)[^>]*>(.*?)</dc:\1>', re.DOTALL)
+_chapter_title_regex = re.compile(r'<navLabel><text>(.*?)</text></navLabel>', re.DOTALL)
+_TOC_ARCHIVE_NAMES = ['OEBPS/toc.html', 'OEBPS/toc.ncx', 'OEBPS/content.opf']
+# Larger files are streamed rather than read whole to compress in parallel
+_MAX_PARALLEL_ENTRY_SIZE = 4 * 1024 * 1024
 
-class _Minetype(object):
 
-    def __init__(self, parent_directory):
-        minetype_template = os.path.join(EPUB_TEMPLATES_DIR, 'minetype.txt')
-        shutil.copy(minetype_template,
-                    os.path.join(parent_directory, 'minetype.txt'))
+def set_template_bytecode_cache(directory=None):
+    """
+    Saves the compiled templates of the epub files as bytecode, so later
+    processes load them instead of compiling them again.
+
+    Args:
+        directory (Option[str]): The directory to save bytecode in. By
+            default, this is the temporary directory of the system.
+    """
+    global _template_bytecode_cache
+    with _template_environments_lock:
+        _template_bytecode_cache = jinja2.FileSystemBytecodeCache(directory)
+        for environment in _template_environments.values():
+            environment.bytecode_cache = _template_bytecode_cache
+
+
+def _get_template(template_file):
+    """
+    Returns the compiled jinja2 template in template_file. Each template is
+    compiled once per process and kept by a jinja2 environment shared by all
+    templates in its directory. The templates that come with pypub are never
+    checked for changes, while others are recompiled when they change.
+    """
+    template_directory, template_name = os.path.split(os.path.abspath(template_file))
+    with _template_environments_lock:
+        environment = _template_environments.get(template_directory)
+        if environment is None:
+            environment = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(template_directory),
+                bytecode_cache=_template_bytecode_cache,
+                auto_reload=template_directory != os.path.abspath(EPUB_TEMPLATES_DIR))
+            _template_environments[template_directory] = environment
+    return environment.get_template(template_name)
 
 
 class _ContainerFile(object):
@@ -41,27 +87,96 @@ class _ContainerFile(object):
                     os.path.join(parent_directory, 'container.xml'))
 
 
+class _ChapterRecord(object):
+    """
+    What an Epub keeps of each chapter once its content is saved to the
+    store, which is all the table of contents needs.
+
+    Args:
+        title (str): The title of the chapter.
+        id (str): The id of the chapter in the epub, e.g. '0'.
+        href (str): The name of the chapter file in the epub, e.g. '0.xhtml'.
+        size (Option[int]): The size in bytes of the chapter file, or None
+            until it is saved.
+    """
+    __slots__ = ('title', 'id', 'href', 'size')
+
+    def __init__(self, title, id, href, size=None):
+        self.title = title
+        self.id = id
+        self.href = href
+        self.size = size
+
+
+class _TemplateChapters(object):
+    """
+    The chapters passed to a template, made into records one at a time as the
+    template loops over them. Can be looped over more than once.
+    """
+
+    def __init__(self, parameter_lists):
+        self._template_chapter = collections.namedtuple('template_chapter', parameter_lists.keys())
+        self._parameter_lists = parameter_lists.values()
+
+    def __iter__(self):
+        return itertools.starmap(self._template_chapter, itertools.izip(*self._parameter_lists))
+
+
+def _get_chapter_links(chapter_list):
+    """
+    Returns the ids and file names of the chapters in chapter_list. Chapter
+    records know theirs, which skip chapters that failed to be added, while
+    Chapters are numbered in order.
+    """
+    id_list = []
+    link_list = []
+    for n, c in enumerate(chapter_list):
+        if isinstance(c, _ChapterRecord):
+            id_list.append(c.id)
+            link_list.append(c.href)
+        else:
+            id_list.append(str(n))
+            link_list.append(str(n) + '.xhtml')
+    return id_list, link_list
+
+
 class _EpubFile(object):
 
     def __init__(self, template_file, **non_chapter_parameters):
-        self.content = u''
         self.file_name = ''
         self.template_file = template_file
         self.non_chapter_parameters = non_chapter_parameters
+        self._chapters = None
+
+    @property
+    def content(self):
+        return u''.join(self.generate())
 
     def write(self, file_name):
         self.file_name = file_name
         with open(file_name, 'wb') as f:
-            f.write(self.content.encode('utf-8'))
+            for chunk in self.generate():
+                f.write(chunk.encode('utf-8'))
+
+    def write_to_archive(self, epub_archive, archive_name):
+        """
+        Renders the file straight into the entry archive_name of an
+        archive.EpubArchive, without holding all of it in memory.
+        """
+        epub_archive.write_chunks(archive_name, self.generate())
+
+    def generate(self):
+        """
+        Renders the file piece by piece.
 
-    def _render_template(self, **variable_value_pairs):
-        def read_template():
-            with open(self.template_file, 'r') as f:
-                template = f.read().decode('utf-8')
-            return jinja2.Template(template)
-        template = read_template()
-        rendered_template = template.render(variable_value_pairs)
-        self.content = rendered_template
+        Returns:
+            iterator: The unicode pieces of the file, which is empty if no
+                chapters have been added.
+        """
+        if self._chapters is None:
+            return iter([])
+        template = _get_template(self.template_file)
+        return template.generate(chapters=self._chapters, **self.non_chapter_parameters)
 
     def add_chapters(self, **parameter_lists):
         def check_list_lengths(lists):
@@ -73,10 +188,7 @@ class _EpubFile(object):
                 else:
                     assert len(value) == list_length
         check_list_lengths(parameter_lists)
-        template_chapter = collections.namedtuple('template_chapter',
-                                                  parameter_lists.keys())
-        chapters = [template_chapter(*items) for items in zip(*parameter_lists.values())]
-        self._render_template(chapters=chapters, **self.non_chapter_parameters)
+        self._chapters = _TemplateChapters(parameter_lists)
 
     def get_content(self):
         return self.content
@@ -88,16 +200,15 @@ class TocHtml(_EpubFile):
         super(TocHtml, self).__init__(template_file, **non_chapter_parameters)
 
     def add_chapters(self, chapter_list):
-        chapter_numbers = range(len(chapter_list))
-        link_list = [str(n) + '.xhtml' for n in chapter_numbers]
         try:
             for c in chapter_list:
                 t = type(c)
-                assert type(c) == chapter.Chapter
+                assert type(c) in (chapter.Chapter, _ChapterRecord)
         except AssertionError:
             raise TypeError('chapter_list items must be Chapter not %s',
                             str(t))
         chapter_titles = [c.title for c in chapter_list]
+        link_list = _get_chapter_links(chapter_list)[1]
         super(TocHtml, self).add_chapters(title=chapter_titles,
                                           link=link_list)
 
@@ -117,10 +228,9 @@ class TocNcx(_EpubFile):
         super(TocNcx, self).__init__(template_file, **non_chapter_parameters)
 
     def add_chapters(self, chapter_list):
-        id_list = range(len(chapter_list))
-        play_order_list = [n + 1 for n in id_list]
+        id_list, link_list = _get_chapter_links(chapter_list)
+        play_order_list = range(1, len(chapter_list) + 1)
         title_list = [c.title for c in chapter_list]
-        link_list = [str(n) + '.xhtml' for n in id_list]
         super(TocNcx, self).add_chapters(**{'id': id_list,
                                             'play_order': play_order_list,
                                             'title': title_list,
@@ -147,8 +257,7 @@ class ContentOpf(_EpubFile):
                                          date=date)
 
     def add_chapters(self, chapter_list):
-        id_list = range(len(chapter_list))
-        link_list = [str(n) + '.xhtml' for n in id_list]
+        id_list, link_list = _get_chapter_links(chapter_list)
         super(ContentOpf, self).add_chapters(**{'id': id_list, 'link': link_list})
 
     def get_content_as_element(self):
@@ -162,7 +271,8 @@ class ContentOpf(_EpubFile):
 class Epub(object):
     """
     Class representing an epub. Add chapters to this and then output your ebook
-    as an epub file.
+    as an epub file. The content of each chapter is saved to the store as soon
+    as it is added, and chapters only keeps a small record of each chapter.
 
     Args:
         title (str): The title of the epub.
@@ -172,11 +282,80 @@ class Epub(object):
         rights (Option[str]): The rights of your epub.
         publisher (Option[str]): The publisher of your epub. By default this
             is pypub.
+        epub_dir (Option[str]): The directory to save the files of the epub in
+            until it is packaged. By default, this is a new temporary
+            directory. Ignored if store is given.
+        store (Option[object]): Where to keep the files of the epub until it
+            is packaged. One of the stores in pypub.storage, e.g.
+            storage.MemoryStore() to build the epub without touching the
+            disk, or storage.SpillingStore(compress=True) to keep chapters
+            compressed in memory up to a limit. By default, files are saved
+            in epub_dir.
+        image_workers (Option[int]): The number of images of a chapter to
+            download at once. By default, this is 8.
+        cache (Option[cache.ResponseCache]): A cache to download images
+            through. By default, this is None. Ignored if transport is given.
+        transport (Option[transport.Transport]): The transport to download
+            images with, which keeps connections to their hosts open. Its
+            pool_maxsize should be at least image_workers. By default, the
+            shared default transport is used, or a new one fetching through
+            cache if cache is given.
+        max_image_bytes (Option[int]): The largest image to include. Larger
+            images are dropped from their chapters, as are images that fail
+            to download. By default, this is None, which means any size.
+        max_book_image_bytes (Option[int]): The most bytes of images to
+            include in all. Images past the limit are dropped from their
+            chapters. By default, this is None, which means no limit.
+        image_optimizer (Option[image_optimizer.ImageOptimizer]): Used to
+            scale down and recompress images before they are saved. Its
+            process pool is started now and closed once the epub is written.
+            By default, this is None, and images are included as downloaded.
+        metrics (Option[metrics.Metrics]): Records the time spent downloading
+            images, writing chapters and packaging the epub. Pass the metrics
+            of a ChapterFactory to follow a whole build. By default, this is
+            a new Metrics.
+        compression_policy (Option[archive.CompressionPolicy]): How much to
+            compress each file of the epub by media type. By default, images
+            are stored uncompressed and everything else is compressed at
+            level 6.
+        compress_workers (Option[int]): The number of files to compress at
+            once when the epub is packaged. By default, this is the number of
+            CPUs.
+
+    Attributes:
+        metrics (metrics.Metrics): What this epub has recorded. Subscribe to
+            it, or read its summary or report after create_epub.
     """
 
-    def __init__(self, title, creator='pypub', language='en', rights='', publisher='pypub', epub_dir=None):
-        self._create_directories(epub_dir)
+    def __init__(self, title, creator='pypub', language='en', rights='', publisher='pypub', epub_dir=None,
+                 store=None, image_workers=8, cache=None, transport=None, max_image_bytes=None,
+                 max_book_image_bytes=None, image_optimizer=None, metrics=None, compression_policy=None,
+                 compress_workers=None):
+        if store is None:
+            self._create_directories(epub_dir)
+            self.container = _ContainerFile(self.META_INF_DIR)
+            store = storage.DiskStore(self.OEBPS_DIR)
+        self.store = store
+        self.image_workers = image_workers
+        if transport is None:
+            transport = get_default_transport() if cache is None else Transport(cache=cache)
+        self.transport = transport
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.compression_policy = compression_policy
+        self.compress_workers = compress_workers
+        # Forking the pool from here rather than from the worker thread of
+        # the first chapter with images keeps other threads out of the fork
+        self.image_optimizer = image_optimizer
+        if image_optimizer is not None:
+            image_optimizer.start()
+        self.image_registry = chapter.ImageRegistry(self.store, self.transport, max_image_bytes,
+                                                    max_book_image_bytes, image_optimizer, self.metrics)
         self.chapters = []
+        # Guards chapters, which add_chapter_async workers remove failed
+        # chapters from
+        self._chapters_lock = threading.Lock()
         self.title = title
         try:
             assert title
@@ -192,8 +371,56 @@ class Epub(object):
         self.toc_html = TocHtml()
         self.toc_ncx = TocNcx()
         self.opf = ContentOpf(self.title, self.creator, self.language, self.rights, self.publisher, self.uid)
-        self.minetype = _Minetype(self.EPUB_DIR)
-        self.container = _ContainerFile(self.META_INF_DIR)
+        self._source_file_name = None
+        self._source_names = []
+
+    @classmethod
+    def open(cls, epub_file_name, epub_dir=None, store=None, image_workers=8, cache=None, transport=None,
+             metrics=None):
+        """
+        Opens an epub made by pypub to add more chapters to it. The chapters
+        and images already in the epub are never read or reprocessed. Save the
+        new chapters with update_epub, or with create_epub to write a new epub
+        file.
+
+        Args:
+            epub_file_name (str): The full name of the epub file to open.
+            The other arguments are the same as those of Epub.
+
+        Returns:
+            Epub: The opened epub.
+
+        Raises:
+            ValueError: Raised if epub_file_name isn't an epub made by pypub.
+        """
+        try:
+            with zipfile.ZipFile(epub_file_name) as source_zip_file:
+                opf = source_zip_file.read('OEBPS/content.opf').decode('utf-8')
+                ncx = source_zip_file.read('OEBPS/toc.ncx').decode('utf-8')
+                source_names = source_zip_file.namelist()
+                source_sizes = dict((zip_info.filename, zip_info.file_size)
+                                    for zip_info in source_zip_file.infolist())
+        except (KeyError, zipfile.BadZipfile):
+            raise ValueError('%s is not an epub made by pypub' % epub_file_name)
+        metadata = dict(_metadata_regex.findall(opf))
+        e = cls(metadata.get('title', ''), metadata.get('creator', ''), metadata.get('language', ''),
+                metadata.get('rights', ''), metadata.get('publisher', ''), epub_dir, store, image_workers, cache,
+                transport, metrics=metrics)
+        e.uid = metadata.get('identifier', '')
+        e.opf = ContentOpf(e.title, e.creator, e.language, e.rights, e.publisher, e.uid, metadata.get('date', ''))
+        for title in _chapter_title_regex.findall(ncx):
+            e.chapters.append(_ChapterRecord(title, e.current_chapter_id, e.current_chapter_path,
+                                             source_sizes.get('OEBPS/' + e.current_chapter_path)))
+            e._increase_current_chapter_number()
+        e._source_file_name = epub_file_name
+        e._set_source_names(source_names)
+        return e
+
+    def _set_source_names(self, names):
+        self._source_names = [name for name in names
+                              if name.startswith('OEBPS/') and name not in _TOC_ARCHIVE_NAMES]
+        for name in self._source_names:
+            self.image_registry._add_saved_file_name(name[len('OEBPS/'):])
 
     def _create_directories(self, epub_dir=None):
         if epub_dir is None:
@@ -231,11 +458,61 @@ class Epub(object):
             assert type(c) == chapter.Chapter
         except AssertionError:
             raise TypeError('chapter must be of type Chapter')
-        chapter_file_output = os.path.join(self.OEBPS_DIR, self.current_chapter_path)
-        c._replace_images_in_chapter(self.OEBPS_DIR)
-        c.write(chapter_file_output)
+        record = _ChapterRecord(c.title, self.current_chapter_id, self.current_chapter_path)
+        self._save_chapter(c, record)
         self._increase_current_chapter_number()
-        self.chapters.append(c)
+        with self._chapters_lock:
+            self.chapters.append(record)
+
+    def _save_chapter(self, c, record):
+        c._replace_images_in_chapter(self.store, self.image_workers, self.image_registry)
+        with self.metrics.time('write', record.href) as timer:
+            content = c.content
+            if isinstance(content, unicode):
+                content = content.encode('utf-8')
+            self.store.write(record.href, content)
+            timer.bytes_out = record.size = len(content)
+        c._release_content_tree()
+
+    def add_chapter_async(self, c, callback=None):
+        """
+        Starts adding a Chapter to your epub in the background and returns at
+        once. The images of the chapter are downloaded on a shared pool of
+        worker threads. Chapters keep the order this method is called in,
+        whichever finishes first. A chapter that fails to be added is left
+        out of the epub. Wait for every result before calling create_epub.
+
+        Args:
+            c (Chapter): A Chapter object representing your chapter.
+            callback (Option[function]): Called with the Chapter once it is
+                added, from a worker thread.
+
+        Returns:
+            multiprocessing.pool.AsyncResult: The pending result. Its get
+                method returns the Chapter once it is added.
+
+        Raises:
+            TypeError: Raised if a Chapter object isn't supplied to this
+                method.
+        """
+        try:
+            assert type(c) == chapter.Chapter
+        except AssertionError:
+            raise TypeError('chapter must be of type Chapter')
+        record = _ChapterRecord(c.title, self.current_chapter_id, self.current_chapter_path)
+        self._increase_current_chapter_number()
+        with self._chapters_lock:
+            self.chapters.append(record)
+
+        def add_chapter():
+            try:
+                self._save_chapter(c, record)
+            except Exception:
+                with self._chapters_lock:
+                    self.chapters.remove(record)
+                raise
+            return c
+        return chapter._get_async_pool().apply_async(add_chapter, callback=callback)
 
     def create_epub(self, output_directory, epub_name=None):
         """
@@ -245,13 +522,15 @@ class Epub(object):
             output_directory (str): Directory to output the epub file to
             epub_name (Option[str]): The file name of your epub. This should not contain
                 .epub at the end. If this argument is not provided, defaults to the title of the epub.
-        """
-        def createTOCs_and_ContentOPF():
-            for epub_file, name in ((self.toc_html, 'toc.html'), (self.toc_ncx, 'toc.ncx'), (self.opf, 'content.opf'),):
-                epub_file.add_chapters(self.chapters)
-                epub_file.write(os.path.join(self.OEBPS_DIR, name))
 
-        def create_zip_archive(epub_name):
+        Returns:
+            str: The full name of the epub file created.
+
+        Raises:
+            ValueError: Raised if a chapter added with add_chapter_async
+                isn't saved yet.
+        """
+        def get_epub_file_name(epub_name):
             try:
                 assert isinstance(epub_name, basestring) or epub_name is None
             except AssertionError:
@@ -259,22 +538,267 @@ class Epub(object):
             if epub_name is None:
                 epub_name = self.title
             epub_name = ''.join([c for c in epub_name if c.isalpha() or c.isdigit() or c == ' ']).rstrip()
-            epub_name_with_path = os.path.join(output_directory, epub_name)
-            try:
-                os.remove(os.path.join(epub_name_with_path, '.zip'))
-            except OSError:
-                pass
-            shutil.make_archive(epub_name_with_path, 'zip', self.EPUB_DIR)
-            return epub_name_with_path + '.zip'
-
-        def turn_zip_into_epub(zip_archive):
-            epub_full_name = zip_archive.strip('.zip') + '.epub'
-            try:
-                os.remove(epub_full_name)
-            except OSError:
-                pass
-            os.rename(zip_archive, epub_full_name)
-            return epub_full_name
-        createTOCs_and_ContentOPF()
-        epub_path = turn_zip_into_epub(create_zip_archive(epub_name))
+            if not os.path.isdir(output_directory):
+                os.makedirs(output_directory)
+            return os.path.join(output_directory, epub_name + '.epub')
+        epub_path = get_epub_file_name(epub_name)
+        if self._source_file_name is not None and os.path.abspath(epub_path) == os.path.abspath(self._source_file_name):
+            raise ValueError('use update_epub to save chapters into the epub they were added to')
+        self._write_epub(epub_path)
         return epub_path
+
+    def create_epub_bytes(self):
+        """
+        Create an epub from this object in memory, without writing a file.
+
+        Returns:
+            str: The content of the epub file.
+
+        Raises:
+            ValueError: Raised if a chapter added with add_chapter_async
+                isn't saved yet.
+        """
+        output = io.BytesIO()
+        self._write_epub(output)
+        return output.getvalue()
+
+    def update_epub(self):
+        """
+        Saves the chapters added to an epub opened with Epub.open into the
+        epub file it was opened from. The chapters and images already in the
+        file are kept byte for byte, and only toc.html, toc.ncx and
+        content.opf are rewritten, so an update costs about as much as the
+        new chapters. If saving fails, the epub file is left as it was.
+
+        Raises:
+            ValueError: Raised if this epub wasn't opened with Epub.open, or
+                if a chapter added with add_chapter_async isn't saved yet.
+        """
+        if self._source_file_name is None:
+            raise ValueError('only epubs opened with Epub.open can be updated')
+        self._check_chapters_saved()
+        self._close_image_optimizer()
+        with self.metrics.time('zip', self._source_file_name) as timer:
+            with archive.EpubArchive(self._source_file_name, 'a', self.compression_policy,
+                                     self.compress_workers) as epub_archive:
+                epub_archive.remove(_TOC_ARCHIVE_NAMES)
+                timer.bytes_in = self._write_entries(epub_archive)
+                source_names = epub_archive.names()
+            timer.bytes_out = os.path.getsize(self._source_file_name)
+        self.store.close()
+        self._set_source_names(source_names)
+
+    def _get_chapters(self):
+        """
+        Returns a copy of chapters, taken while no worker thread changes it.
+        """
+        with self._chapters_lock:
+            return list(self.chapters)
+
+    def _check_chapters_saved(self):
+        saved_names = set(self.store.names()).union(name[len('OEBPS/'):] for name in self._source_names)
+        unsaved_names = [record.href for record in self._get_chapters() if record.href not in saved_names]
+        if unsaved_names:
+            raise ValueError('chapters %s are not saved yet, wait for add_chapter_async to finish'
+                             % ', '.join(unsaved_names))
+
+    def _write_epub(self, output):
+        self._check_chapters_saved()
+        self._close_image_optimizer()
+        name = output if isinstance(output, basestring) else None
+        with self.metrics.time('zip', name) as timer:
+            with archive.EpubArchive(output, 'w', self.compression_policy, self.compress_workers) as epub_archive:
+                if self._source_file_name is not None:
+                    with zipfile.ZipFile(self._source_file_name) as source_zip_file:
+                        epub_archive.copy_entries(source_zip_file, self._source_names)
+                timer.bytes_in = self._write_entries(epub_archive)
+            timer.bytes_out = os.path.getsize(output) if name is not None else output.tell()
+
+    def _close_image_optimizer(self):
+        """
+        Stops the process pool of the image optimizer once every chapter is
+        saved. Images of chapters added later are optimized in this process.
+        """
+        if self.image_optimizer is not None:
+            self.image_optimizer.close()
+
+    def _write_entries(self, epub_archive):
+        """
+        Writes the files in the store and the table of contents, and returns
+        the size of the files in the store. Chapters are written in order,
+        followed by the other files by name, so the epub doesn't depend on
+        which chapter was saved first. Files to deflate are compressed in
+        parallel, while stored and large files are streamed from the store.
+        """
+        store_names = set(self.store.names())
+        chapter_names = [record.href for record in self._get_chapters() if record.href in store_names]
+        names = chapter_names + sorted(store_names.difference(chapter_names))
+        parallel_entries = []
+        for name in names:
+            archive_name = 'OEBPS/' + name
+            if (epub_archive.compression_policy.get_level(archive_name) and
+                    self.store.size(name) <= _MAX_PARALLEL_ENTRY_SIZE):
+                parallel_entries.append((archive_name, functools.partial(self.store.read, name)))
+                continue
+            epub_archive.write_entries(parallel_entries)
+            parallel_entries = []
+            self.store.write_to_archive(name, epub_archive, archive_name)
+        epub_archive.write_entries(parallel_entries)
+        size = sum(self.store.size(name) for name in names)
+        # The table of contents goes last, where update_epub can cut it off
+        self._write_toc(epub_archive)
+        return size
+
+    def _write_toc(self, epub_archive):
+        """
+        Writes toc.html, toc.ncx and content.opf, listing every chapter added.
+        """
+        chapter_list = self._get_chapters()
+        for epub_file, name in ((self.toc_html, 'toc.html'), (self.toc_ncx, 'toc.ncx'), (self.opf, 'content.opf'),):
+            epub_file.add_chapters(chapter_list)
+            epub_file.write_to_archive(epub_archive, 'OEBPS/' + name)
+
+
+class EpubWriter(object):
+    """
+    Writes an epub file while chapters are added to it. The content and
+    images of each chapter go straight into the epub file, and only the
+    title and file name of each chapter are kept for the table of contents,
+    which is written when the writer is closed. However long the book, no
+    more than one chapter at a time is held in memory.
+
+        with EpubWriter('book.epub', 'My Book') as writer:
+            for url in urls:
+                writer.add_chapter(factory.create_chapter_from_url(url))
+
+    If the with block raises an exception, the unfinished epub file is
+    deleted.
+
+    Args:
+        file_name (str): The full name of the epub file to create. Any
+            existing file with this name is overwritten. A writable, seekable
+            file object can be given instead.
+        title (str): The title of the epub.
+        The other arguments are the same as those of Epub.
+
+    Attributes:
+        metrics (metrics.Metrics): What this writer has recorded.
+        closed (bool): Whether the epub has been closed.
+
+    Raises:
+        ValueError: Raised if title is empty.
+    """
+
+    def __init__(self, file_name, title, creator='pypub', language='en', rights='', publisher='pypub',
+                 image_workers=8, cache=None, transport=None, max_image_bytes=None, max_book_image_bytes=None,
+                 image_optimizer=None, metrics=None, compression_policy=None):
+        try:
+            assert title
+        except AssertionError:
+            raise ValueError('title cannot be empty string')
+        self.file_name = file_name
+        self._archive = archive.EpubArchive(file_name, compression_policy=compression_policy)
+        self._epub = Epub(title, creator, language, rights, publisher, store=storage.ArchiveStore(self._archive),
+                          image_workers=image_workers, cache=cache, transport=transport,
+                          max_image_bytes=max_image_bytes, max_book_image_bytes=max_book_image_bytes,
+                          image_optimizer=image_optimizer, metrics=metrics)
+        self.metrics = self._epub.metrics
+        self.closed = False
+        self._pending_results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+    @property
+    def chapters(self):
+        return self._epub._get_chapters()
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError('the epub is closed')
+
+    def add_chapter(self, c):
+        """
+        Writes a Chapter and its images to the epub file.
+
+        Args:
+            c (Chapter): A Chapter object representing your chapter.
+
+        Raises:
+            TypeError: Raised if a Chapter object isn't supplied to this
+                method.
+            ValueError: Raised if the epub is closed.
+        """
+        self._check_open()
+        self._epub.add_chapter(c)
+
+    def add_chapter_async(self, c, callback=None):
+        """
+        Starts writing a Chapter and its images to the epub file in the
+        background, like Epub.add_chapter_async. close waits for every
+        chapter to be written.
+
+        Returns:
+            multiprocessing.pool.AsyncResult: The pending result.
+
+        Raises:
+            TypeError: Raised if a Chapter object isn't supplied to this
+                method.
+            ValueError: Raised if the epub is closed.
+        """
+        self._check_open()
+        result = self._epub.add_chapter_async(c, callback)
+        # Only results still to be checked are kept, as each holds its chapter
+        self._pending_results = [pending_result for pending_result in self._pending_results
+                                 if not pending_result.ready() or not pending_result.successful()]
+        self._pending_results.append(result)
+        return result
+
+    def close(self):
+        """
+        Waits for chapters being added in the background, writes the table of
+        contents and closes the epub file. Does nothing if the epub is
+        already closed.
+
+        Raises:
+            Exception: Any error raised adding a chapter in the background,
+                in which case the unfinished epub file is deleted.
+        """
+        if self.closed:
+            return
+        try:
+            for result in self._pending_results:
+                result.get()
+        except Exception:
+            self._abort()
+            raise
+        self._pending_results = []
+        self._epub._close_image_optimizer()
+        name = self.file_name if isinstance(self.file_name, basestring) else None
+        with self.metrics.time('zip', name) as timer:
+            self._epub._write_toc(self._archive)
+            self._archive.close()
+            self.closed = True
+            store = self._epub.store
+            timer.bytes_in = sum(store.size(file_name) for file_name in store.names())
+            timer.bytes_out = os.path.getsize(self.file_name) if name is not None else self.file_name.tell()
+        store.close()
+
+    def _abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        for result in self._pending_results:
+            result.wait()
+        self._pending_results = []
+        self._epub._close_image_optimizer()
+        self._archive.close()
+        self._epub.store.close()
+        if isinstance(self.file_name, basestring) and os.path.exists(self.file_name):
+            os.remove(self.file_name)
@@ -0,0 +1,219 @@
+import imp
+import io
+import multiprocessing
+import threading
+
+try:
+    imp.find_module('PIL')
+    pillow_module_exists = True
+    from PIL import Image
+except ImportError:
+    pillow_module_exists = False
+
+
+_PHOTO_MIN_COLORS = 256
+_PILLOW_FORMATS = {
+    'bmp': 'BMP',
+    'gif': 'GIF',
+    'jpeg': 'JPEG',
+    'jpg': 'JPEG',
+    'png': 'PNG',
+    'tif': 'TIFF',
+    'tiff': 'TIFF',
+    'webp': 'WEBP',
+    }
+
+
+class ImageOptimizer(object):
+    """
+    Makes the images of an epub smaller before they are packaged, so books
+    take less space and turn pages faster on e-ink readers. Images larger than
+    max_width by max_height are scaled down to fit, photos saved as PNG are
+    converted to JPEG and animated GIFs are reduced to their first frame.
+    Images other than JPEG, PNG and GIF, except SVG, are converted to PNG or
+    JPEG, which every epub reader supports. Every image changed is saved
+    without its metadata. An image that needs none of these changes is only
+    saved again if that makes it smaller, and is otherwise kept as it is,
+    metadata included. Requires Pillow.
+
+    Many images are optimized at once on a pool of processes, one per CPU
+    core by default, once start is called. Epub and EpubWriter start the
+    pool when they are created and close it once their epub is written.
+    Until then, images are optimized in the calling process.
+
+    Args:
+        max_width (Option[int]): The largest width of an image in pixels. By
+            default, this is 758, the width of many e-ink screens.
+        max_height (Option[int]): The largest height of an image in pixels.
+            By default, this is 1024.
+        jpeg_quality (Option[int]): The quality JPEGs are saved with, from 1
+            to 95. By default, this is 80.
+        convert_photos (Option[bool]): If True, PNGs without transparency and
+            with many colors are converted to JPEG. By default, this is True.
+        processes (Option[int]): The number of processes to optimize images
+            with. By default, this is the number of CPU cores.
+
+    Raises:
+        NotImplementedError: Raised if Pillow isn't installed.
+    """
+
+    def __init__(self, max_width=758, max_height=1024, jpeg_quality=80, convert_photos=True, processes=None):
+        if not pillow_module_exists:
+            raise NotImplementedError('Pillow must be installed to optimize images')
+        self.max_width = max_width
+        self.max_height = max_height
+        self.jpeg_quality = jpeg_quality
+        self.convert_photos = convert_photos
+        self.processes = processes or multiprocessing.cpu_count()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_settings(self):
+        return self.max_width, self.max_height, self.jpeg_quality, self.convert_photos
+
+    def optimize(self, content, image_type):
+        """
+        Optimizes one image in this process.
+
+        Args:
+            content (str): The content of the image.
+            image_type (str): The extension of the image, e.g. 'png'.
+
+        Returns:
+            tuple: The content and extension of the optimized image, which
+                are those given if the image can't be optimized.
+        """
+        return _optimize_image((content, image_type, self._get_settings()))
+
+    def optimize_images(self, images):
+        """
+        Optimizes several images at once on the process pool.
+
+        Args:
+            images (list): The (content, extension) tuples of the images.
+
+        Returns:
+            list: The (content, extension) tuples of the optimized images, in
+                the same order.
+        """
+        tasks = [(content, image_type, self._get_settings()) for content, image_type in images]
+        if self.processes <= 1 or len(tasks) <= 1:
+            return [_optimize_image(task) for task in tasks]
+        pool = self._get_pool()
+        if pool is None:
+            return [_optimize_image(task) for task in tasks]
+        return pool.map(_optimize_image, tasks, chunksize=1)
+
+    def optimize_in_pool(self, content, image_type):
+        """
+        Optimizes one image on the process pool and waits for it. Threads
+        optimizing an image each at the same time share the pool.
+
+        Args:
+            The same as those of optimize.
+
+        Returns:
+            tuple: The content and extension of the optimized image.
+        """
+        task = (content, image_type, self._get_settings())
+        pool = self._get_pool()
+        if pool is None or self.processes <= 1:
+            return _optimize_image(task)
+        return pool.apply(_optimize_image, (task,))
+
+    def start(self):
+        """
+        Starts the process pool, unless it is started already or processes
+        is 1. The pool is forked from this process, so start it before other
+        threads are busy, e.g. from the main thread before adding chapters.
+        """
+        with self._pool_lock:
+            if self._pool is None and self.processes > 1:
+                self._pool = multiprocessing.Pool(self.processes)
+
+    def _get_pool(self):
+        with self._pool_lock:
+            return self._pool
+
+    def close(self):
+        """
+        Stops the process pool. Images are then optimized in the calling
+        process until the pool is started again.
+        """
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+
+def _optimize_image(task):
+    content, image_type, (max_width, max_height, jpeg_quality, convert_photos) = task
+    if image_type not in _PILLOW_FORMATS:
+        return content, image_type
+    try:
+        image = Image.open(io.BytesIO(content))
+        # Only the first frame of an animated image is loaded
+        image.load()
+        changed = getattr(image, 'is_animated', False) or _PILLOW_FORMATS[image_type] not in ('JPEG', 'PNG', 'GIF')
+        if image.width > max_width or image.height > max_height:
+            image.thumbnail((max_width, max_height), Image.LANCZOS)
+            changed = True
+        output_format = _get_output_format(image, image_type, convert_photos)
+        if output_format != _PILLOW_FORMATS[image_type]:
+            changed = True
+        output = io.BytesIO()
+        if output_format == 'JPEG':
+            if image.mode not in ('L', 'RGB'):
+                image = image.convert('RGB')
+            image.save(output, 'JPEG', quality=jpeg_quality, optimize=True)
+        elif output_format == 'GIF':
+            image.save(output, 'GIF', optimize=True)
+        else:
+            if image.mode == 'CMYK':
+                image = image.convert('RGB')
+            image.save(output, 'PNG', optimize=True)
+        optimized_content = output.getvalue()
+    except Exception:
+        # Anything Pillow can't handle, including decompression bombs, is kept
+        return content, image_type
+    # Re-encoding alone sometimes makes an image larger, in which case the
+    # original is kept, metadata and all
+    if not changed and len(optimized_content) >= len(content):
+        return content, image_type
+    return optimized_content, _get_image_type(output_format, image_type)
+
+
+def _get_output_format(image, image_type, convert_photos):
+    pillow_format = _PILLOW_FORMATS[image_type]
+    if pillow_format in ('JPEG', 'GIF'):
+        return pillow_format
+    if convert_photos and _is_photo(image):
+        return 'JPEG'
+    return 'PNG'
+
+
+def _is_photo(image):
+    """
+    Returns whether image looks like a photo rather than a drawing or a
+    screenshot: opaque and with many colors.
+    """
+    if image.mode in ('1', 'L', 'P') or 'transparency' in image.info:
+        return False
+    if image.mode in ('RGBA', 'LA') and image.getchannel('A').getextrema()[0] < 255:
+        return False
+    return image.convert('RGB').getcolors(_PHOTO_MIN_COLORS) is None
+
+
+def _get_image_type(output_format, image_type):
+    # Keep the spelling of the original extension when the format is the same
+    if _PILLOW_FORMATS[image_type] == output_format:
+        return image_type
+    return output_format.lower()
@@ -0,0 +1,136 @@
+import BaseHTTPServer
+import socket
+import SocketServer
+import threading
+import time
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up early, e.g. on oversized images, are expected
+        pass
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one piece, or delayed acks stall kept alive
+    # connections for tens of milliseconds per request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.local_server._record_connection(self.connection)
+
+    def do_GET(self):
+        server = self.server.local_server
+        server._record_request(self.path, self.headers)
+        if server.delay:
+            time.sleep(server.delay)
+        try:
+            status, headers, body = server.routes[self.path]
+        except KeyError:
+            status, headers, body = 404, {'Content-Type': 'text/plain'}, 'Not Found'
+        if status == 200 and headers.get('ETag') and self.headers.get('If-None-Match') == headers['ETag']:
+            status, body = 304, ''
+        self.send_response(status)
+        for header, value in headers.items():
+            if value is not None:
+                self.send_header(header, value)
+        if 'Content-Length' in headers and headers['Content-Length'] is None:
+            # The body ends when the connection does
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+        else:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalServer(object):
+    """
+    A local stand-in for the web servers pypub fetches pages and images from,
+    used by the tests and benchmarks so they run without network access.
+    Serves fixed responses from a background thread.
+
+    Args:
+        delay (Option[float]): Seconds to wait before answering each request,
+            to simulate network latency. By default, this is 0.
+
+    Attributes:
+        routes (dict): Maps paths to (status, headers, body) tuples. Routes
+            with an ETag header answer matching If-None-Match requests with
+            304 Not Modified, and routes whose Content-Length header is None
+            are sent without one.
+        requests (list): The (path, headers) of every request received.
+        connections (int): The number of connections accepted. Connections
+            are kept alive, so clients that reuse them open fewer.
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.routes = {}
+        self.requests = []
+        self.connections = 0
+        self._open_connections = []
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _RequestHandler)
+        self._server.local_server = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _record_request(self, path, headers):
+        with self._lock:
+            self.requests.append((path, headers))
+
+    def _record_connection(self, connection):
+        with self._lock:
+            self.connections += 1
+            self._open_connections.append(connection)
+
+    def add_route(self, path, body, content_type='text/html', status=200, headers=None):
+        """
+        Serves body at path and returns the full url of path.
+        """
+        route_headers = {'Content-Type': content_type}
+        route_headers.update(headers or {})
+        self.routes[path] = (status, route_headers, body)
+        return self.get_url(path)
+
+    def add_file(self, path, file_name, content_type):
+        """
+        Serves the content of the file file_name at path and returns the full
+        url of path.
+        """
+        with open(file_name, 'rb') as f:
+            return self.add_route(path, f.read(), content_type)
+
+    def get_url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self._server.server_address[1], path)
+
+    def request_count(self, path):
+        with self._lock:
+            return len([p for p, headers in self.requests if p == path])
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        # Let the threads serving kept alive connections finish
+        with self._lock:
+            for connection in self._open_connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
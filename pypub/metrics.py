@@ -0,0 +1,163 @@
+import collections
+import threading
+import time
+
+
+StageEvent = collections.namedtuple('StageEvent', ['stage', 'seconds', 'bytes_in', 'bytes_out', 'name'])
+ChapterStats = collections.namedtuple('ChapterStats', ['title', 'url', 'nodes'])
+
+STAGES = ('fetch', 'extract', 'clean', 'xhtml', 'images', 'optimize_images', 'write', 'zip')
+
+
+class Metrics(object):
+    """
+    Collects how long each stage of building an epub takes, the bytes going
+    into and out of it, image counts and the number of nodes in each chapter.
+    Give the same Metrics to a ChapterFactory and an Epub to follow a whole
+    build. Safe to share between threads.
+
+    The stages are:
+        fetch: downloading a webpage. bytes_out is the size of the response.
+        extract: narrowing a page to its main content, when the
+            ChapterFactory extracts content. Also counted in clean.
+        clean: parsing and sanitizing a page. bytes_in is its length.
+        xhtml: converting a sanitized page to xhtml.
+        images: downloading the images of a chapter. bytes_in is the size of
+            the downloads and bytes_out that of the images saved.
+        optimize_images: optimizing a downloaded image.
+        write: saving a chapter to the store. bytes_out is its size.
+        zip: packaging the epub. bytes_in is the size of the files packaged
+            and bytes_out that of the epub.
+
+    Attributes:
+        counters (dict): Counts by name: images_downloaded, images_failed
+            and images_duplicate, which counts downloads whose content was
+            already saved.
+        chapters (list): A ChapterStats for each chapter created.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets everything recorded so far. Subscribers are kept.
+        """
+        with self._lock:
+            self._stages = collections.OrderedDict((stage, [0, 0.0, 0, 0]) for stage in STAGES)
+            self.counters = collections.defaultdict(int)
+            self.chapters = []
+
+    def subscribe(self, callback):
+        """
+        Calls callback with a StageEvent every time a stage finishes, from the
+        thread the stage ran on.
+
+        Args:
+            callback (function): Called with the StageEvent.
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._callbacks.remove(callback)
+
+    def time(self, stage, name=None):
+        """
+        Returns a context manager that records how long its block takes as
+        one run of stage. Set the bytes_in and bytes_out attributes of the
+        object it returns to record sizes too.
+
+        Args:
+            stage (str): The name of the stage.
+            name (Option[str]): What the stage ran on, e.g. a url, passed on
+                to subscribers. By default, this is None.
+        """
+        return _StageTimer(self, stage, name)
+
+    def record(self, stage, seconds, bytes_in=0, bytes_out=0, name=None):
+        """
+        Records one run of stage and tells subscribers about it.
+        """
+        with self._lock:
+            totals = self._stages.setdefault(stage, [0, 0.0, 0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += bytes_in
+            totals[3] += bytes_out
+            callbacks = list(self._callbacks)
+        event = StageEvent(stage, seconds, bytes_in, bytes_out, name)
+        for callback in callbacks:
+            callback(event)
+
+    def increment(self, counter, amount=1):
+        with self._lock:
+            self.counters[counter] += amount
+
+    def add_chapter(self, title, url, nodes):
+        with self._lock:
+            self.chapters.append(ChapterStats(title, url, nodes))
+
+    def summary(self):
+        """
+        Returns:
+            dict: stages maps each stage that ran to its calls, seconds,
+                bytes_in and bytes_out, counters holds the counters and
+                chapters a dict for each ChapterStats.
+        """
+        with self._lock:
+            stages = collections.OrderedDict(
+                (stage, {'calls': calls, 'seconds': seconds, 'bytes_in': bytes_in, 'bytes_out': bytes_out})
+                for stage, (calls, seconds, bytes_in, bytes_out) in self._stages.items() if calls)
+            return {
+                'stages': stages,
+                'counters': dict(self.counters),
+                'chapters': [stats._asdict() for stats in self.chapters],
+                }
+
+    def report(self):
+        """
+        Returns the summary as a table, one line per stage and counter.
+        """
+        summary = self.summary()
+        lines = ['%-16s %6s %10s %12s %12s' % ('stage', 'calls', 'seconds', 'bytes in', 'bytes out')]
+        for stage, totals in summary['stages'].items():
+            lines.append('%-16s %6d %10.3f %12d %12d' % (stage, totals['calls'], totals['seconds'],
+                                                         totals['bytes_in'], totals['bytes_out']))
+        for counter, count in sorted(summary['counters'].items()):
+            lines.append('%-16s %6d' % (counter, count))
+        if summary['chapters']:
+            lines.append('%-16s %6d' % ('chapter_nodes', sum(stats['nodes'] for stats in summary['chapters'])))
+        return '\n'.join(lines)
+
+
+class _StageTimer(object):
+
+    def __init__(self, metrics, stage, name):
+        self.metrics = metrics
+        self.stage = stage
+        self.name = name
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.metrics is not None:
+            self.metrics.record(self.stage, time.time() - self.start_time, self.bytes_in, self.bytes_out,
+                                self.name)
+
+
+def time_stage(metrics, stage, name=None):
+    """
+    Returns metrics.time(stage, name), or a context manager that records
+    nothing if metrics is None.
+    """
+    if metrics is None:
+        return _StageTimer(None, stage, name)
+    return metrics.time(stage, name)
@@ -0,0 +1,396 @@
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+
+
+_COMPRESS_LEVEL = 6
+_CHUNK_SIZE = 64 * 1024
+# Files written in pieces to an ArchiveStore larger than this are gathered on disk
+_SPOOL_SIZE = 1024 * 1024
+
+
+class MemoryStore(object):
+    """
+    Keeps the files of an epub in memory. Nothing is written to disk, so an
+    epub can be built and packaged without touching the filesystem.
+
+    File names are paths relative to the root of the store and always use
+    forward slashes, e.g. 'images/cover.png'.
+
+    Args:
+        compress (Option[bool]): If True, files are kept compressed with zlib,
+            which takes a fraction of the memory for xhtml. By default, this
+            is False.
+    """
+
+    def __init__(self, compress=False):
+        self.compress = compress
+        self._files = {}
+        self._sizes = {}
+        self._names = []
+
+    def write(self, name, data):
+        """
+        Saves a file to the store, replacing any file with the same name.
+
+        Args:
+            name (str): The name of the file.
+            data (str): The content of the file. Unicode strings are encoded
+                as utf-8.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._put(name, self._pack(data), len(data))
+
+    def write_chunks(self, name, chunks):
+        """
+        Saves a file to the store from an iterable of strings, replacing any
+        file with the same name. If chunks raises an exception, no file is
+        saved.
+        """
+        self.write(name, ''.join(chunks))
+
+    def _pack(self, data):
+        if self.compress:
+            return zlib.compress(data, _COMPRESS_LEVEL)
+        return data
+
+    def _put(self, name, packed_data, size):
+        if name not in self._files:
+            self._names.append(name)
+        self._files[name] = packed_data
+        self._sizes[name] = size
+
+    def read(self, name):
+        """
+        Returns the content of the file name.
+
+        Raises:
+            KeyError: Raised if there is no file name in the store.
+        """
+        if self.compress:
+            return zlib.decompress(self._files[name])
+        return self._files[name]
+
+    def remove(self, name):
+        """
+        Deletes the file name from the store.
+
+        Raises:
+            KeyError: Raised if there is no file name in the store.
+        """
+        del self._files[name]
+        del self._sizes[name]
+        self._names.remove(name)
+
+    def names(self):
+        """
+        Returns the names of all files in the store, in the order they were
+        first written.
+        """
+        return list(self._names)
+
+    def size(self, name):
+        return self._sizes[name]
+
+    def memory_size(self, name):
+        """
+        Returns the number of bytes of memory the file name takes, which is
+        less than its size if it is compressed.
+        """
+        return len(self._files[name])
+
+    def write_to_archive(self, name, epub_archive, archive_name):
+        """
+        Adds the file name to an archive.EpubArchive as archive_name.
+        """
+        epub_archive.write_string(archive_name, self.read(name))
+
+    def close(self):
+        """
+        Discards all files in the store.
+        """
+        self._files = {}
+        self._sizes = {}
+        self._names = []
+
+
+class DiskStore(object):
+    """
+    Keeps the files of an epub in a directory on disk.
+
+    Args:
+        directory (Option[str]): The directory to save files in. It is created
+            if it doesn't exist. By default, a new temporary directory is used,
+            which is deleted when the store is closed.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            self.directory = tempfile.mkdtemp()
+            self._owns_directory = True
+        else:
+            self.directory = directory
+            self._owns_directory = False
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+        self._names = []
+
+    def _get_full_name(self, name):
+        return os.path.join(self.directory, *name.split('/'))
+
+    def write(self, name, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        full_name = self._get_full_name(name)
+        parent_directory = os.path.dirname(full_name)
+        if not os.path.isdir(parent_directory):
+            os.makedirs(parent_directory)
+        with open(full_name, 'wb') as f:
+            f.write(data)
+        if name not in self._names:
+            self._names.append(name)
+
+    def write_chunks(self, name, chunks):
+        """
+        Saves a file to the store from an iterable of strings, writing each
+        piece to disk as it comes. If chunks raises an exception, no file is
+        saved.
+        """
+        full_name = self._get_full_name(name)
+        parent_directory = os.path.dirname(full_name)
+        if not os.path.isdir(parent_directory):
+            os.makedirs(parent_directory)
+        try:
+            with open(full_name + '.part', 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        except Exception:
+            os.remove(full_name + '.part')
+            raise
+        if os.name == 'nt' and os.path.exists(full_name):
+            os.remove(full_name)
+        os.rename(full_name + '.part', full_name)
+        if name not in self._names:
+            self._names.append(name)
+
+    def read(self, name):
+        try:
+            with open(self._get_full_name(name), 'rb') as f:
+                return f.read()
+        except IOError:
+            raise KeyError(name)
+
+    def remove(self, name):
+        try:
+            os.remove(self._get_full_name(name))
+        except OSError:
+            raise KeyError(name)
+        self._names.remove(name)
+
+    def names(self):
+        return list(self._names)
+
+    def size(self, name):
+        return os.path.getsize(self._get_full_name(name))
+
+    def write_to_archive(self, name, epub_archive, archive_name):
+        epub_archive.write_file(archive_name, self._get_full_name(name))
+
+    def close(self):
+        """
+        Deletes the directory of the store if the store created it.
+        """
+        if self._owns_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        self._names = []
+
+
+class SpillingStore(object):
+    """
+    Keeps the files of an epub in memory until they add up to more than
+    max_memory_bytes, and saves any further files to a temporary directory.
+    Small books never touch the disk while large ones don't exhaust memory.
+
+    Args:
+        max_memory_bytes (Option[int]): The number of bytes to keep in memory.
+            By default, this is 32 MB.
+        compress (Option[bool]): If True, files in memory are kept compressed,
+            so many more fit in max_memory_bytes. By default, this is False.
+    """
+
+    def __init__(self, max_memory_bytes=32 * 1024 * 1024, compress=False):
+        self.max_memory_bytes = max_memory_bytes
+        self.memory_bytes = 0
+        self._memory_store = MemoryStore(compress)
+        self._disk_store = None
+        self._stores = {}
+        self._names = []
+
+    def write(self, name, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if name in self._stores and self._stores[name] is self._memory_store:
+            self.memory_bytes -= self._memory_store.memory_size(name)
+        packed_data = self._memory_store._pack(data)
+        if self.memory_bytes + len(packed_data) <= self.max_memory_bytes:
+            store = self._memory_store
+            self.memory_bytes += len(packed_data)
+        else:
+            if self._disk_store is None:
+                self._disk_store = DiskStore()
+            store = self._disk_store
+        if store is self._memory_store:
+            self._memory_store._put(name, packed_data, len(data))
+        else:
+            store.write(name, data)
+        self._set_store(name, store)
+
+    def write_chunks(self, name, chunks):
+        """
+        Saves a file to the store from an iterable of strings. The pieces are
+        gathered in memory only while they fit, uncompressed, in what is left
+        of max_memory_bytes, and a larger file is streamed to disk. If chunks
+        raises an exception, no file is saved.
+        """
+        available_bytes = self.max_memory_bytes - self.memory_bytes
+        if name in self._stores and self._stores[name] is self._memory_store:
+            available_bytes += self._memory_store.memory_size(name)
+        chunks = iter(chunks)
+        buffered_chunks = []
+        buffered_size = 0
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            buffered_chunks.append(chunk)
+            buffered_size += len(chunk)
+            if buffered_size > available_bytes:
+                if self._disk_store is None:
+                    self._disk_store = DiskStore()
+                self._disk_store.write_chunks(name, itertools.chain(buffered_chunks, chunks))
+                if name in self._stores and self._stores[name] is self._memory_store:
+                    self.memory_bytes -= self._memory_store.memory_size(name)
+                self._set_store(name, self._disk_store)
+                return
+        self.write(name, ''.join(buffered_chunks))
+
+    def _set_store(self, name, store):
+        previous_store = self._stores.get(name)
+        if previous_store is not None and previous_store is not store:
+            previous_store.remove(name)
+        if name not in self._stores:
+            self._names.append(name)
+        self._stores[name] = store
+
+    def read(self, name):
+        return self._stores[name].read(name)
+
+    def remove(self, name):
+        store = self._stores.pop(name)
+        if store is self._memory_store:
+            self.memory_bytes -= self._memory_store.memory_size(name)
+        store.remove(name)
+        self._names.remove(name)
+
+    def names(self):
+        return list(self._names)
+
+    def size(self, name):
+        return self._stores[name].size(name)
+
+    def write_to_archive(self, name, epub_archive, archive_name):
+        self._stores[name].write_to_archive(name, epub_archive, archive_name)
+
+    def close(self):
+        self._memory_store.close()
+        if self._disk_store is not None:
+            self._disk_store.close()
+            self._disk_store = None
+        self.memory_bytes = 0
+        self._stores = {}
+        self._names = []
+
+
+class ArchiveStore(object):
+    """
+    Writes the files of an epub straight into an archive.EpubArchive as they
+    are saved, so nothing is kept once a file is written. Files can't be
+    read back or replaced. Safe to share between threads.
+
+    Args:
+        epub_archive (archive.EpubArchive): The archive to write files to.
+        directory (Option[str]): The directory inside the archive the names
+            of files are relative to. By default, this is 'OEBPS/'.
+    """
+
+    def __init__(self, epub_archive, directory='OEBPS/'):
+        self.epub_archive = epub_archive
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._sizes = {}
+        self._names = []
+
+    def write(self, name, data):
+        """
+        Adds a file to the archive.
+
+        Raises:
+            ValueError: Raised if a file name was already written.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        with self._lock:
+            if name in self._sizes:
+                raise ValueError('%s is already in the archive' % name)
+            self._sizes[name] = len(data)
+        # Files saved from several threads are compressed at the same time
+        compressed_entry = self.epub_archive.compress(self.directory + name, data)
+        with self._lock:
+            self.epub_archive.write_compressed(compressed_entry)
+            self._names.append(name)
+
+    def write_chunks(self, name, chunks):
+        """
+        Adds a file to the archive from an iterable of strings. The pieces
+        are gathered in a temporary file first, which keeps up to
+        _SPOOL_SIZE in memory, so other threads go on writing meanwhile and,
+        if chunks raises an exception, nothing is written.
+
+        Raises:
+            ValueError: Raised if a file name was already written.
+        """
+        spool = tempfile.SpooledTemporaryFile(_SPOOL_SIZE)
+        try:
+            size = 0
+            for chunk in chunks:
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf-8')
+                spool.write(chunk)
+                size += len(chunk)
+            spool.seek(0)
+            with self._lock:
+                if name in self._sizes:
+                    raise ValueError('%s is already in the archive' % name)
+                self._sizes[name] = size
+                self.epub_archive.write_chunks(self.directory + name, iter(lambda: spool.read(_CHUNK_SIZE), ''))
+                self._names.append(name)
+        finally:
+            spool.close()
+
+    def names(self):
+        with self._lock:
+            return list(self._names)
+
+    def size(self, name):
+        return self._sizes[name]
+
+    def close(self):
+        """
+        Forgets the files written. The archive is left open.
+        """
+        with self._lock:
+            self._sizes = {}
+            self._names = []
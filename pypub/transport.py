@@ -0,0 +1,95 @@
+import threading
+
+import requests
+import requests.adapters
+from requests.packages.urllib3.util.retry import Retry
+
+
+_user_agent = r'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0'
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+
+class Transport(object):
+    """
+    Fetches the webpages and images of an epub over one requests.Session, so
+    connections are kept alive and reused between requests to the same host.
+
+    Args:
+        pool_connections (Option[int]): The number of hosts to keep connection
+            pools for. By default, this is 10.
+        pool_maxsize (Option[int]): The number of connections to keep open to
+            each host. Should be at least the number of threads fetching at
+            once. By default, this is 10.
+        host_pool_sizes (Option[dict]): Maps hosts, e.g. 'cdn.example.com' or
+            'example.com:8080', to the number of connections to keep open to
+            them, overriding pool_maxsize. By default, this is None.
+        timeout (Option[float]): Seconds to wait for a server to connect or
+            send data. By default, this is 30.
+        retries (Option[int]): The number of times to retry a request that
+            fails to connect or gets a 502, 503 or 504 response. By default,
+            this is 3.
+        backoff_factor (Option[float]): Scales the pause between retries,
+            which doubles after each retry. By default, this is 0.3.
+        cache (Option[cache.ResponseCache]): A cache to fetch through. By
+            default, this is None.
+        headers (Option[dict]): Headers sent with every request. By default,
+            only a browser User-Agent is sent.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, host_pool_sizes=None, timeout=30, retries=3,
+                 backoff_factor=0.3, cache=None, headers=None):
+        self.timeout = timeout
+        self.cache = cache
+        self.retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(502, 503, 504),
+                           raise_on_status=False)
+        self.session = requests.Session()
+        self.session.headers.update(headers or {'User-Agent': _user_agent})
+        adapter = requests.adapters.HTTPAdapter(pool_connections, pool_maxsize, self.retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        for host, pool_size in (host_pool_sizes or {}).items():
+            host_adapter = requests.adapters.HTTPAdapter(1, pool_size, self.retry)
+            self.session.mount('http://%s/' % host, host_adapter)
+            self.session.mount('https://%s/' % host, host_adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, url, max_bytes=None, **kwargs):
+        """
+        Gets url through the session, and the cache if there is one. Takes the
+        same arguments as requests.get. max_bytes is passed on to the cache,
+        which reads no more than that of a response; without a cache, pass
+        stream=True and read what is needed instead.
+
+        Returns:
+            requests.Response: The response.
+
+        Raises:
+            requests.exceptions.RequestException: Raised if the request fails.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        if self.cache is None:
+            return self.session.get(url, **kwargs)
+        return self.cache.get(url, session=self.session, max_bytes=max_bytes, **kwargs)
+
+    def close(self):
+        """
+        Closes every pooled connection.
+        """
+        self.session.close()
+
+
+def get_default_transport():
+    """
+    Returns the Transport shared by everything that isn't given one.
+    """
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None:
+            _default_transport = Transport()
+        return _default_transport
@@ -0,0 +1,36 @@
+import argparse
+import unittest
+
+import benchmarks
+
+
+class BenchmarksTests(unittest.TestCase):
+
+    def setUp(self):
+        self.options = argparse.Namespace(chapters=3, images=1, repeat=1, nodes=300)
+
+    def test_run_benchmark(self):
+        for name in ['clean_deep[bs4]', 'clean_wide[bs4]', 'create_chapter', 'add_chapter', 'create_epub']:
+            result = benchmarks.run_benchmark(name, self.options)
+            self.assertGreater(result['items'], 0)
+            self.assertGreater(result['bytes'], 0)
+            self.assertGreater(result['items_per_second'], 0)
+
+    def test_compare_results(self):
+        old_results = {'benchmarks': {
+            'clean[bs4]': {'items_per_second': 10.0, 'max_rss_kb': 1000},
+            'create_epub': {'error': 'failed'},
+            }}
+        new_results = {'benchmarks': {
+            'clean[bs4]': {'items_per_second': 20.0, 'max_rss_kb': 500},
+            'create_epub': {'items_per_second': 1.0, 'max_rss_kb': 1000},
+            }}
+        lines = benchmarks.compare_results(old_results, new_results)
+        self.assertEqual(len(lines), 3)
+        self.assertIn('2.00x', lines[1])
+        self.assertIn('0.50x', lines[1])
+        self.assertIn('error', lines[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import cache
+import chapter
+from local_server import LocalServer
+import storage
+from transport import Transport
+
+
+class ResponseCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = LocalServer()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_revalidation(self):
+        url = self.server.add_route('/page.html', '<html>page</html>', headers={'ETag': '"1"'})
+        response_cache = cache.ResponseCache(self.directory)
+        self.assertEqual(response_cache.get(url).content, '<html>page</html>')
+        response = response_cache.get(url)
+        self.assertEqual(response.content, '<html>page</html>')
+        self.assertEqual(response.headers['Content-Type'], 'text/html')
+        self.assertEqual(self.server.request_count('/page.html'), 2)
+        self.assertEqual(self.server.requests[-1][1].get('If-None-Match'), '"1"')
+
+    def test_changed_response(self):
+        url = self.server.add_route('/page.html', 'old', headers={'ETag': '"1"'})
+        response_cache = cache.ResponseCache(self.directory)
+        response_cache.get(url)
+        self.server.add_route('/page.html', 'new', headers={'ETag': '"2"'})
+        self.assertEqual(response_cache.get(url).content, 'new')
+        self.assertEqual(response_cache.get(url).content, 'new')
+
+    def test_max_age(self):
+        url = self.server.add_route('/page.html', 'page')
+        response_cache = cache.ResponseCache(self.directory, max_age=3600)
+        response_cache.get(url)
+        self.assertEqual(response_cache.get(url).content, 'page')
+        self.assertEqual(self.server.request_count('/page.html'), 1)
+
+    def test_no_store(self):
+        url = self.server.add_route('/page.html', 'page', headers={'Cache-Control': 'no-store'})
+        response_cache = cache.ResponseCache(self.directory)
+        response_cache.get(url)
+        self.assertEqual(response_cache.size, 0)
+
+    def test_errors_not_cached(self):
+        url = self.server.get_url('/missing.html')
+        response_cache = cache.ResponseCache(self.directory)
+        self.assertEqual(response_cache.get(url).status_code, 404)
+        self.assertEqual(response_cache.size, 0)
+
+    def test_eviction(self):
+        urls = [self.server.add_route('/%d.html' % i, str(i) * 10) for i in range(3)]
+        response_cache = cache.ResponseCache(self.directory, max_bytes=25)
+        response_cache.get(urls[0])
+        response_cache.get(urls[1])
+        response_cache.get(urls[0])
+        response_cache.get(urls[2])
+        self.assertEqual(response_cache.size, 20)
+        response_cache.offline = True
+        self.assertEqual(response_cache.get(urls[0]).content, '0' * 10)
+        self.assertRaises(cache.OfflineError, response_cache.get, urls[1])
+
+    def test_offline(self):
+        url = self.server.add_route('/page.html', u'café'.encode('utf-8'),
+                                    content_type='text/html; charset=utf-8')
+        response_cache = cache.ResponseCache(self.directory)
+        response_cache.get(url)
+        response_cache.close()
+        response_cache = cache.ResponseCache(self.directory, offline=True)
+        self.assertEqual(response_cache.get(url).text, u'café')
+        self.assertEqual(self.server.request_count('/page.html'), 1)
+        self.assertRaises(cache.OfflineError, response_cache.get, self.server.get_url('/other.html'))
+
+    def test_clear(self):
+        url = self.server.add_route('/page.html', 'page')
+        response_cache = cache.ResponseCache(self.directory)
+        response_cache.get(url)
+        response_cache.clear()
+        self.assertEqual(response_cache.size, 0)
+        self.assertEqual(os.listdir(self.directory), ['index.json'])
+
+    def test_chapter_factory(self):
+        url = self.server.add_route('/page.html', '<html><head><title>Cached</title></head>'
+                                    '<body><p>text</p></body></html>')
+        response_cache = cache.ResponseCache(self.directory)
+        chapter.ChapterFactory(cache=response_cache).create_chapter_from_url(url)
+        response_cache.offline = True
+        c = chapter.ChapterFactory(cache=response_cache).create_chapter_from_url(url)
+        self.assertEqual(c.title, 'Cached')
+        self.assertEqual(self.server.request_count('/page.html'), 1)
+
+    def test_image_registry(self):
+        with open(os.path.join('test_files', 'test image 0.png'), 'rb') as f:
+            image = f.read()
+        url = self.server.add_route('/a.png', image, content_type='image/png')
+        response_cache = cache.ResponseCache(self.directory)
+        chapter.ImageRegistry(storage.MemoryStore(), Transport(cache=response_cache)).add_images([url])
+        response_cache.offline = True
+        image_registry = chapter.ImageRegistry(storage.MemoryStore(), Transport(cache=response_cache))
+        image_registry.add_images([url])
+        self.assertTrue(image_registry.get_file_name(url).endswith('.png'))
+        self.assertEqual(self.server.request_count('/a.png'), 1)
+
+
+    def test_max_bytes(self):
+        with open(os.path.join('test_files', 'test image 0.png'), 'rb') as f:
+            image = f.read()
+        large_image = image + '\x00' * 500000
+        url = self.server.add_route('/large.png', large_image, content_type='image/png')
+        unsized_url = self.server.add_route('/unsized.png', large_image, content_type='image/png',
+                                            headers={'Content-Length': None})
+        response_cache = cache.ResponseCache(self.directory)
+        image_registry = chapter.ImageRegistry(storage.MemoryStore(), Transport(cache=response_cache),
+                                               max_image_bytes=100000)
+        image_registry.add_images([url, unsized_url])
+        self.assertIsNone(image_registry.get_file_name(url))
+        self.assertIsNone(image_registry.get_file_name(unsized_url))
+        self.assertEqual(response_cache.size, 0)
+        response = response_cache.get(url, max_bytes=100000)
+        # Too large by its Content-Length, so none of it is read
+        self.assertFalse(response._content_consumed)
+        response.close()
+        response = response_cache.get(unsized_url, max_bytes=100000)
+        self.assertGreater(len(response.content), 100000)
+        self.assertLess(len(response.content), len(large_image))
+        self.assertEqual(response_cache.size, 0)
+        self.assertEqual(len(response_cache.get(url).content), len(large_image))
+        response_cache.offline = True
+        self.assertEqual(response_cache.get(url, max_bytes=100000).content, large_image[:100001])
+        small_url = self.server.add_route('/small.png', image, content_type='image/png')
+        response_cache.offline = False
+        self.assertEqual(response_cache.get(small_url, max_bytes=100000).content, image)
+        self.assertEqual(response_cache.size, len(large_image) + len(image))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,14 @@
+import codecs
 import os
+import time
 import unittest
 
+import requests
+
 import chapter
+import clean
+import local_server
+import storage
 
 
 test_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -43,6 +50,63 @@ class ChapterTests(unittest.TestCase):
         self.assertEqual(c.html_title,
                 'Strategy&amp; (Formerly Booz &amp; Company) - A global management and strategy consulting firm')
 
+    def test_create_chapter_from_string_single_parse(self):
+        test_file = os.path.join(test_directory, 'strategy&.html')
+        with codecs.open(test_file, 'r', encoding='utf-8') as f:
+            html_string = f.read()
+        c = chapter.ChapterFactory(engine='bs4').create_chapter_from_string(html_string)
+        self.assertEqual(c.content,
+                         clean.html_to_xhtml(clean.clean(html_string, engine='bs4'), engine='bs4'))
+        custom_factory = chapter.ChapterFactory(lambda s: clean.clean(s, engine='bs4'), engine='bs4')
+        self.assertEqual(custom_factory.create_chapter_from_string(html_string).content,
+                         c.content)
+
+    def test_create_chapter_extract_content(self):
+        test_file = os.path.join(test_directory, 'strategy&.html')
+        with codecs.open(test_file, 'r', encoding='utf-8') as f:
+            html_string = f.read()
+        c = chapter.ChapterFactory(engine='bs4', extract_content=True).create_chapter_from_string(html_string)
+        self.assertEqual(c.title, 'Strategy& (Formerly Booz & Company) - A global management and strategy consulting firm')
+        self.assertEqual(c.content, clean.html_to_xhtml(clean.clean(html_string, engine='bs4', extract_content=True),
+                                                        engine='bs4'))
+        self.assertNotIn('UtilityNavigation', c.content)
+        custom_factory = chapter.ChapterFactory(lambda s: clean.clean(s, engine='bs4'), engine='bs4',
+                                                extract_content=True)
+        self.assertEqual(custom_factory.create_chapter_from_string(html_string).content, c.content)
+
+    def test_content_tree_is_lazy(self):
+        c = chapter.Chapter(u'<html><head></head><body><p>Hello</p></body></html>', 'Dummy Title')
+        self.assertIsNone(c._content_tree)
+        c._replace_images_in_chapter(test_directory)
+        self.assertIsNone(c._content_tree)
+        self.assertEqual(c._get_image_urls(), [])
+        self.assertIsNotNone(c._content_tree)
+        c._release_content_tree()
+        self.assertIsNone(c._content_tree)
+        self.assertEqual(c.content, u'<html><head></head><body><p>Hello</p></body></html>')
+
+    def test_images_replaced_without_parsing_again(self):
+        with open(os.path.join(test_directory, 'test image 0.png'), 'rb') as f:
+            png_data = f.read()
+        with local_server.LocalServer() as server:
+            image_url = server.add_route('/image.png', png_data, 'image/png')
+            html_string = (u'<html><head><title>Images</title></head><body><p>text</p><img src="%s"/>'
+                           u'<img src="/missing.png"/></body></html>' % image_url)
+            for engine in ['bs4', 'lxml'] if clean.lxml_module_exists else ['bs4']:
+                factory = chapter.ChapterFactory(engine=clean.ENGINES[engine]())
+                parsed = []
+                parse = factory.engine.parse
+                factory.engine.parse = lambda html_string: parsed.append(html_string) or parse(html_string)
+                c = factory.create_chapter_from_string(html_string, url=image_url)
+                self.assertIsNone(c._content_tree)
+                image_registry = chapter.ImageRegistry(storage.MemoryStore())
+                c._replace_images_in_chapter(None, image_registry=image_registry)
+                self.assertEqual(len(parsed), 1)
+                self.assertIsNone(c._content_tree)
+                self.assertIn(u'src="%s"' % image_registry.get_file_name(image_url), c.content)
+                self.assertNotIn(u'missing.png', c.content)
+                self.assertEqual(c.content.count(u'<img'), 1)
+
     def test_chapter_type_errors(self):
         self.assertRaises(TypeError, chapter.Chapter, 1, 'Dummy Content')
         self.assertRaises(TypeError, chapter.Chapter, 'Dummy Title', 1)
@@ -55,6 +119,62 @@ class ChapterTests(unittest.TestCase):
                 test_file)
         self.assertRaises(ValueError, c.write, '')
 
+    def test_create_chapters_from_urls(self):
+        with local_server.LocalServer(delay=0.2) as server:
+            urls = []
+            for index in range(6):
+                urls.append(server.add_route('/%d.html' % index, '<html><head><title>Page %d</title></head>'
+                                             '<body><p>text</p></body></html>' % index))
+            urls.insert(2, server.get_url('/missing.html').replace('http', 'nope'))
+            start_time = time.time()
+            chapters, errors = self.factory.create_chapters_from_urls(urls, max_workers=8)
+            # one after another the six requests would take 1.2 seconds
+            self.assertLess(time.time() - start_time, 0.8)
+            self.assertEqual([c.title for c in chapters], ['Page %d' % index for index in range(6)])
+            self.assertEqual(errors.keys(), [urls[2]])
+            titles = ['Custom'] + [None] * 6
+            chapters, errors = self.factory.create_chapters_from_urls(urls, titles, max_workers=1)
+            self.assertEqual(chapters[0].title, 'Custom')
+            self.assertEqual(chapters[1].title, 'Page 1')
+            self.assertRaises(ValueError, self.factory.create_chapters_from_urls, urls, ['Custom'])
+
+    def test_thread_map_raises(self):
+        def check(n):
+            if n in (3, 5):
+                raise RuntimeError(n)
+            return n * 2
+        self.assertEqual(chapter._thread_map(check, [0, 1, 2], 4), [0, 2, 4])
+        for max_workers in (1, 4):
+            try:
+                chapter._thread_map(check, range(8), max_workers)
+                self.fail('RuntimeError not raised')
+            except RuntimeError as e:
+                self.assertEqual(e.args, (3,))
+
+    def test_create_chapters_from_urls_unexpected_error(self):
+        def failing_clean(html_string):
+            raise RuntimeError('clean failed')
+        factory = chapter.ChapterFactory(clean_function=failing_clean)
+        with local_server.LocalServer() as server:
+            urls = [server.add_route('/%d.html' % index, '<html><body><p>text</p></body></html>')
+                    for index in range(2)]
+            for max_workers in (1, 8):
+                self.assertRaises(RuntimeError, factory.create_chapters_from_urls, urls, max_workers=max_workers)
+
+    def test_create_chapter_from_url_async(self):
+        with local_server.LocalServer(delay=0.2) as server:
+            url = server.add_route('/page.html', '<html><head><title>Page</title></head>'
+                                   '<body><p>text</p></body></html>')
+            created = []
+            start_time = time.time()
+            result = self.factory.create_chapter_from_url_async(url, callback=created.append)
+            self.assertLess(time.time() - start_time, 0.2)
+            c = result.get(10)
+            self.assertEqual(c.title, 'Page')
+            self.assertEqual(created, [c])
+            result = self.factory.create_chapter_from_url_async(server.get_url('/page.html').replace('http', 'nope'))
+            self.assertRaises(requests.exceptions.InvalidSchema, result.get, 10)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,10 +1,18 @@
+import codecs
+import glob
+import os
 import re
+import urllib
 
 import unittest
 
+import bs4
 from bs4 import BeautifulSoup
 
+import chapter
+import clean as clean_module
 from clean import clean, condense, create_html_from_fragment, html_to_xhtml
+from constants import *
 
 
 class CleanTests(unittest.TestCase):
@@ -141,6 +149,106 @@ class CleanTests(unittest.TestCase):
                 '''
         self.assertEqual(condense(html_to_xhtml(clean(s1))), s)
 
+    def test_clean_singleton_children_kept(self):
+        root = BeautifulSoup(u'<html><head></head><body><p>a<br/>c</p></body></html>', 'html.parser')
+        # Other parsers can nest content in a singleton tag
+        root.br.append(u'b')
+        root.br.append(root.new_tag('em'))
+        root.em.append(u'e')
+        root = clean_module.clean_tree(root)
+        self.assertEqual(clean_module.html_tree_to_string(root),
+                         u'<html><head></head><body><p>a<br />b<em>e</em>c</p></body></html>')
+
+    def test_clean_dropped_tags(self):
+        s = u'<html><head></head><body><p>Hello</p></body></html>'
+        s1 = (u'<html><head><style>p {}</style></head><body><nav><ul><li>Home</li></ul></nav><p>Hello</p>'
+              u'<iframe><p>frame</p></iframe><script>evil()</script></body></html>')
+        for engine in clean_module.ENGINES:
+            if engine == 'lxml' and not clean_module.lxml_module_exists:
+                continue
+            self.assertEqual(condense(clean(s1, engine=engine)), condense(clean(s, engine=engine)))
+
+    def test_clean_keeps_order(self):
+        s = u'<html><head></head><body><p>1</p><p>2</p><p>3</p></body></html>'
+        s1 = u'<html><head></head><body><section><p>1</p><table><tr><td><p>2</p></td></tr></table></section><p>3</p></body></html>'
+        for engine in clean_module.ENGINES:
+            if engine == 'lxml' and not clean_module.lxml_module_exists:
+                continue
+            self.assertEqual(condense(clean(s1, engine=engine)), condense(clean(s, engine=engine)))
+
+    def test_clean_control_characters(self):
+        s = u'<html><head></head><body><p title="xy">ab</p><p>cd</p><span></span></body></html>'
+        s1 = (u'<html><head></head><body><p title="x\x0by">a\x0cb</p><p class="x\x0by">c\x01d</p>'
+              u'<span class="x\x0by"></span></body></html>')
+        s2 = u'<html><head></head><body><article title="x\x0by">a\x0bb</article></body></html>'
+        for engine in clean_module.ENGINES:
+            if engine == 'lxml' and not clean_module.lxml_module_exists:
+                continue
+            self.assertEqual(condense(clean(s1, engine=engine)), condense(clean(s, engine=engine)))
+            self.assertIn(u'<article title="xy">ab</article>', clean(s2, engine=engine))
+            c = chapter.ChapterFactory(engine=engine).create_chapter_from_string(s1)
+            self.assertIn(u'<p title="xy">ab</p>', c.content)
+
+    def test_sanitizer_policy(self):
+        policy = clean_module.SanitizerPolicy(SUPPORTED_TAGS, dropped_tags=[])
+        s = u'<html><head></head><body><nav><p>Home</p></nav></body></html>'
+        self.assertIn('Home', clean(s, policy, engine='bs4'))
+        self.assertNotIn('Home', clean(s, engine='bs4'))
+        self.assertIs(clean_module.get_policy(), clean_module.DEFAULT_POLICY)
+        self.assertIs(clean_module.get_policy(policy), policy)
+
+    def test_clean_deep_tree(self):
+        levels = 3000
+        s = u'<html><body>%s%s</body></html>' % (u'<section><p>level</p><span>' * levels, u'</span></section>' * levels)
+        root = clean_module.clean_tree(BeautifulSoup(s, 'html.parser'))
+        self.assertEqual(len(root.find_all('p')), levels)
+        self.assertEqual(root.find('p').parent.name, 'body')
+
+    def test_extract_content(self):
+        paragraph = u'<p>This paragraph, which is long enough to count, is part of the story being told.</p>'
+        s = u'''
+                <html>
+                 <head><title>Story</title></head>
+                 <body>
+                  <div id="header"><a href="/">Home</a> <a href="/news">News</a></div>
+                  <div class="story-content"><h1>Story</h1>%s</div>
+                  <div class="sidebar"><a href="/1">Related story one</a><img src="ad.png"/></div>
+                  <div id="comments"><p>First!</p></div>
+                 </body>
+                </html>
+                ''' % (paragraph * 5)
+        s1 = u'<html><head></head><body><div><h1>Story</h1>%s</div></body></html>' % (paragraph * 5)
+        s2 = u'<html><head></head><body><div>Too short to tell</div><div>%s</div></body></html>' % paragraph
+        for engine in clean_module.ENGINES:
+            if engine == 'lxml' and not clean_module.lxml_module_exists:
+                continue
+            self.assertEqual(condense(clean(s, engine=engine, extract_content=True)), condense(clean(s1, engine=engine)))
+            self.assertEqual(condense(clean(s2, engine=engine, extract_content=True)), condense(clean(s2, engine=engine)))
+
+    def test_replace_image_sources(self):
+        s = (u'<html><body><!-- <img src="comment.png" /> --><p>&lt;img src="text.png"&gt;</p>'
+             u'<img src="a.png?x=1&amp;y=&quot;2&quot;" /><img class="b" src="b.png"/><img /></body></html>')
+        self.assertEqual(clean_module.get_image_sources(s), [u'a.png?x=1&y="2"', u'b.png'])
+        new_sources = {u'a.png?x=1&y="2"': u'images/a&b.png', u'b.png': None}
+        self.assertEqual(clean_module.replace_image_sources(s, new_sources.get),
+                         u'<html><body><!-- <img src="comment.png" /> --><p>&lt;img src="text.png"&gt;</p>'
+                         u'<img src="images/a&amp;b.png" /><img /></body></html>')
+        for engine in ['bs4', 'lxml'] if clean_module.lxml_module_exists else ['bs4']:
+            engine = clean_module.get_engine(engine)
+            root = engine.html_tree_to_xhtml(engine.clean_tree(engine.parse(
+                u'<p><img src="a.png?x=1&amp;y=2" alt="x > y"/></p><img src="b.png">')))
+            self.assertEqual(clean_module.get_image_sources(engine.xhtml_tree_to_string(root)),
+                             [u'a.png?x=1&y=2', u'b.png'])
+
+    def test_xhtml_tree_to_string(self):
+        s = (u'<!DOCTYPE html><html><head></head><body><!-- note -->\n  \n<p title="a &quot;b&quot;" id="x">'
+             u'caf\xe9 &amp; <b>bar</b></p><br><img src="a.png"><div></div><pre>  x\n\n</pre></body></html>')
+        root = clean_module.html_tree_to_xhtml(BeautifulSoup(s, 'html.parser'))
+        self.assertEqual(clean_module.xhtml_tree_to_string(root),
+                         u'<!DOCTYPE html>\n<html xmlns="http://www.w3.org/1999/xhtml"><head></head><body><!-- note -->\n'
+                         u'<p id="x" title="a &quot;b&quot;">caf\xe9 &amp; <b>bar</b></p><br /><img src="a.png" />'
+                         u'<div></div><pre>  x\n\n</pre></body></html>')
+
     def test_create_html_from_fragment(self):
         test_tag1 = BeautifulSoup('<div></div>', 'html.parser').div
         test_tree1 = create_html_from_fragment(test_tag1)
@@ -149,5 +257,100 @@ class CleanTests(unittest.TestCase):
         self.assertRaises(ValueError, create_html_from_fragment, test_tree1)
 
 
+def canonical_form(xhtml_string):
+    """
+    Reduces an xhtml string to its elements, attributes and text in document
+    order, ignoring formatting, entities and comments.
+    """
+    events = []
+    for node in BeautifulSoup(xhtml_string, 'html.parser').descendants:
+        if isinstance(node, bs4.element.Tag):
+            attributes = []
+            for attribute, value in sorted(node.attrs.items()):
+                if isinstance(value, list):
+                    value = ' '.join(value)
+                if attribute in ('href', 'src'):
+                    # lxml's html serializer percent-escapes urls
+                    value = urllib.unquote(value.encode('utf-8')).decode('utf-8').strip()
+                attributes.append((attribute, value))
+            events.append((node.name, attributes))
+        elif type(node) is bs4.element.NavigableString and node.split():
+            events.append(' '.join(node.split()))
+    return events
+
+
+@unittest.skipUnless(clean_module.lxml_module_exists, 'lxml is not installed')
+class CleanEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+        self.html_strings = []
+        for file_name in sorted(glob.glob(os.path.join(TEST_DIR, '*.html'))):
+            with codecs.open(file_name, 'r', encoding='utf-8') as f:
+                self.html_strings.append(f.read())
+
+    def test_get_engine(self):
+        self.assertIsInstance(clean_module.get_engine(), clean_module.LxmlEngine)
+        self.assertIsInstance(clean_module.get_engine('bs4'), clean_module.Bs4Engine)
+        self.assertRaises(ValueError, clean_module.get_engine, 'html5lib')
+
+    def test_engines_match_clean(self):
+        for html_string in self.html_strings:
+            bs4_string = html_to_xhtml(clean(html_string, engine='bs4'), engine='bs4')
+            lxml_string = html_to_xhtml(clean(html_string, engine='lxml'), engine='lxml')
+            self.assertEqual(canonical_form(lxml_string), canonical_form(bs4_string))
+
+    def test_engines_match_singleton_tags(self):
+        s = u'<html><head></head><body><p>a<br class="x">b<img alt="a/b" src="c.png"></p><hr></body></html>'
+        self.assertEqual(html_to_xhtml(s, engine='lxml'), html_to_xhtml(s, engine='bs4'))
+        self.assertIn(u'<img alt="a/b" src="c.png" />', html_to_xhtml(s, engine='lxml'))
+
+    def test_engines_match_chapter(self):
+        bs4_factory = chapter.ChapterFactory(engine='bs4')
+        lxml_factory = chapter.ChapterFactory(engine='lxml')
+        for html_string in self.html_strings:
+            bs4_chapter = bs4_factory.create_chapter_from_string(html_string)
+            lxml_chapter = lxml_factory.create_chapter_from_string(html_string)
+            self.assertEqual(lxml_chapter.title, bs4_chapter.title)
+            self.assertEqual(canonical_form(lxml_chapter.content), canonical_form(bs4_chapter.content))
+
+    def test_engines_match_deep_tree(self):
+        levels = 300
+        s = u'<html><head></head><body>%s%s</body></html>' % (u'<section><p>level</p><div>' * levels, u'</div></section>' * levels)
+        bs4_root = clean_module.get_engine('bs4').clean_tree(BeautifulSoup(s, 'html.parser'))
+        lxml_engine = clean_module.get_engine('lxml')
+        lxml_root = lxml_engine.clean_tree(lxml_engine.parse(s))
+        self.assertEqual(len(bs4_root.find_all('p')), levels)
+        self.assertEqual(len(lxml_root.findall('.//p')), levels)
+        self.assertEqual(canonical_form(lxml_engine.html_tree_to_string(lxml_root)),
+                         canonical_form(unicode(bs4_root)))
+
+    def test_engines_match_extract_content(self):
+        for html_string in self.html_strings:
+            bs4_string = html_to_xhtml(clean(html_string, engine='bs4', extract_content=True), engine='bs4')
+            lxml_string = html_to_xhtml(clean(html_string, engine='lxml', extract_content=True), engine='lxml')
+            self.assertEqual(canonical_form(lxml_string), canonical_form(bs4_string))
+
+    def test_bs4_xhtml_is_well_formed(self):
+        for html_string in self.html_strings:
+            bs4_string = html_to_xhtml(clean(html_string, engine='bs4'), engine='bs4')
+            # The doctype isn't an xml one
+            clean_module.lxml.etree.fromstring(bs4_string.split(u'>', 1)[1].encode('utf-8'))
+
+    def test_lxml_whitelist(self):
+        for html_string in self.html_strings:
+            lxml_string = html_to_xhtml(clean(html_string, engine='lxml'), engine='lxml')
+            for event in canonical_form(lxml_string):
+                if isinstance(event, tuple) and event[0] != 'article':
+                    tag, attributes = event
+                    self.assertIn(tag, SUPPORTED_TAGS)
+                    for attribute, value in attributes:
+                        self.assertTrue(attribute in SUPPORTED_TAGS[tag] or attribute == 'xmlns')
+
+    def test_lxml_xhtml_is_well_formed(self):
+        for html_string in self.html_strings:
+            lxml_string = html_to_xhtml(clean(html_string, engine='lxml'), engine='lxml')
+            clean_module.lxml.etree.fromstring(lxml_string.encode('utf-8'))
+
+
 if __name__ == '__main__':
     unittest.main()
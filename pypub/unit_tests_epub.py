@@ -1,14 +1,22 @@
 import copy
+import io
 import unittest
 import os
 import os.path
 import shutil
 import tempfile
+import threading
 import time
+import zipfile
 
+import jinja2
+
+import archive
 import chapter
 from constants import *
 import epub
+import local_server
+import storage
 
 
 class TestEpub(unittest.TestCase):
@@ -90,6 +98,394 @@ class TestEpub(unittest.TestCase):
         else:
             self.assertRaises(NotImplementedError, createContentOPF)
 
+    def test_add_chapter_releases_content_tree(self):
+        e = epub.Epub('Test Epub')
+        c = chapter.ChapterFactory(engine='bs4').create_chapter_from_file(
+                os.path.join(TEST_DIR, 'example.html'))
+        # Chapters from a ChapterFactory only keep their content string
+        self.assertIsNone(c._content_tree)
+        e.add_chapter(c)
+        self.assertIsNone(c._content_tree)
+        with open(os.path.join(e.OEBPS_DIR, '0.xhtml'), 'rb') as f:
+            self.assertEqual(f.read().decode('utf-8'), c.content)
+        c = chapter.Chapter(u'<html><head></head><body><p>Parsed</p></body></html>', u'Parsed')
+        self.assertEqual(c._get_image_urls(), [])
+        self.assertIsNotNone(c._content_tree)
+        e.add_chapter(c)
+        self.assertIsNone(c._content_tree)
+        shutil.rmtree(e.EPUB_DIR)
+
+    def test_create_epub_archive(self):
+        e = epub.Epub('Test Zip')
+        e.add_chapter(chapter.create_chapter_from_file(os.path.join(TEST_DIR, 'example.html')))
+        output_directory = tempfile.mkdtemp()
+        epub_path = e.create_epub(output_directory)
+        self.assertEqual(epub_path, os.path.join(output_directory, 'Test Zip.epub'))
+        self.assertEqual(os.listdir(output_directory), ['Test Zip.epub'])
+        epub_zip = zipfile.ZipFile(epub_path)
+        mimetype_info = epub_zip.infolist()[0]
+        self.assertEqual(mimetype_info.filename, 'mimetype')
+        self.assertEqual(mimetype_info.compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(epub_zip.read('mimetype'), 'application/epub+zip')
+        self.assertEqual(sorted(epub_zip.namelist()),
+                         ['META-INF/container.xml', 'OEBPS/0.xhtml', 'OEBPS/content.opf',
+                          'OEBPS/toc.html', 'OEBPS/toc.ncx', 'mimetype'])
+        self.assertIsNone(epub_zip.testzip())
+        epub_zip.close()
+        shutil.rmtree(output_directory)
+        shutil.rmtree(e.EPUB_DIR)
+
+    def test_archive_write_chunks(self):
+        output = io.BytesIO()
+        chunks = [u'chapter \u2019%d\n' % n for n in range(20000)]
+        with archive.EpubArchive(output) as epub_archive:
+            epub_archive.write_chunks('OEBPS/toc.ncx', iter(chunks))
+            epub_archive.write_chunks('OEBPS/empty.html', [])
+            epub_archive.write_chunks('OEBPS/stored.html', ['a', 'b'], zipfile.ZIP_STORED)
+        epub_zip = zipfile.ZipFile(output)
+        self.assertIsNone(epub_zip.testzip())
+        self.assertEqual(epub_zip.read('OEBPS/toc.ncx'), u''.join(chunks).encode('utf-8'))
+        self.assertEqual(epub_zip.read('OEBPS/empty.html'), '')
+        self.assertEqual(epub_zip.read('OEBPS/stored.html'), 'ab')
+        self.assertEqual(epub_zip.getinfo('OEBPS/stored.html').compress_type, zipfile.ZIP_STORED)
+
+    def test_archive_compression_policy(self):
+        policy = archive.CompressionPolicy({'application/xhtml+xml': 9, 'text/css': 0})
+        self.assertEqual(archive.get_media_type('OEBPS/images/a.JPG'), 'image/jpeg')
+        self.assertEqual(archive.get_media_type('OEBPS/toc.ncx'), 'application/x-dtbncx+xml')
+        self.assertEqual(archive.get_media_type('OEBPS/unknown'), 'application/octet-stream')
+        chapters = [('OEBPS/%d.xhtml' % n, u'<p>chapter \u2019%d</p>\n' % n * (n * 500)) for n in range(40)]
+        output = io.BytesIO()
+        with archive.EpubArchive(output, compression_policy=policy, max_workers=4) as epub_archive:
+            epub_archive.write_entries(iter([('OEBPS/images/a.png', lambda: 'png data')] +
+                                            [(name, lambda data=data: data) for name, data in chapters]))
+            epub_archive.write_string('OEBPS/style.css', 'p {}')
+            epub_archive.write_string('OEBPS/images/b.gif', 'gif data', zipfile.ZIP_DEFLATED)
+            epub_archive.write_file('OEBPS/images/c.png', os.path.join(TEST_DIR, 'test image 0.png'))
+            epub_archive.write_chunks('OEBPS/toc.ncx', ['<ncx>', '</ncx>'])
+        epub_zip = zipfile.ZipFile(output)
+        self.assertIsNone(epub_zip.testzip())
+        self.assertEqual(epub_zip.namelist(),
+                         ['mimetype', 'META-INF/container.xml', 'OEBPS/images/a.png'] +
+                         [name for name, data in chapters] +
+                         ['OEBPS/style.css', 'OEBPS/images/b.gif', 'OEBPS/images/c.png', 'OEBPS/toc.ncx'])
+        compress_types = dict((zip_info.filename, zip_info.compress_type) for zip_info in epub_zip.infolist())
+        for name, compress_type in (('mimetype', zipfile.ZIP_STORED),
+                                    ('META-INF/container.xml', zipfile.ZIP_DEFLATED),
+                                    ('OEBPS/images/a.png', zipfile.ZIP_STORED),
+                                    ('OEBPS/10.xhtml', zipfile.ZIP_DEFLATED),
+                                    ('OEBPS/style.css', zipfile.ZIP_STORED),
+                                    ('OEBPS/images/b.gif', zipfile.ZIP_DEFLATED),
+                                    ('OEBPS/images/c.png', zipfile.ZIP_STORED),
+                                    ('OEBPS/toc.ncx', zipfile.ZIP_DEFLATED)):
+            self.assertEqual(compress_types[name], compress_type)
+        for name, data in chapters:
+            self.assertEqual(epub_zip.read(name).decode('utf-8'), data)
+        self.assertEqual(epub_zip.read('OEBPS/images/a.png'), 'png data')
+        with open(os.path.join(TEST_DIR, 'test image 0.png'), 'rb') as f:
+            self.assertEqual(epub_zip.read('OEBPS/images/c.png'), f.read())
+
+    def test_entry_order_is_deterministic(self):
+        server = local_server.LocalServer()
+        with open(os.path.join(TEST_DIR, 'test image 0.png'), 'rb') as f:
+            png_data = f.read()
+        html_strings = []
+        for n in range(6):
+            image_url = server.add_route('/%d.png' % n, png_data + str(n), 'image/png')
+            html_strings.append(u'<html><head></head><body><p>%d</p><img src="%s"/></body></html>' % (n, image_url))
+
+        e = epub.Epub('Ordered', store=storage.MemoryStore())
+        results = [e.add_chapter_async(chapter.Chapter(html_string, u'Chapter')) for html_string in html_strings]
+        for result in results:
+            result.get()
+        names = zipfile.ZipFile(io.BytesIO(e.create_epub_bytes())).namelist()
+        self.assertEqual(names[2:8], ['OEBPS/%d.xhtml' % n for n in range(6)])
+        self.assertEqual(names[8:14], sorted(names[8:14]))
+        # The same files saved in another order make the same epub
+        reordered_store = storage.MemoryStore()
+        for name in reversed(e.store.names()):
+            reordered_store.write(name, e.store.read(name))
+        e.store = reordered_store
+        self.assertEqual(zipfile.ZipFile(io.BytesIO(e.create_epub_bytes())).namelist(), names)
+        server.close()
+
+    def test_failed_async_chapter_left_out(self):
+        class FailingStore(storage.MemoryStore):
+            def write(self, name, data):
+                if name == '1.xhtml':
+                    raise IOError('disk full')
+                storage.MemoryStore.write(self, name, data)
+        e = epub.Epub('Failing', store=FailingStore())
+        html_string = u'<html><head></head><body><p>%s</p></body></html>'
+        results = [e.add_chapter_async(chapter.Chapter(html_string % title, title))
+                   for title in (u'One', u'Two', u'Three')]
+        results[0].get()
+        self.assertRaises(IOError, results[1].get)
+        results[2].get()
+        self.assertEqual([record.href for record in e.chapters], ['0.xhtml', '2.xhtml'])
+        epub_zip = zipfile.ZipFile(io.BytesIO(e.create_epub_bytes()))
+        self.assertIsNone(epub_zip.testzip())
+        opf = epub_zip.read('OEBPS/content.opf')
+        self.assertIn('<item href="2.xhtml" id="2" media-type="application/xhtml+xml"/>', opf)
+        self.assertNotIn('1.xhtml', opf)
+        self.assertIn('src="2.xhtml"', epub_zip.read('OEBPS/toc.ncx'))
+        self.assertIn('"2.xhtml"', epub_zip.read('OEBPS/toc.html'))
+        self.assertEqual(epub._chapter_title_regex.findall(epub_zip.read('OEBPS/toc.ncx')), [u'One', u'Three'])
+        e.chapters.append(epub._ChapterRecord(u'Pending', '3', '3.xhtml'))
+        self.assertRaises(ValueError, e.create_epub_bytes)
+
+        # A failed chapter is only removed while chapters is not being read
+        write_started = threading.Event()
+
+        class BlockingStore(FailingStore):
+            def write(self, name, data):
+                write_started.wait()
+                FailingStore.write(self, name, data)
+        e = epub.Epub('Failing', store=BlockingStore())
+        write_started.set()
+        e.add_chapter(chapter.Chapter(html_string % u'Zero', u'Zero'))
+        write_started.clear()
+        result = e.add_chapter_async(chapter.Chapter(html_string % u'One', u'One'))
+        with e._chapters_lock:
+            write_started.set()
+            result.wait(0.2)
+            self.assertFalse(result.ready())
+        self.assertRaises(IOError, result.get)
+        self.assertEqual([record.href for record in e.chapters], ['0.xhtml'])
+
+    def test_stored_and_large_files_streamed(self):
+        class RecordingStore(storage.DiskStore):
+            def __init__(self):
+                storage.DiskStore.__init__(self)
+                self.read_names = []
+                self.streamed_names = []
+
+            def read(self, name):
+                self.read_names.append(name)
+                return storage.DiskStore.read(self, name)
+
+            def write_to_archive(self, name, epub_archive, archive_name):
+                self.streamed_names.append(name)
+                storage.DiskStore.write_to_archive(self, name, epub_archive, archive_name)
+        store = RecordingStore()
+        e = epub.Epub('Streamed Files', store=store, compress_workers=4)
+        for n in range(3):
+            e.add_chapter(chapter.Chapter(u'<html><head></head><body><p>%d</p></body></html>' % n, u'%d' % n))
+        store.write('images/a.png', 'png data')
+        store.write('style.css', 'p { margin: 0 }\n' * 1000)
+        max_parallel_entry_size = epub._MAX_PARALLEL_ENTRY_SIZE
+        epub._MAX_PARALLEL_ENTRY_SIZE = 1000
+        try:
+            epub_zip = zipfile.ZipFile(io.BytesIO(e.create_epub_bytes()))
+        finally:
+            epub._MAX_PARALLEL_ENTRY_SIZE = max_parallel_entry_size
+        self.assertEqual(sorted(store.read_names), ['0.xhtml', '1.xhtml', '2.xhtml'])
+        self.assertEqual(store.streamed_names, ['images/a.png', 'style.css'])
+        self.assertEqual(epub_zip.namelist()[2:7],
+                         ['OEBPS/0.xhtml', 'OEBPS/1.xhtml', 'OEBPS/2.xhtml', 'OEBPS/images/a.png', 'OEBPS/style.css'])
+        self.assertEqual(epub_zip.getinfo('OEBPS/images/a.png').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(epub_zip.getinfo('OEBPS/style.css').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(epub_zip.read('OEBPS/style.css'), 'p { margin: 0 }\n' * 1000)
+        self.assertIsNone(epub_zip.testzip())
+        store.close()
+
+    def test_streamed_tocs(self):
+        e = epub.Epub('Streamed', store=storage.MemoryStore())
+        for c in self.chapter_list:
+            e.add_chapter(c)
+        epub_zip = zipfile.ZipFile(io.BytesIO(e.create_epub_bytes()))
+        for epub_file, name in ((epub.TocHtml(), 'toc.html'), (epub.TocNcx(), 'toc.ncx'),
+                                (epub.ContentOpf(**e.opf.non_chapter_parameters), 'content.opf')):
+            self.assertEqual(epub_file.content, u'')
+            epub_file.add_chapters(e.chapters)
+            self.assertEqual(epub_zip.read('OEBPS/' + name).decode('utf-8'), epub_file.content)
+        self.assertEqual(epub_file.content.count('<itemref idref='), len(self.chapter_list) + 1)
+
+    def test_update_epub(self):
+        server = local_server.LocalServer()
+        with open(os.path.join(TEST_DIR, 'test image 0.png'), 'rb') as f:
+            image_url = server.add_route('/image.png', f.read(), 'image/png')
+        html_string = u'<html><head></head><body><p>%s</p><img src="' + image_url + '"/></body></html>'
+        output_directory = tempfile.mkdtemp()
+        e = epub.Epub('Serial', store=storage.MemoryStore())
+        e.add_chapter(chapter.Chapter(html_string % u'One', u'Chapter \u2019 One'))
+        e.add_chapter(chapter.Chapter(html_string % u'Two', u'Chapter & Two'))
+        epub_path = e.create_epub(output_directory)
+
+        def read_entries(epub_path):
+            epub_zip = zipfile.ZipFile(epub_path)
+            self.assertIsNone(epub_zip.testzip())
+            entries = {}
+            with open(epub_path, 'rb') as f:
+                epub_bytes = f.read()
+            infos = sorted(epub_zip.infolist(), key=lambda zip_info: zip_info.header_offset)
+            for index, zip_info in enumerate(infos):
+                end_offset = archive._get_end_offset(epub_zip, zip_info)
+                if index + 1 < len(infos):
+                    # no unused space is left between entries
+                    self.assertEqual(end_offset, infos[index + 1].header_offset)
+                entries[zip_info.filename] = epub_bytes[zip_info.header_offset:end_offset]
+            epub_zip.close()
+            return entries
+        old_entries = read_entries(epub_path)
+
+        opened = epub.Epub.open(epub_path, store=storage.MemoryStore())
+        self.assertEqual(opened.title, 'Serial')
+        self.assertEqual(opened.uid, e.uid)
+        self.assertEqual([c.title for c in opened.chapters], [u'Chapter \u2019 One', u'Chapter & Two'])
+        opened.add_chapter(chapter.Chapter(html_string % u'Three', u'Chapter Three'))
+        self.assertRaises(ValueError, opened.create_epub, output_directory)
+        copy_path = opened.create_epub(output_directory, 'Serial copy')
+        opened.update_epub()
+        new_entries = read_entries(epub_path)
+        self.assertEqual(sorted(new_entries), sorted(old_entries.keys() + ['OEBPS/2.xhtml']))
+        for name in old_entries:
+            if name not in ('OEBPS/toc.html', 'OEBPS/toc.ncx', 'OEBPS/content.opf'):
+                self.assertEqual(new_entries[name], old_entries[name])
+        read_entries(copy_path)
+        for name in new_entries:
+            self.assertEqual(zipfile.ZipFile(copy_path).read(name), zipfile.ZipFile(epub_path).read(name))
+        self.assertEqual(server.request_count('/image.png'), 2)
+
+        opened = epub.Epub.open(epub_path, store=storage.MemoryStore())
+        opened.add_chapter(chapter.Chapter(html_string % u'Four', u'Chapter Four'))
+        opened.update_epub()
+        epub_zip = zipfile.ZipFile(epub_path)
+        ncx = epub_zip.read('OEBPS/toc.ncx').decode('utf-8')
+        self.assertEqual(epub._chapter_title_regex.findall(ncx),
+                         [u'Chapter \u2019 One', u'Chapter & Two', u'Chapter Three', u'Chapter Four'])
+        self.assertEqual(epub_zip.read('OEBPS/content.opf'), e.opf.content.replace(
+            '<itemref idref="1"/>', '<itemref idref="1"/>\n    \n    <itemref idref="2"/>\n    \n    '
+            '<itemref idref="3"/>').replace(
+            '<item href="1.xhtml" id="1" media-type="application/xhtml+xml"/>',
+            '<item href="1.xhtml" id="1" media-type="application/xhtml+xml"/>\n    \n    '
+            '<item href="2.xhtml" id="2" media-type="application/xhtml+xml"/>\n    \n    '
+            '<item href="3.xhtml" id="3" media-type="application/xhtml+xml"/>'))
+        self.assertEqual(len([name for name in epub_zip.namelist() if name.startswith('OEBPS/images/')]), 1)
+        epub_zip.close()
+
+        self.assertRaises(ValueError, e.update_epub)
+        self.assertRaises(ValueError, epub.Epub.open, os.path.join(TEST_DIR, 'example.html'))
+        server.close()
+        shutil.rmtree(output_directory)
+
+    def test_failed_update_epub_restored(self):
+        class FailingStore(storage.MemoryStore):
+            def read(self, name):
+                raise IOError('disk error')
+        output_directory = tempfile.mkdtemp()
+        e = epub.Epub('Serial', store=storage.MemoryStore())
+        for title in (u'One', u'Two'):
+            e.add_chapter(chapter.Chapter(u'<html><head></head><body><p>%s</p></body></html>' % title, title))
+        epub_path = e.create_epub(output_directory)
+        with open(epub_path, 'rb') as f:
+            epub_bytes = f.read()
+        opened = epub.Epub.open(epub_path, store=FailingStore())
+        opened.add_chapter(chapter.Chapter(u'<html><head></head><body><p>Three</p></body></html>', u'Three'))
+        self.assertRaises(IOError, opened.update_epub)
+        with open(epub_path, 'rb') as f:
+            self.assertEqual(f.read(), epub_bytes)
+        self.assertEqual([record.title for record in epub.Epub.open(epub_path).chapters], [u'One', u'Two'])
+        shutil.rmtree(output_directory)
+
+    def test_epub_writer(self):
+        server = local_server.LocalServer()
+        with open(os.path.join(TEST_DIR, 'test image 0.png'), 'rb') as f:
+            image_url = server.add_route('/image.png', f.read(), 'image/png')
+        html_string = u'<html><head></head><body><p>%s</p><img src="' + image_url + '"/></body></html>'
+        titles = [u'Chapter \u2019 One', u'Chapter & Two', u'Chapter Three']
+        output_directory = tempfile.mkdtemp()
+        epub_path = os.path.join(output_directory, 'Streamed.epub')
+        with epub.EpubWriter(epub_path, 'Streamed') as writer:
+            writer.add_chapter(chapter.Chapter(html_string % u'One', titles[0]))
+            # written as soon as it is added, with its image
+            image_name, chapter_name = writer._archive.names()[2:]
+            self.assertTrue(image_name.startswith('OEBPS/images/'))
+            self.assertEqual(chapter_name, 'OEBPS/0.xhtml')
+            result = writer.add_chapter_async(chapter.Chapter(html_string % u'Two', titles[1]))
+            writer.add_chapter(chapter.Chapter(html_string % u'Three', titles[2]))
+        self.assertTrue(writer.closed)
+        self.assertTrue(result.ready())
+        self.assertRaises(ValueError, writer.add_chapter, chapter.Chapter(html_string % u'Four', u'Four'))
+        self.assertEqual([record.title for record in writer.chapters], titles)
+        self.assertEqual(writer.metrics.summary()['stages']['zip']['bytes_out'], os.path.getsize(epub_path))
+
+        e = epub.Epub('Streamed', store=storage.MemoryStore())
+        for index, title in enumerate(titles):
+            e.add_chapter(chapter.Chapter(html_string % [u'One', u'Two', u'Three'][index], title))
+        e.opf = writer._epub.opf
+        expected_zip = zipfile.ZipFile(io.BytesIO(e.create_epub_bytes()))
+        epub_zip = zipfile.ZipFile(epub_path)
+        self.assertIsNone(epub_zip.testzip())
+        self.assertEqual(epub_zip.namelist()[:2], ['mimetype', 'META-INF/container.xml'])
+        self.assertEqual(epub_zip.namelist()[-3:], ['OEBPS/toc.html', 'OEBPS/toc.ncx', 'OEBPS/content.opf'])
+        self.assertEqual(sorted(epub_zip.namelist()), sorted(expected_zip.namelist()))
+        for name in epub_zip.namelist():
+            self.assertEqual(epub_zip.read(name), expected_zip.read(name))
+        self.assertEqual(server.request_count('/image.png'), 2)
+        epub_zip.close()
+
+        output = io.BytesIO()
+        with epub.EpubWriter(output, 'In Memory') as writer:
+            writer.add_chapter(chapter.Chapter(u'<html><head></head><body><p>One</p></body></html>', u'One'))
+        self.assertIsNone(zipfile.ZipFile(output).testzip())
+        self.assertRaises(ValueError, epub.EpubWriter, io.BytesIO(), '')
+        server.close()
+        shutil.rmtree(output_directory)
+
+    def test_epub_writer_aborted(self):
+        output_directory = tempfile.mkdtemp()
+        epub_path = os.path.join(output_directory, 'Aborted.epub')
+        try:
+            with epub.EpubWriter(epub_path, 'Aborted') as writer:
+                writer.add_chapter(chapter.Chapter(u'<html><head></head><body><p>One</p></body></html>', u'One'))
+                writer.add_chapter(u'not a chapter')
+        except TypeError:
+            pass
+        self.assertTrue(writer.closed)
+        self.assertEqual(os.listdir(output_directory), [])
+        shutil.rmtree(output_directory)
+
+    def test_templates_compiled_once(self):
+        template = epub._get_template(os.path.join(EPUB_TEMPLATES_DIR, 'toc.html'))
+        self.assertIs(epub._get_template(os.path.join(EPUB_TEMPLATES_DIR, 'toc.html')), template)
+        with open(os.path.join(EPUB_TEMPLATES_DIR, 'toc.html'), 'rb') as f:
+            uncached_template = jinja2.Template(f.read().decode('utf-8'))
+        toc = epub.TocHtml()
+        toc.add_chapters(self.chapter_list)
+        chapters = [{'title': c.title, 'link': '%d.xhtml' % n} for n, c in enumerate(self.chapter_list)]
+        self.assertEqual(toc.content, uncached_template.render(chapters=chapters))
+
+    def test_custom_template_reloaded(self):
+        template_directory = tempfile.mkdtemp()
+        template_file = os.path.join(template_directory, 'toc.html')
+        with open(template_file, 'wb') as f:
+            f.write('{% for c in chapters %}{{ c.title }};{% endfor %}')
+        toc = epub.TocHtml(template_file)
+        toc.add_chapters(self.chapter_list[:1])
+        self.assertEqual(toc.content, self.chapter_list[0].title + ';')
+        with open(template_file, 'wb') as f:
+            f.write('{% for c in chapters %}{{ c.link }}{% endfor %}')
+        os.utime(template_file, (time.time() + 10, time.time() + 10))
+        toc.add_chapters(self.chapter_list[:1])
+        self.assertEqual(toc.content, '0.xhtml')
+        shutil.rmtree(template_directory)
+
+    def test_template_bytecode_cache(self):
+        cache_directory = tempfile.mkdtemp()
+        template_environments = epub._template_environments
+        epub._template_environments = {}
+        try:
+            epub.set_template_bytecode_cache(cache_directory)
+            toc = epub.TocNcx()
+            toc.add_chapters(self.chapter_list)
+            toc.get_content()
+            self.assertEqual(len(os.listdir(cache_directory)), 1)
+        finally:
+            epub._template_environments = template_environments
+            epub._template_bytecode_cache = None
+            shutil.rmtree(cache_directory)
+
     def test_create_epub(self):
         epub_dir_ending = time.strftime("%m%d%Y%H%M%S")
         epub_directory = os.path.join(TEST_DIR, 'epub_output', 'epub files' + epub_dir_ending)
@@ -1,7 +1,13 @@
 import os
+import shutil
+import tempfile
+import time
 import unittest
 
 import chapter
+import epub
+import local_server
+import storage
 
 
 test_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -50,5 +56,201 @@ class ChapterTests(unittest.TestCase):
 
 
 
+class ConcurrentImageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = local_server.LocalServer(delay=0.2)
+        with open(os.path.join(test_directory, 'test image 0.png'), 'rb') as f:
+            png_data = f.read()
+        self.image_data = {}
+        image_tags = []
+        for index in range(6):
+            path = '/image%d.png' % index
+            if index == 3:
+                image_tags.append('<img src="%s"/>' % self.server.get_url('/missing.png'))
+                continue
+            self.image_data[index] = png_data + str(index)
+            image_tags.append('<img src="%s"/>' % self.server.add_route(path, self.image_data[index], 'image/png'))
+        self.html_string = '<html><head></head><body>%s</body></html>' % ''.join(image_tags)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_replace_images_concurrently(self):
+        c = chapter.Chapter(self.html_string, 'Images')
+        store = storage.MemoryStore()
+        start_time = time.time()
+        c._replace_images_in_chapter(store, max_workers=8)
+        # one after another the six requests would take 1.2 seconds
+        self.assertLess(time.time() - start_time, 0.8)
+        image_nodes = c._get_content_tree().find_all('img')
+        self.assertEqual(len(image_nodes), 5)
+        for index, node in zip([0, 1, 2, 4, 5], image_nodes):
+            self.assertEqual(store.read(node['src']), self.image_data[index])
+
+    def test_images_downloaded_once(self):
+        c = chapter.Chapter(self.html_string, 'Images')
+        c._replace_images_in_chapter(storage.MemoryStore())
+        for index in self.image_data:
+            self.assertEqual(self.server.request_count('/image%d.png' % index), 1)
+
+    def test_get_image_type(self):
+        with open(os.path.join(test_directory, 'test image 0.png'), 'rb') as f:
+            png_data = f.read()
+        self.assertEqual(chapter.get_image_type(os.path.join(test_directory, 'test image 0.png')), 'png')
+        self.assertEqual(chapter.get_image_type(os.path.join(test_directory, 'test image 1.jpg')), 'jpg')
+        self.assertEqual(chapter.get_image_type(os.path.join(test_directory, 'test image 1.jpeg')), 'jpeg')
+        url = self.server.add_route('/image?id=1', png_data, 'image/png')
+        self.assertEqual(chapter.get_image_type(url), 'png')
+        url = self.server.add_route('/photo.jpg?size=large', png_data, 'image/png')
+        self.assertEqual(chapter.get_image_type(url), 'png')
+        url = self.server.add_route('/drawing', '<svg></svg>', 'image/svg+xml')
+        self.assertEqual(chapter.get_image_type(url), 'svg')
+        url = self.server.add_route('/not_an_image.jpg', '<html></html>', 'text/html')
+        self.assertEqual(chapter.get_image_type(url), None)
+        self.assertRaises(chapter.ImageErrorException, chapter._download_image, url)
+        self.assertEqual(chapter.get_image_type(self.server.get_url('/missing.gif')), None)
+
+    def test_replace_images_serially(self):
+        c = chapter.Chapter(self.html_string, 'Images')
+        store = storage.MemoryStore()
+        c._replace_images_in_chapter(store)
+        image_nodes = c._get_content_tree().find_all('img')
+        for index, node in zip([0, 1, 2, 4, 5], image_nodes):
+            self.assertEqual(store.read(node['src']), self.image_data[index])
+
+    def test_add_chapters_async(self):
+        e = epub.Epub('Async', store=storage.MemoryStore())
+        image_chapter = chapter.Chapter(self.html_string, 'Images')
+        text_chapter = chapter.Chapter(u'<html><head></head><body><p>Text</p></body></html>', 'Text')
+        added = []
+        start_time = time.time()
+        results = [e.add_chapter_async(image_chapter), e.add_chapter_async(text_chapter, added.append)]
+        # the call returns before any image is downloaded
+        self.assertLess(time.time() - start_time, 0.2)
+        self.assertEqual([result.get(10) for result in results], [image_chapter, text_chapter])
+        self.assertEqual(added, [text_chapter])
+        self.assertEqual([record.title for record in e.chapters], ['Images', 'Text'])
+        self.assertEqual([record.size for record in e.chapters],
+                         [len(image_chapter.content), len(text_chapter.content)])
+        self.assertEqual(len(image_chapter._get_content_tree().find_all('img')), 5)
+        self.assertEqual(e.store.read('0.xhtml').decode('utf-8'), image_chapter.content)
+        self.assertEqual(e.store.read('1.xhtml').decode('utf-8'), text_chapter.content)
+        self.assertRaises(TypeError, e.add_chapter_async, 'not a chapter')
+
+    def test_async_chapters_share_download(self):
+        e = epub.Epub('Async', store=storage.MemoryStore())
+        chapters = [chapter.Chapter(self.html_string, 'Images %d' % index) for index in range(2)]
+        results = [e.add_chapter_async(c) for c in chapters]
+        self.assertEqual([result.get(10) for result in results], chapters)
+        for index in self.image_data:
+            self.assertEqual(self.server.request_count('/image%d.png' % index), 1)
+        self.assertEqual([node['src'] for node in chapters[0]._get_content_tree().find_all('img')],
+                         [node['src'] for node in chapters[1]._get_content_tree().find_all('img')])
+        self.assertEqual(len(chapters[1]._get_content_tree().find_all('img')), 5)
+
+
+class ImageRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = local_server.LocalServer()
+        with open(os.path.join(test_directory, 'test image 0.png'), 'rb') as f:
+            self.png_data = f.read()
+        self.logo_url = self.server.add_route('/logo.png', self.png_data, 'image/png')
+        self.logo_copy_url = self.server.add_route('/static/logo-copy.png', self.png_data, 'image/png')
+        self.photo_url = self.server.add_route('/photo.png', self.png_data + 'photo', 'image/png')
+        self.missing_url = self.server.get_url('/missing.png')
+
+    def tearDown(self):
+        self.server.close()
+
+    def create_chapter(self, image_urls):
+        image_tags = ''.join('<img src="%s"/>' % image_url for image_url in image_urls)
+        return chapter.Chapter('<html><head></head><body>%s</body></html>' % image_tags, 'Images')
+
+    def test_images_shared_between_chapters(self):
+        e = epub.Epub('Images', store=storage.MemoryStore())
+        first_chapter = self.create_chapter([self.logo_url, self.photo_url, self.missing_url])
+        second_chapter = self.create_chapter([self.missing_url, self.logo_copy_url, self.logo_url])
+        e.add_chapter(first_chapter)
+        e.add_chapter(second_chapter)
+        image_names = [name for name in e.store.names() if name.startswith('images/')]
+        self.assertEqual(len(image_names), 2)
+        first_sources = [node['src'] for node in first_chapter._get_content_tree().find_all('img')]
+        second_sources = [node['src'] for node in second_chapter._get_content_tree().find_all('img')]
+        self.assertEqual(len(first_sources), 2)
+        self.assertEqual(second_sources, [first_sources[0], first_sources[0]])
+        self.assertEqual(e.store.read(first_sources[0]), self.png_data)
+        self.assertEqual(e.store.read(first_sources[1]), self.png_data + 'photo')
+        for path in ['/logo.png', '/missing.png']:
+            self.assertEqual(self.server.request_count(path), 1)
+        self.assertTrue(e.image_registry.has_failed(self.missing_url))
+
+    def test_image_size_limits(self):
+        large_url = self.server.add_route('/large.png', self.png_data + 'x' * 10000, 'image/png')
+        registry = chapter.ImageRegistry(storage.MemoryStore(), max_image_bytes=len(self.png_data) + 100)
+        registry.add_images([self.logo_url, large_url])
+        self.assertIsNotNone(registry.get_file_name(self.logo_url))
+        self.assertTrue(registry.has_failed(large_url))
+        self.assertRaises(chapter.ImageErrorException, chapter._download_image, large_url, None, 1000)
+
+        e = epub.Epub('Images', store=storage.MemoryStore(), max_book_image_bytes=len(self.png_data))
+        c = self.create_chapter([self.logo_url, self.logo_copy_url, self.photo_url, self.logo_url])
+        e.add_chapter(c)
+        sources = [node['src'] for node in c._get_content_tree().find_all('img')]
+        self.assertEqual(len(sources), 3)
+        self.assertEqual(len(set(sources)), 1)
+        self.assertTrue(e.image_registry.has_failed(self.photo_url))
+        self.assertEqual(e.image_registry.total_bytes, len(self.png_data))
+        e.add_chapter(self.create_chapter([large_url]))
+        # no download is attempted once the budget is spent
+        self.assertEqual(self.server.request_count('/large.png'), 2)
+
+    def test_images_streamed_to_store(self):
+        class RecordingStore(storage.MemoryStore):
+            def __init__(self):
+                storage.MemoryStore.__init__(self)
+                self.chunk_sizes = {}
+
+            def write_chunks(self, name, chunks):
+                chunks = list(chunks)
+                self.chunk_sizes[name] = [len(chunk) for chunk in chunks]
+                storage.MemoryStore.write(self, name, ''.join(chunks))
+        large_data = self.png_data + 'x' * (3 * chapter._IMAGE_CHUNK_SIZE)
+        large_url = self.server.add_route('/large.png', large_data, 'image/png')
+        large_copy_url = self.server.add_route('/large-copy.png', large_data, 'image/png')
+        store = RecordingStore()
+        registry = chapter.ImageRegistry(store)
+        registry.add_images([large_url, self.logo_url, large_copy_url], max_workers=3)
+        self.assertEqual(sorted(store.chunk_sizes), sorted([registry.get_file_name(large_url),
+                                                            registry.get_file_name(self.logo_url)]))
+        self.assertEqual(registry.get_file_name(large_copy_url), registry.get_file_name(large_url))
+        self.assertEqual(sum(store.chunk_sizes[registry.get_file_name(large_url)]), len(large_data))
+        self.assertLessEqual(max(store.chunk_sizes[registry.get_file_name(large_url)]), chapter._IMAGE_CHUNK_SIZE)
+        self.assertEqual(store.read(registry.get_file_name(large_url)), large_data)
+
+    def test_save_image_streams_to_disk(self):
+        image_directory = tempfile.mkdtemp()
+        self.assertEqual(chapter.save_image(self.logo_url, image_directory, 'logo'), 'png')
+        with open(os.path.join(image_directory, 'logo.png'), 'rb') as f:
+            self.assertEqual(f.read(), self.png_data)
+        self.assertRaises(chapter.ImageErrorException, chapter.save_image, self.photo_url, image_directory,
+                          'photo', len(self.png_data))
+        local_image = os.path.join(test_directory, 'test image 0.png')
+        self.assertRaises(chapter.ImageErrorException, chapter.save_image, local_image, image_directory,
+                          'local', 10)
+        self.assertEqual(sorted(os.listdir(image_directory)), ['logo.png'])
+        store = storage.DiskStore()
+
+        def failing_chunks():
+            yield 'partial'
+            raise chapter.ImageErrorException('url')
+        self.assertRaises(chapter.ImageErrorException, store.write_chunks, 'images/a.png', failing_chunks())
+        self.assertEqual(os.listdir(os.path.join(store.directory, 'images')), [])
+        self.assertEqual(store.names(), [])
+        store.close()
+        shutil.rmtree(image_directory)
+
+
 if __name__ == '__main__':
     unittest.main()
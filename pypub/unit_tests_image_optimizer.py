@@ -0,0 +1,134 @@
+import io
+import random
+import struct
+import unittest
+import zlib
+
+import chapter
+import epub
+import image_optimizer
+import local_server
+import storage
+
+if image_optimizer.pillow_module_exists:
+    from PIL import Image
+
+
+def create_image(image_format, size, mode='RGB', photo=True, **save_parameters):
+    image = Image.new(mode, size, 'white')
+    if photo:
+        pixels = image.load()
+        random.seed(size)
+        for x in range(size[0]):
+            for y in range(size[1]):
+                pixels[x, y] = (random.randint(0, 255), x % 256, y % 256) + ((255,) if mode == 'RGBA' else ())
+    output = io.BytesIO()
+    image.save(output, image_format, **save_parameters)
+    return output.getvalue()
+
+
+def create_png_header(width, height):
+    """
+    Returns a tiny PNG that claims to be width by height pixels.
+    """
+    def png_chunk(chunk_type, data):
+        return (struct.pack('>I', len(data)) + chunk_type + data +
+                struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+    return ('\x89PNG\r\n\x1a\n' + png_chunk('IHDR', struct.pack('>IIBBBBB', width, height, 1, 0, 0, 0, 0)) +
+            png_chunk('IDAT', zlib.compress('\x00' * 1000)) + png_chunk('IEND', ''))
+
+
+@unittest.skipUnless(image_optimizer.pillow_module_exists, 'Pillow is not installed')
+class ImageOptimizerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.optimizer = image_optimizer.ImageOptimizer(max_width=100, max_height=100, processes=2)
+        self.optimizer.start()
+
+    def tearDown(self):
+        self.optimizer.close()
+
+    def open_image(self, content):
+        return Image.open(io.BytesIO(content))
+
+    def test_photo_png_resized_to_jpeg(self):
+        content, image_type = self.optimizer.optimize(create_image('PNG', (400, 200)), 'png')
+        self.assertEqual(image_type, 'jpeg')
+        self.assertEqual(self.open_image(content).size, (100, 50))
+
+    def test_screenshot_png_stays_png(self):
+        content, image_type = self.optimizer.optimize(create_image('PNG', (400, 200), photo=False), 'png')
+        self.assertEqual(image_type, 'png')
+        self.assertEqual(self.open_image(content).size, (100, 50))
+        transparent_content = create_image('PNG', (50, 50), 'RGBA', photo=False)
+        self.assertEqual(self.optimizer.optimize(transparent_content, 'png')[1], 'png')
+
+    def test_metadata_stripped(self):
+        original = create_image('JPEG', (200, 200), exif='Exif\x00\x00' + 'x' * 1000)
+        content, image_type = self.optimizer.optimize(original, 'jpg')
+        self.assertEqual(image_type, 'jpg')
+        self.assertNotIn('exif', self.open_image(content).info)
+
+    def test_animated_gif_first_frame(self):
+        frames = [Image.new('P', (40, 40), color) for color in (1, 2, 3)]
+        output = io.BytesIO()
+        frames[0].save(output, 'GIF', save_all=True, append_images=frames[1:])
+        content, image_type = self.optimizer.optimize(output.getvalue(), 'gif')
+        self.assertEqual(image_type, 'gif')
+        self.assertFalse(getattr(self.open_image(content), 'is_animated', False))
+
+    def test_small_images_kept(self):
+        original = create_image('PNG', (20, 20), photo=False)
+        self.assertEqual(self.optimizer.optimize(original, 'png'), (original, 'png'))
+        self.assertEqual(self.optimizer.optimize('<svg></svg>', 'svg'), ('<svg></svg>', 'svg'))
+        self.assertEqual(self.optimizer.optimize('not a png', 'png'), ('not a png', 'png'))
+
+    def test_decompression_bomb_kept(self):
+        bomb = create_png_header(14000, 14000)
+        self.assertEqual(self.optimizer.optimize(bomb, 'png'), (bomb, 'png'))
+        images = [(bomb, 'png'), (create_image('PNG', (300, 300)), 'png')]
+        optimized_images = self.optimizer.optimize_images(images)
+        self.assertEqual(optimized_images[0], (bomb, 'png'))
+        self.assertEqual(optimized_images[1][1], 'jpeg')
+
+    def test_bmp_converted(self):
+        content, image_type = self.optimizer.optimize(create_image('BMP', (30, 30), photo=False), 'bmp')
+        self.assertEqual(image_type, 'png')
+
+    def test_optimize_images_in_parallel(self):
+        images = [(create_image('PNG', (300 + n, 300)), 'png') for n in range(4)]
+        self.assertEqual(self.optimizer.optimize_images(images),
+                         [self.optimizer.optimize(*image) for image in images])
+        self.assertEqual(self.optimizer.optimize_in_pool(*images[0]), self.optimizer.optimize(*images[0]))
+
+    def test_pool_owned_by_epub(self):
+        optimizer = image_optimizer.ImageOptimizer(processes=2)
+        self.assertIsNone(optimizer._pool)
+        e = epub.Epub('Pool', store=storage.MemoryStore(), image_optimizer=optimizer)
+        self.assertIsNotNone(optimizer._pool)
+        e.create_epub_bytes()
+        self.assertIsNone(optimizer._pool)
+        self.assertEqual(optimizer.optimize_in_pool('<svg></svg>', 'svg'), ('<svg></svg>', 'svg'))
+        writer = epub.EpubWriter(io.BytesIO(), 'Pool', image_optimizer=optimizer)
+        self.assertIsNotNone(optimizer._pool)
+        writer.close()
+        self.assertIsNone(optimizer._pool)
+
+    def test_epub_images_optimized(self):
+        with local_server.LocalServer() as server:
+            large_png = create_image('PNG', (400, 400))
+            url = server.add_route('/large.png', large_png, 'image/png')
+            copy_url = server.add_route('/copy.png', large_png, 'image/png')
+            e = epub.Epub('Optimized', store=storage.MemoryStore(), image_optimizer=self.optimizer)
+            c = chapter.Chapter('<html><head></head><body><img src="%s"/><img src="%s"/></body></html>'
+                                % (url, copy_url), 'Images')
+            e.add_chapter(c)
+            sources = [node['src'] for node in c._get_content_tree().find_all('img')]
+            self.assertEqual(sources[0], sources[1])
+            self.assertTrue(sources[0].endswith('.jpeg'))
+            self.assertEqual(self.open_image(e.store.read(sources[0])).size, (100, 100))
+            self.assertLess(e.store.size(sources[0]), len(large_png))
+
+
+if __name__ == '__main__':
+    unittest.main()
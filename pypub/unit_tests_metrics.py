@@ -0,0 +1,85 @@
+import unittest
+
+import chapter
+import epub
+import local_server
+import metrics
+import storage
+from transport import Transport
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_record(self):
+        m = metrics.Metrics()
+        events = []
+        m.subscribe(events.append)
+        with m.time('fetch', 'page') as timer:
+            timer.bytes_out = 10
+        m.record('fetch', 1.0, bytes_out=5)
+        m.increment('images_failed')
+        summary = m.summary()
+        self.assertEqual(summary['stages'].keys(), ['fetch'])
+        self.assertEqual(summary['stages']['fetch']['calls'], 2)
+        self.assertEqual(summary['stages']['fetch']['bytes_out'], 15)
+        self.assertGreaterEqual(summary['stages']['fetch']['seconds'], 1.0)
+        self.assertEqual(summary['counters'], {'images_failed': 1})
+        self.assertEqual([(event.stage, event.name) for event in events], [('fetch', 'page'), ('fetch', None)])
+        self.assertIn('images_failed', m.report())
+        m.unsubscribe(events.append)
+        m.reset()
+        m.record('zip', 0.5)
+        self.assertEqual(m.summary()['stages'].keys(), ['zip'])
+        self.assertEqual(len(events), 2)
+
+    def test_time_stage_without_metrics(self):
+        with metrics.time_stage(None, 'fetch') as timer:
+            timer.bytes_out = 10
+
+
+class BuildMetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = local_server.LocalServer()
+        with open('test_files/test image 0.png', 'rb') as f:
+            self.image = f.read()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_build(self):
+        image_urls = [self.server.add_route('/0.png', self.image, 'image/png'),
+                      self.server.add_route('/1.png', self.image, 'image/png'),
+                      self.server.add_route('/missing.png', 'missing', status=404)]
+        page = ('<html><head><title>Page</title></head><body><p>text</p>%s</body></html>'
+                % ''.join('<img src="%s"/>' % image_url for image_url in image_urls))
+        url = self.server.add_route('/page.html', page)
+        m = metrics.Metrics()
+        factory = chapter.ChapterFactory(transport=Transport(), metrics=m)
+        c = factory.create_chapter_from_url(url)
+        e = epub.Epub('Metrics', store=storage.MemoryStore(), transport=Transport(retries=0), metrics=m)
+        e.add_chapter(c)
+        epub_bytes = e.create_epub_bytes()
+        summary = m.summary()
+        self.assertEqual(summary['stages'].keys(), ['fetch', 'clean', 'xhtml', 'images', 'write', 'zip'])
+        self.assertEqual(summary['stages']['fetch']['bytes_out'], len(page))
+        self.assertEqual(summary['stages']['images']['bytes_in'], 2 * len(self.image))
+        self.assertEqual(summary['stages']['images']['bytes_out'], len(self.image))
+        self.assertEqual(summary['stages']['write']['bytes_out'], e.chapters[0].size)
+        self.assertEqual(summary['stages']['zip']['bytes_out'], len(epub_bytes))
+        self.assertEqual(summary['counters'], {'images_downloaded': 2, 'images_failed': 1, 'images_duplicate': 1})
+        self.assertEqual(len(summary['chapters']), 1)
+        self.assertEqual(summary['chapters'][0]['title'], 'Page')
+        self.assertGreater(summary['chapters'][0]['nodes'], 3)
+
+    def test_epub_default_metrics(self):
+        factory = chapter.ChapterFactory()
+        self.assertIsNone(factory.metrics)
+        e = epub.Epub('Metrics', store=storage.MemoryStore())
+        e.add_chapter(factory.create_chapter_from_string('<html><body><p>text</p></body></html>'))
+        e.create_epub_bytes()
+        self.assertEqual(e.metrics.summary()['stages'].keys(), ['write', 'zip'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import io
+import os
+import unittest
+import zipfile
+
+import archive
+import chapter
+from constants import *
+import epub
+import storage
+
+
+class StorageTests(unittest.TestCase):
+
+    def check_store(self, store):
+        store.write('0.xhtml', u'<html>\u2019</html>')
+        store.write('images/a.png', 'png data')
+        store.write('0.xhtml', 'replaced')
+        self.assertEqual(store.names(), ['0.xhtml', 'images/a.png'])
+        self.assertEqual(store.read('0.xhtml'), 'replaced')
+        self.assertEqual(store.read('images/a.png'), 'png data')
+        self.assertEqual(store.size('images/a.png'), 8)
+        self.assertRaises(KeyError, store.read, 'missing.xhtml')
+        store.write('1.xhtml', 'removed')
+        store.remove('1.xhtml')
+        self.assertEqual(store.names(), ['0.xhtml', 'images/a.png'])
+        self.assertRaises(KeyError, store.read, '1.xhtml')
+        self.assertRaises(KeyError, store.remove, '1.xhtml')
+
+    def test_memory_store(self):
+        store = storage.MemoryStore()
+        self.check_store(store)
+        store.close()
+        self.assertEqual(store.names(), [])
+
+    def test_disk_store(self):
+        store = storage.DiskStore()
+        self.check_store(store)
+        self.assertTrue(os.path.isfile(os.path.join(store.directory, 'images', 'a.png')))
+        store.close()
+        self.assertFalse(os.path.exists(store.directory))
+
+    def test_spilling_store(self):
+        store = storage.SpillingStore(max_memory_bytes=20)
+        self.check_store(store)
+        store.write('images/b.png', 'more png data')
+        self.assertEqual(store.memory_bytes, len('replaced'))
+        self.assertEqual(store._disk_store.names(), ['images/a.png', 'images/b.png'])
+        self.assertEqual(store.read('images/b.png'), 'more png data')
+        disk_directory = store._disk_store.directory
+        # A file moved between memory and disk is deleted from where it was
+        store.write('images/a.png', 'png')
+        self.assertEqual(store._disk_store.names(), ['images/b.png'])
+        self.assertFalse(os.path.exists(os.path.join(disk_directory, 'images', 'a.png')))
+        store.write('0.xhtml', 'x' * 30)
+        self.assertEqual(store._memory_store.names(), ['images/a.png'])
+        self.assertEqual(store.memory_bytes, 3)
+        store.close()
+        self.assertFalse(os.path.exists(disk_directory))
+
+    def test_spilling_store_write_chunks(self):
+        store = storage.SpillingStore(max_memory_bytes=20)
+        store.write_chunks('0.xhtml', ['0123', '456789'])
+        store.write_chunks('images/a.png', iter(['0123456789', '0123456789', 'x']))
+        self.assertEqual(store.memory_bytes, 10)
+        self.assertEqual(store._disk_store.names(), ['images/a.png'])
+        self.assertEqual(store.read('images/a.png'), '0123456789' * 2 + 'x')
+        store.write_chunks('0.xhtml', ['x' * 30])
+        self.assertEqual(store.memory_bytes, 0)
+        self.assertEqual(store._memory_store.names(), [])
+        self.assertEqual(store.read('0.xhtml'), 'x' * 30)
+
+        def failing_chunks():
+            yield 'x' * 30
+            raise IOError('download failed')
+        self.assertRaises(IOError, store.write_chunks, 'images/b.png', failing_chunks())
+        self.assertEqual(store.names(), ['0.xhtml', 'images/a.png'])
+        store.close()
+
+    def test_compressed_stores(self):
+        store = storage.MemoryStore(compress=True)
+        self.check_store(store)
+        store.write('1.xhtml', '<p>text</p>\n' * 1000)
+        self.assertEqual(store.size('1.xhtml'), 12000)
+        self.assertLess(store.memory_size('1.xhtml'), 200)
+        store = storage.SpillingStore(max_memory_bytes=1000, compress=True)
+        store.write('1.xhtml', '<p>text</p>\n' * 1000)
+        store.write('2.xhtml', '<p>more</p>\n' * 1000)
+        self.assertIsNone(store._disk_store)
+        self.assertEqual(store.read('2.xhtml'), '<p>more</p>\n' * 1000)
+        self.assertEqual(store.memory_bytes, store._memory_store.memory_size('1.xhtml') +
+                         store._memory_store.memory_size('2.xhtml'))
+        store.close()
+
+    def test_archive_store(self):
+        output = io.BytesIO()
+        with archive.EpubArchive(output) as epub_archive:
+            store = storage.ArchiveStore(epub_archive)
+            store.write('0.xhtml', u'<html>\u2019</html>')
+            store.write_chunks('images/a.png', ['png ', 'data'])
+            self.assertRaises(ValueError, store.write, '0.xhtml', 'replaced')
+
+            def failing_chunks():
+                yield 'png'
+                raise IOError('download failed')
+            self.assertRaises(IOError, store.write_chunks, 'images/b.png', failing_chunks())
+            self.assertEqual(store.names(), ['0.xhtml', 'images/a.png'])
+            self.assertEqual(store.size('images/a.png'), 8)
+            store.close()
+            self.assertEqual(store.names(), [])
+        epub_zip = zipfile.ZipFile(output)
+        self.assertEqual(epub_zip.namelist()[2:], ['OEBPS/0.xhtml', 'OEBPS/images/a.png'])
+        self.assertEqual(epub_zip.read('OEBPS/0.xhtml').decode('utf-8'), u'<html>\u2019</html>')
+        self.assertEqual(epub_zip.read('OEBPS/images/a.png'), 'png data')
+
+    def test_epub_keeps_chapter_records(self):
+        e = epub.Epub('Records', store=storage.SpillingStore(compress=True))
+        c = chapter.create_chapter_from_file(os.path.join(TEST_DIR, 'example.html'))
+        e.add_chapter(c)
+        e.add_chapter(chapter.Chapter(u'<html><head></head><body><p>\u2019</p></body></html>', u'Second'))
+        record = e.chapters[0]
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertEqual((record.title, record.id, record.href), (c.title, '0', '0.xhtml'))
+        self.assertEqual(record.size, len(c.content.encode('utf-8')))
+        self.assertEqual(e.chapters[1].size, len(u'<html><head></head><body><p>\u2019</p></body></html>'.encode('utf-8')))
+        epub_zip = zipfile.ZipFile(io.BytesIO(e.create_epub_bytes()))
+        self.assertEqual(epub_zip.read('OEBPS/0.xhtml').decode('utf-8'), c.content)
+        self.assertIn('<navLabel><text>Second</text></navLabel>', epub_zip.read('OEBPS/toc.ncx'))
+
+    def test_epub_in_memory(self):
+        e = epub.Epub('Memory Epub', store=storage.MemoryStore())
+        self.assertFalse(hasattr(e, 'EPUB_DIR'))
+        e.add_chapter(chapter.create_chapter_from_file(os.path.join(TEST_DIR, 'example.html')))
+        epub_zip = zipfile.ZipFile(io.BytesIO(e.create_epub_bytes()))
+        self.assertEqual(epub_zip.namelist(),
+                         ['mimetype', 'META-INF/container.xml', 'OEBPS/0.xhtml', 'OEBPS/toc.html',
+                          'OEBPS/toc.ncx', 'OEBPS/content.opf'])
+        self.assertEqual(epub_zip.read('OEBPS/0.xhtml'), e.store.read('0.xhtml'))
+        self.assertIsNone(epub_zip.testzip())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+import chapter
+import local_server
+import storage
+from transport import Transport
+
+
+class TransportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = local_server.LocalServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_connection_reuse(self):
+        url = self.server.add_route('/page.html', '<html>page</html>')
+        with Transport() as transport:
+            for i in range(5):
+                self.assertEqual(transport.get(url).content, '<html>page</html>')
+        self.assertEqual(self.server.request_count('/page.html'), 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_host_pool_sizes(self):
+        host = self.server.get_url('').split('//')[1]
+        transport = Transport(pool_maxsize=2, host_pool_sizes={host: 16})
+        adapter = transport.session.get_adapter(self.server.get_url('/page.html'))
+        self.assertEqual(adapter._pool_maxsize, 16)
+        adapter = transport.session.get_adapter('http://example.com/page.html')
+        self.assertEqual(adapter._pool_maxsize, 2)
+
+    def test_retries(self):
+        url = self.server.add_route('/busy.html', 'busy', status=503)
+        transport = Transport(retries=2, backoff_factor=0)
+        self.assertEqual(transport.get(url).status_code, 503)
+        self.assertEqual(self.server.request_count('/busy.html'), 3)
+
+    def test_headers(self):
+        url = self.server.add_route('/page.html', 'page')
+        Transport(headers={'User-Agent': 'test agent'}).get(url)
+        self.assertEqual(self.server.requests[-1][1].get('User-Agent'), 'test agent')
+
+    def test_chapter_factory(self):
+        url = self.server.add_route('/page.html', '<html><head><title>Page</title></head>'
+                                    '<body><p>text</p></body></html>')
+        factory = chapter.ChapterFactory(transport=Transport())
+        for i in range(3):
+            self.assertEqual(factory.create_chapter_from_url(url).title, 'Page')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_image_downloads(self):
+        with open('test_files/test image 0.png', 'rb') as f:
+            image = f.read()
+        urls = [self.server.add_route('/%d.png' % i, image + str(i), 'image/png') for i in range(4)]
+        image_registry = chapter.ImageRegistry(storage.MemoryStore(), Transport())
+        image_registry.add_images(urls)
+        self.assertEqual(self.server.connections, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()